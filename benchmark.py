@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+'''
+
+Benchmark the workflow on synthetic cities.
+
+For each size, a synthetic city is made with make-synthetic-city.py
+(once, and kept in the work directory), and every stage of the
+workflow from find-communities.py on is run on it, one at a time.  The
+wall time, peak resident memory and node throughput of each stage are
+written as JSON.
+
+Given a --baseline from an earlier run, each stage's time is compared
+to it, and stages which got slower by more than --tolerance are
+reported.  Everything runs offline; the tesselation is not AND-ed with
+any shapefiles.
+
+'''
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from topotools.graph import open_graph
+from topotools.pipeline import Pipeline
+from topotools.workflow import city_stages
+
+log = logging.getLogger(__name__)
+
+
+def make_city(work_dir, n_nodes, seed):
+    """Make a synthetic city, unless it is already there"""
+    city = os.path.join(work_dir, 'synthetic-%i-%i' % (n_nodes, seed))
+    graph = os.path.join(city, 'road.graph')
+    if not os.path.exists(graph):
+        log.info("Making a synthetic city with %i nodes in %s",
+                 n_nodes, city)
+        subprocess.check_call(
+            [sys.executable, 'make-synthetic-city.py', city,
+             '--nodes', str(n_nodes), '--seed', str(seed)])
+    return city, graph
+
+
+def run_stages(city, graph, work_dir, n_nodes, threads, targets):
+    """Run the workflow on a city, from scratch, and time each stage
+
+    The throughput of each stage is given for the n_nodes of the graph.
+    """
+    stages = city_stages(city, threads, graph=graph, shapefiles=False)
+    cache_dir = tempfile.mkdtemp(prefix='cache-', dir=work_dir)
+    try:
+        # No links into the city, they would dangle once the cache is gone
+        pipeline = Pipeline(stages, '.', cache_dir)
+        timings = pipeline.run(targets, jobs=1, poll=0.05)
+    finally:
+        shutil.rmtree(cache_dir)
+    results = {}
+    for name in pipeline.order():
+        if name not in timings:
+            continue
+        results[name] = {
+            'wall': timings[name],
+            'peak_rss_mb': pipeline.peak_rss[name],
+            'nodes_per_second': n_nodes / max(timings[name], 1e-9),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Compare stage wall times to a baseline
+
+    Returns a list of (size, stage, baseline time, time, ratio) and the
+    number of stages slower than the baseline by more than tolerance.
+    """
+    rows = []
+    regressions = 0
+    for size in sorted(results, key=int):
+        for stage, result in sorted(results[size].items()):
+            try:
+                before = baseline[size][stage]['wall']
+            except KeyError:
+                continue
+            ratio = result['wall'] / max(before, 1e-9)
+            rows.append((size, stage, before, result['wall'], ratio))
+            if ratio > 1 + tolerance:
+                regressions += 1
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', metavar='benchmark.json',
+                        help='Output timings')
+
+    parser.add_argument('--nodes', type=int, nargs='+', metavar='N',
+                        default=[10000, 100000],
+                        help='Sizes of the synthetic cities.'
+                        ' Default %(default)s')
+
+    parser.add_argument('--seed', default=1, type=int, help='random seed')
+
+    parser.add_argument('--work-dir', dest='work_dir', metavar='dir',
+                        default='benchmark',
+                        help='Where the synthetic cities are kept.'
+                        ' Default %(default)s')
+
+    parser.add_argument('--threads', type=int, metavar='N', default=4,
+                        help='Threads used by each parallel stage.'
+                        ' Default %(default)i')
+
+    parser.add_argument('--stages', nargs='+', metavar='stage',
+                        default=['merged'],
+                        help='Run up to these stages. Default %(default)s')
+
+    parser.add_argument('--baseline', metavar='baseline.json',
+                        help='Compare to the timings of an earlier run')
+
+    parser.add_argument('--tolerance', type=float, metavar='x', default=0.2,
+                        help='Report stages slower than the baseline by'
+                        ' more than this fraction.  Default %(default)g')
+
+    parser.add_argument('--fail', default=False, action='store_true',
+                        help='Exit with an error if any stage is slower'
+                        ' than the baseline')
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    logging.getLogger('topotools.pipeline').setLevel(logging.INFO)
+
+    if not os.path.isdir(args.work_dir):
+        os.makedirs(args.work_dir)
+
+    results = {}
+    for n_nodes in args.nodes:
+        city, graph = make_city(args.work_dir, n_nodes, args.seed)
+        # The generator only makes about as many nodes as asked for
+        n_graph = len(open_graph(graph).id)
+        log.info("%s has %i nodes", graph, n_graph)
+        results[str(n_nodes)] = run_stages(
+            city, graph, args.work_dir, n_graph, args.threads, args.stages)
+
+    for size in sorted(results, key=int):
+        for stage, result in sorted(results[size].items()):
+            log.info("%9s %-20s %8.2fs %8.0f MB %10.0f nodes/s", size,
+                     stage, result['wall'], result['peak_rss_mb'],
+                     result['nodes_per_second'])
+
+    log.info("Writing to %s", args.output)
+    with open(args.output, 'w') as outputfd:
+        json.dump({
+            'seed': args.seed,
+            'threads': args.threads,
+            'host': platform.node(),
+            'python': platform.python_version(),
+            'results': results,
+        }, outputfd, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baselinefd:
+            baseline = json.load(baselinefd)['results']
+        rows, regressions = compare(results, baseline, args.tolerance)
+        for size, stage, before, after, ratio in rows:
+            log.info("%9s %-20s %8.2fs -> %8.2fs (x%0.2f)%s", size, stage,
+                     before, after, ratio,
+                     ' SLOWER' if ratio > 1 + args.tolerance else '')
+        log.info("%i of %i stages are slower than the baseline",
+                 regressions, len(rows))
+        if regressions and args.fail:
+            sys.exit(1)
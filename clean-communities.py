@@ -16,13 +16,11 @@ Orphaned nodes are assigned to their nearest neighbors.
 
 import argparse
 import itertools
-import gzip
 import logging
 import math
 import operator
 
 import numpy as np
-from shapely.geometry import Point, Polygon, LineString
 from scipy.spatial import KDTree
 
 import topotools
@@ -38,7 +36,8 @@ if __name__ == "__main__":
         help='Gzipped output communities')
 
     parser.add_argument('--bbox', nargs=4, type=float, metavar='x',
-                        help='Only consider nodes within bbox')
+                        help='Only consider nodes within bbox, given in'
+                        ' degrees, not in OSRM integer units')
 
     parser.add_argument('--alphacut', type=float, metavar='x', default=10,
                         help='Concave hull alpha cut. Default %(default)f')
@@ -62,6 +61,8 @@ if __name__ == "__main__":
                         help='Maximum length/width for '
                         'tails Default %(default)f')
 
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
@@ -89,7 +90,8 @@ if __name__ == "__main__":
 
         log.info("Cleaning community %i with %i points",
                  clustidx, len(points))
-        concave_hull = topotools.get_concave_hull(points, args.alphacut)
+        with topotools.metrics.span('get_concave_hull', clustidx):
+            concave_hull = topotools.get_concave_hull(points, args.alphacut)
         # So tiny it doesn't even have a hull
         if concave_hull is None:
             log.info("No concave hull, orphaning judicously")
@@ -118,85 +120,23 @@ if __name__ == "__main__":
         # Trim tails on the concave hulls.  Tails are long, thin,
         # features which are created when the community goes
         # down a road away from the main group.
-        has_tail = True  # guilty until proven innocent
-        while has_tail:
-            hull_outline = LineString(concave_hull.exterior)
-            characteristic_size = math.sqrt(concave_hull.area)
-            outline_pts = hull_outline.coords[:]
-            # find the projections along the line lenght for each point
-            projections = [hull_outline.project(Point(x)) for x in outline_pts]
-            # so we can find neighbors close to each other
-            outline_kdtree = KDTree(outline_pts)
-            biggest_tail = None
-            for idx, point in enumerate(outline_pts):
-                proj = projections[idx]
-                # find nearest neighbors, within 5% of total size
-                neighbors = outline_kdtree.query_ball_point(
-                    point, r=characteristic_size * args.tail_pinch)
-                for neighbor in neighbors:
-                    neighbor_point = outline_pts[neighbor]
-                    if neighbor_point == point:
-                        continue
-                    neighbor_proj = projections[neighbor]
-                    # Find distance along edge in both directions.
-                    # Must wrap around at proj = 0.
-                    # The smaller of the two is the relevant one.
-                    distance_along_edge = abs(neighbor_proj - proj)
-                    distance_along_edge = min(
-                        distance_along_edge,
-                        hull_outline.length - distance_along_edge
-                    )
-                    distance_as_crow_flies = math.hypot(
-                        point[0] - neighbor_point[0],
-                        point[1] - neighbor_point[1])
-                    tailiness = distance_along_edge / distance_as_crow_flies
-                    if tailiness > args.tail_length:
-                        #if not biggest_tail or tailiness > biggest_tail[0]:
-                        metric = tailiness * distance_along_edge
-                        if not biggest_tail or metric > biggest_tail[0]:
-                            log.info("Found tail with length^2/width %f, "
-                                     "from idx %i -> %i",
-                                     metric, idx, neighbor)
-                            biggest_tail = (metric, (idx, neighbor))
-            if biggest_tail:
-                log.info("Clipping from %i -> %i, out of %i edges",
-                         biggest_tail[1][0], biggest_tail[1][1],
-                         len(outline_pts))
-                tail_idx_1 = biggest_tail[1][0]
-                tail_idx_2 = biggest_tail[1][1]
-                min_idx = min(tail_idx_1, tail_idx_2)
-                max_idx = max(tail_idx_1, tail_idx_2)
-
-                # Now create two hypotheses for what to delete.
-                hypo_1 = Polygon(outline_pts[min_idx:max_idx + 1])
-                hypo_2 = Polygon(
-                    outline_pts[:min_idx + 1] + outline_pts[max_idx:])
-                split_hull = [hypo_1, hypo_2]
-
-                assert(len(split_hull) == 2)
-                biggest = max(split_hull, key=lambda x: x.area)
-                log.info("Found new hull with %0.2f of the original area "
-                         "and %0.2f of the original length",
-                         biggest.area / concave_hull.area,
-                         biggest.exterior.length / hull_outline.length)
-                concave_hull = biggest
-            else:
-                print 'break'
-                has_tail = False
+        with topotools.metrics.span('trim_tails', clustidx):
+            concave_hull, clips = topotools.trim_tails(
+                concave_hull, args.tail_pinch, args.tail_length)
 
         buffered = concave_hull.buffer(
             math.sqrt(concave_hull.area) * args.buffer)
 
         log.info("Pruning %i nodes using concave hull", len(points))
         # Exclude points outside the hull.
-        bad = 0
-        for node, point in itertools.izip(node_list, points):
-            if Point(point).within(buffered):
+        inside = topotools.points_in_polygon(points, buffered)
+        for node, good in itertools.izip(node_list, inside):
+            if good:
                 good_nodes.append(node)
             else:
-                bad += 1
                 orphans.append(node)
-        log.info("After pruning, %i bad nodes are orphaned", bad)
+        log.info("After pruning, %i bad nodes are orphaned",
+                 len(inside) - np.count_nonzero(inside))
 
     log.info("Constructing KDtree for good nodes to adopt %i total orphans",
              len(orphans))
@@ -230,8 +170,6 @@ if __name__ == "__main__":
     all_nodes.sort(key=operator.attrgetter('clust'))
 
     log.info("Writing to %s", args.output)
-    with gzip.open(args.output, 'wb') as outputfd:
-        for node in all_nodes:
-            outputfd.write(' '.join(str(x) for x in [
-                node.id, node.lat, node.lon, node.clust, '\n'
-            ]))
+    topotools.write_clusters(args.output, all_nodes)
+
+    topotools.metrics.write(args.metrics)
@@ -7,16 +7,12 @@ Remove objects which lie outside the concave hulls.
 
 
 import argparse
-from concurrent import futures
-import itertools
-import gzip
 import logging
 import math
-import operator
 
 import geojson
-from shapely.geometry import Point, asShape
-from shapely.prepared import prep
+import numpy as np
+from shapely.geometry import asShape
 
 import topotools
 
@@ -35,7 +31,8 @@ if __name__ == "__main__":
         help='Gzipped output communities')
 
     parser.add_argument('--bbox', nargs=4, type=float, metavar='x',
-                        help='Only consider nodes within bbox')
+                        help='Only consider nodes within bbox, given in'
+                        ' degrees, not in OSRM integer units')
 
     parser.add_argument('--buffer', type=float, metavar='b', default=0.05,
                         help='Buffer value (in % of characteristic size)'
@@ -45,6 +42,12 @@ if __name__ == "__main__":
     parser.add_argument('--threads', type=int, metavar='N', default=2,
                         help='Number of threads. Default %(default)f')
 
+    parser.add_argument('--processes', default=False, action='store_true',
+                        help='Run the --threads workers as separate'
+                        ' processes, to use more than one core.')
+
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
@@ -60,64 +63,45 @@ if __name__ == "__main__":
 
     log.info("Loaded %i hulls", len(cluster_features))
 
-    # Get generator of clustered nodes
+    # Get the clustered nodes
     # We keep these in OSRM units for now.
-    clustered_node_iters = itertools.groupby(
-        topotools.read_clusters(args.input, args.bbox, scale=False),
-        operator.attrgetter('clust')
-    )
-
-    # Get the ID, the hull (if it exists), and the nodes for each cluster
-    clustered_nodes = (
-        (clust, cluster_features.get(clust), list(nodes))
-        for clust, nodes in clustered_node_iters
-    )
-
-    def associate_nodes(fargs):
-        """ Find nodes which are within the hull """
-        cluster, cluster_hull, nodes = fargs
+    nodes, _ = topotools.io.read_nodes(args.input, args.bbox)
+
+    def associate_nodes(cluster, nodes):
+        """ Find nodes which are within the hull
+
+        Returns the new cluster of each node.
+        """
+        cluster_hull = cluster_features.get(cluster)
+        new_clusters = np.array(nodes['clust'])
         # There is no hull for this community, it's been deleted.
         # Orphan all nodes.
         if cluster_hull is None:
             log.info("Missing hull, orphaning all nodes in cluster %i",
                      cluster)
-            output = [topotools.NodeInfo(
-                orphan.id, orphan.lat, orphan.lon, -1)
-                for orphan in nodes]
-            return len(output), output
+            new_clusters[:] = -1
+            return new_clusters
 
         characteristic_size = math.sqrt(cluster_hull.area)
         allowed_distance = characteristic_size * args.buffer
-        buffered = prep(cluster_hull.buffer(allowed_distance))
-
-        output = []
-        num_orphans = 0
-        for node in nodes:
-            # check if it is an interior node
-            point = Point((node.lon, node.lat))
-            orphan = not buffered.contains(point)
-            if orphan:
-                num_orphans += 1
-            output.append(topotools.NodeInfo(
-                node.id, node.lat, node.lon,
-                -1 if orphan else node.clust))
-        return num_orphans, output
-
-    log.info("Spawning %i worker threads", args.threads)
-    final_nodes = []
-    total_orphans = 0
-    with futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
-        for num_orphans, new_cluster in executor.map(
-                associate_nodes, clustered_nodes):
-            total_orphans += num_orphans
-            final_nodes.extend(new_cluster)
-    log.info("Orphaned %i nodes out of %i", total_orphans, len(final_nodes))
-
-    final_nodes.sort(key=operator.attrgetter('clust'))
+        buffered = cluster_hull.buffer(allowed_distance)
+
+        # check which are interior nodes
+        points = np.column_stack((nodes['lon'], nodes['lat']))
+        inside = topotools.points_in_polygon(points, buffered)
+        new_clusters[~inside] = -1
+        return new_clusters
+
+    new_clusters = topotools.map_clusters(
+        associate_nodes, nodes, args.threads, args.processes)
+    if new_clusters:
+        nodes['clust'] = np.concatenate(new_clusters)
+    log.info("Orphaned %i nodes out of %i",
+             np.count_nonzero(nodes['clust'] == -1), len(nodes))
+
+    final_nodes = nodes[np.argsort(nodes['clust'], kind='mergesort')]
 
     log.info("Writing to %s", args.output)
-    with gzip.open(args.output, 'wb') as outputfd:
-        for node in final_nodes:
-            outputfd.write(' '.join(str(x) for x in [
-                node.id, node.lat, node.lon, node.clust, '\n'
-            ]))
+    topotools.write_clusters(args.output, final_nodes)
+
+    topotools.metrics.write(args.metrics)
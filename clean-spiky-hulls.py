@@ -13,6 +13,8 @@ import logging
 import geojson
 from shapely.geometry import asShape
 
+import topotools
+
 log = logging.getLogger(__name__)
 
 if __name__ == "__main__":
@@ -27,6 +29,8 @@ if __name__ == "__main__":
     parser.add_argument('--convexity', type=float, metavar='x', default=0.5,
                         help='Minimum on the ratio of '
                         'the concave/convex area.  Default %(default)f')
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     log.info("Writing output to %s", args.output)
@@ -54,3 +58,5 @@ if __name__ == "__main__":
         log.info("Writing output to %s", args.output)
         geojson.dump(geojson.FeatureCollection(output_features),
                      outputfd, indent=2)
+
+    topotools.metrics.write(args.metrics)
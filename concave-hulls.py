@@ -8,10 +8,7 @@ as GeoJSON files.
 '''
 
 import argparse
-from concurrent import futures
-import itertools
 import logging
-import operator
 import topotools
 
 import geojson
@@ -30,7 +27,8 @@ if __name__ == "__main__":
         help='Output hulls')
 
     parser.add_argument('--bbox', nargs=4, type=float, metavar='x',
-                        help='Only consider nodes within bbox')
+                        help='Only consider nodes within bbox, given in'
+                        ' degrees, not in OSRM integer units')
 
     parser.add_argument('--alphacut', type=float, metavar='x', default=10,
                         help='Concave hull alpha cut. Default %(default)f')
@@ -38,6 +36,13 @@ if __name__ == "__main__":
     parser.add_argument('--threads', type=int, metavar='N', default=2,
                         help='Number of threads. Default %(default)f')
 
+    parser.add_argument('--processes', default=False, action='store_true',
+                        help='Run the --threads workers as separate'
+                        ' processes, to use more than one core.')
+
+    topotools.incremental.add_argument(parser)
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
@@ -46,21 +51,14 @@ if __name__ == "__main__":
 
     # Get generator of clustered nodes
     # We keep these in OSRM units for now.
-    clustered_node_iters = itertools.groupby(
-        topotools.read_clusters(args.input, args.bbox, scale=False),
-        operator.attrgetter('clust')
-    )
+    nodes, _ = topotools.io.read_nodes(args.input, args.bbox)
 
-    clustered_nodes = (
-        (clust, list(nodes)) for clust, nodes in clustered_node_iters)
-
-    def compute_hull(fargs):
+    def compute_hull(clustidx, nodes):
         '''Compute the convex hull for a set of nodes
 
         Returns a geojson object.
         '''
-        clustidx, nodes = fargs
-        points = np.array([(x.lon, x.lat) for x in nodes], dtype=int)
+        points = np.column_stack((nodes['lon'], nodes['lat']))
         try:
             hull = topotools.get_concave_hull(points, args.alphacut)
             feature = geojson.Feature(
@@ -76,9 +74,10 @@ if __name__ == "__main__":
             feature = None
         return feature
 
-    log.info("Spawning %i compute threads", args.threads)
-    with futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
-        features = list(executor.map(compute_hull, clustered_nodes))
+    cache = topotools.incremental.open_cache(
+        args.cluster_cache, __file__, args.alphacut)
+    features = topotools.cached_map_clusters(
+        compute_hull, nodes, cache, args.threads, args.processes)
 
     feature_collection = geojson.FeatureCollection(
         [feature for feature in features
@@ -86,3 +85,5 @@ if __name__ == "__main__":
 
     with open(args.output, 'w') as outputfd:
         geojson.dump(feature_collection, outputfd, indent=2)
+
+    topotools.metrics.write(args.metrics)
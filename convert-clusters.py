@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+'''
+
+Convert cluster files between the gzipped text and binary formats.
+
+The output format is chosen by the output file name; files ending in
+.clusters are binary, anything else is gzipped text.
+
+'''
+
+import argparse
+import logging
+
+import topotools
+
+log = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', metavar='communities.gz',
+                        help='Input communities, in either format')
+    parser.add_argument('output', metavar='communities.clusters',
+                        help='Output communities')
+
+    parser.add_argument('--bbox', nargs=4, type=float, metavar='x',
+                        help='Only consider nodes within bbox, given in'
+                        ' degrees, not in OSRM integer units')
+
+    topotools.metrics.add_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+
+    log.info("Reading %s", args.input)
+    nodes = topotools.io.read_clusters_as_recarray(args.input, args.bbox)
+    log.info("Writing %i nodes to %s", len(nodes), args.output)
+    topotools.write_clusters(args.output, nodes)
+
+    topotools.metrics.write(args.metrics)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+'''
+
+Cut a saved community dendrogram at one or more numbers of clusters
+-------------------------------------------------------------------
+
+Reads the dendrogram saved by find-communities.py (fastgreedy only), and
+writes a cluster file for each --clusters count, without finding the
+communities again.  The output name is formatted with the count, e.g.
+
+    cut-dendrogram.py communities.dendrogram.npz \\
+        'communities-%i.clusters' --clusters 500 1000 2000
+
+--matrix writes every cut as one membership matrix instead (or as
+well), in an .npz with the node ids, the counts, and one row of
+cluster numbers per count, in the node order of the ids.
+
+'''
+
+import argparse
+import logging
+
+import numpy as np
+
+import topotools
+from topotools.dendrogram import load_dendrogram, membership_matrix
+
+log = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', metavar='communities.dendrogram.npz',
+                        help='Dendrogram from find-communities.py')
+    parser.add_argument('output', nargs='?',
+                        metavar='communities-%i.clusters',
+                        help='Output cluster file name, with %%i for the'
+                        ' number of clusters')
+    parser.add_argument('--clusters', nargs='+', type=int, metavar='N',
+                        required=True, help='Numbers of clusters to cut at')
+    parser.add_argument('--matrix', metavar='memberships.npz',
+                        help='Write all cuts as a membership matrix')
+
+    topotools.metrics.add_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    topotools.dendrogram.log.setLevel(logging.INFO)
+
+    if not args.output and not args.matrix:
+        parser.error("Give an output file name, --matrix, or both")
+
+    log.info("Loading dendrogram from %s", args.input)
+    merges, nodes = load_dendrogram(args.input)
+    log.info("=> %i merges of %i nodes", len(merges), len(nodes))
+
+    with topotools.metrics.span('cut_dendrogram'):
+        matrix = membership_matrix(merges, len(nodes), args.clusters)
+
+    if args.matrix:
+        log.info("Writing membership matrix to %s", args.matrix)
+        with open(args.matrix, 'wb') as outputfd:
+            np.savez_compressed(outputfd, id=nodes['id'],
+                                clusters=np.array(args.clusters),
+                                membership=matrix)
+
+    if args.output:
+        for n_clusters, membership in zip(args.clusters, matrix):
+            output = args.output % n_clusters
+            log.info("Writing %i clusters to %s",
+                     membership.max() + 1, output)
+            topotools.write_clusters(
+                output, topotools.io.membership_to_recarray(
+                    nodes['id'], nodes['lat'], nodes['lon'], membership))
+
+    topotools.metrics.write(args.metrics)
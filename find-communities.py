@@ -4,7 +4,25 @@
 Find communities in an graph
 ----------------------------
 
-Uses the fast-greedy algorithm.
+Uses the fast-greedy algorithm by default.  --method chooses one of the
+faster algorithms instead: multilevel (Louvain), leiden or
+label_propagation.  The modularity and run time are logged, and written
+with --metrics.
+
+The fast-greedy dendrogram is saved next to the output, as
+communities.dendrogram.npz, so cut-dendrogram.py can cut it at other
+numbers of clusters without finding the communities again.  When the
+previous communities are kept, so is their dendrogram.
+
+When the road network is refreshed, --previous gives the communities
+found last time.  The clusters are then relabelled to keep the numbers
+of the previous clusters they overlap most, and leiden and
+label_propagation start from the previous membership.  With
+--previous-graph as well, the graphs are compared, and if nothing
+changed the previous communities are kept as they are, provided they
+were found with the same --method, --clusters, --resolution and
+--seed.  These are saved next to the output, as
+communities.params.json, for the next run to compare with.
 
 The output format is a gzipped string packed data.
 
@@ -12,27 +30,55 @@ Each line has the format:
 
     osrm_id lat lon cluster
 
+If the output file name ends in .clusters, the same fields are written
+in the binary format described in topotools/io.py instead.
+
 Author: Evan K. Friis
 
 '''
 
 import argparse
-import gzip
 import logging
+import os
+import random
+import shutil
+
+import numpy as np
 
-import igraph
+import topotools
 
 log = logging.getLogger(__name__)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('input', metavar='input.igraph.pkl.gz',
-                        help='Gzipped igraph cornichon.')
+                        help='Gzipped igraph cornichon, or a .graph file')
     parser.add_argument('output', metavar='communities.gz',
                         help='Output communities')
     parser.add_argument('--clusters', default=0,
                         type=int, help='Number of clusters to form.'
                         ' If not specified, use the # found by the algo')
+    parser.add_argument('--method', default='fastgreedy',
+                        choices=topotools.communities.METHODS,
+                        help='Community detection algorithm.'
+                        ' Default %(default)s')
+    parser.add_argument('--resolution', type=float, metavar='x', default=1.,
+                        help='Resolution for multilevel and leiden; higher'
+                        ' gives more, smaller, clusters.'
+                        '  Default %(default)g')
+    parser.add_argument('--seed', default=1, type=int, help='random seed')
+    parser.add_argument('--dendrogram', metavar='communities.dendrogram.npz',
+                        help='Where to save the fastgreedy dendrogram.'
+                        ' Default: next to the output')
+    parser.add_argument('--no-dendrogram', action='store_true',
+                        help="Don't save the fastgreedy dendrogram")
+    parser.add_argument('--previous', metavar='communities.clusters',
+                        help='Communities found on the previous graph')
+    parser.add_argument('--previous-graph', dest='previous_graph',
+                        metavar='road.graph',
+                        help='The previous graph, to compare with')
+
+    topotools.metrics.add_argument(parser)
 
     args = parser.parse_args()
 
@@ -40,27 +86,90 @@ if __name__ == "__main__":
     log.setLevel(logging.INFO)
 
     log.info("Loading graph from %s", args.input)
-    graph = igraph.read(args.input, format='picklez')
+    with topotools.metrics.span('load_graph'):
+        graph = topotools.graph.read_igraph(args.input)
     log.info("=> %i nodes, %i edges", len(graph.vs), len(graph.es))
 
-    log.info("Finding communities via fastgreedy")
-    communities = graph.community_fastgreedy(weights='weight')
-
-    log.info("Found an optimal count of %i communities",
-             communities.optimal_count)
-
-    n_clusters = args.clusters if args.clusters else communities.optimal_count
-
-    log.info("Partitioning dendrogram into %i clusters", n_clusters)
-    clusters = communities.as_clustering(n_clusters)
+    # igraph draws its random numbers from the random module
+    random.seed(args.seed)
+
+    # Pull out each vertex attribute once, as a whole column
+    ids, lat, lon = [np.array(graph.vs[attribute])
+                     for attribute in ('name', 'lat', 'lon')]
+
+    params = {'method': args.method, 'clusters': args.clusters,
+              'resolution': args.resolution, 'seed': args.seed}
+
+    previous = None
+    initial = None
+    unchanged = False
+    if args.previous:
+        log.info("Loading previous communities from %s", args.previous)
+        previous, _ = topotools.io.read_nodes(args.previous, None)
+        initial = topotools.incremental.seed_membership(
+            previous['id'], previous['clust'], ids)
+        if args.previous_graph:
+            old_ids, old_edges = topotools.graph.read_edges(
+                args.previous_graph)
+            diff = topotools.incremental.diff_graphs(
+                old_ids, old_edges, ids, np.array(graph.get_edgelist()))
+            for name, changes in zip(diff._fields, diff):
+                topotools.metrics.value(name, len(changes))
+            touched = topotools.incremental.lookup(
+                previous['id'], previous['clust'],
+                topotools.incremental.touched_nodes(diff))
+            log.info("The changes touch %i of %i previous communities",
+                     len(np.unique(touched[touched >= 0])),
+                     len(np.unique(previous['clust'])))
+            unchanged = topotools.incremental.is_unchanged(diff) and \
+                len(previous) == len(ids)
+            previous_params = topotools.incremental.read_params(
+                topotools.incremental.params_filename(args.previous))
+            if unchanged and previous_params != params:
+                log.info("The previous communities were found with %s,"
+                         " not %s", previous_params, params)
+                unchanged = False
+
+    info = {}
+    if unchanged:
+        log.info("The graph is unchanged, keeping the previous communities")
+        membership = topotools.incremental.lookup(
+            previous['id'], previous['clust'], ids)
+        info['clusters'] = len(np.unique(membership))
+        info['modularity'] = graph.modularity(membership.tolist(),
+                                              weights='weight')
+    else:
+        log.info("Finding communities via %s", args.method)
+        clusters, info = topotools.communities.find_communities(
+            graph, args.method, n_clusters=args.clusters,
+            resolution=args.resolution, initial=initial)
+        membership = np.array(clusters.membership)
+        if previous is not None:
+            membership = topotools.incremental.stable_relabel(
+                previous['id'], previous['clust'], ids, membership)
+    for name in ('clusters', 'modularity'):
+        topotools.metrics.value(name, info[name])
+
+    dendrogram = args.dendrogram or \
+        topotools.dendrogram.dendrogram_filename(args.output)
+    if 'merges' in info and not args.no_dendrogram:
+        topotools.dendrogram.save_dendrogram(
+            dendrogram, info['merges'], ids, lat, lon)
+    elif unchanged and not args.no_dendrogram:
+        # The previous dendrogram still holds, and names its nodes
+        previous_dendrogram = \
+            topotools.dendrogram.dendrogram_filename(args.previous)
+        if os.path.exists(previous_dendrogram):
+            log.info("Copying the previous dendrogram from %s",
+                     previous_dendrogram)
+            shutil.copyfile(previous_dendrogram, dendrogram)
 
     log.info("Mini-fying data")
+    nodes = topotools.io.membership_to_recarray(ids, lat, lon, membership)
+
     log.info("Writing to %s", args.output)
-    with gzip.open(args.output, 'wb') as outputfd:
-        for clust_idx, cluster in enumerate(clusters):
-            for vertex_idx in cluster:
-                vertex = graph.vs[vertex_idx]
-                outputfd.write(' '.join(str(x) for x in [
-                    vertex['name'], vertex['lat'],
-                    vertex['lon'], clust_idx, '\n'
-                ]))
+    topotools.write_clusters(args.output, nodes)
+    topotools.incremental.write_params(
+        topotools.incremental.params_filename(args.output), params)
+
+    topotools.metrics.write(args.metrics)
@@ -7,16 +7,12 @@ Keep only nodes on the edge of the communities.
 
 
 import argparse
-from concurrent import futures
-import itertools
-import gzip
 import logging
 import math
-import operator
-import random
 
 import geojson
-from shapely.geometry import Point, asShape
+import numpy as np
+from shapely.geometry import asShape
 
 import topotools
 
@@ -35,7 +31,8 @@ if __name__ == "__main__":
         help='Gzipped output communities')
 
     parser.add_argument('--bbox', nargs=4, type=float, metavar='x',
-                        help='Only consider nodes within bbox')
+                        help='Only consider nodes within bbox, given in'
+                        ' degrees, not in OSRM integer units')
 
     parser.add_argument('--within', type=float, metavar='b', default=0.1,
                         help='Buffer value (in % of characteristic size)'
@@ -46,9 +43,18 @@ if __name__ == "__main__":
                         help='Keep a random sampling of interior nodes. '
                         ' Default %(default)f')
 
+    parser.add_argument('--seed', default=1, type=int, help='random seed')
+
     parser.add_argument('--threads', type=int, metavar='N', default=2,
                         help='Number of threads. Default %(default)f')
 
+    parser.add_argument('--processes', default=False, action='store_true',
+                        help='Run the --threads workers as separate'
+                        ' processes, to use more than one core.')
+
+    topotools.incremental.add_argument(parser)
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
@@ -64,60 +70,57 @@ if __name__ == "__main__":
 
     log.info("Loaded %i hulls", len(cluster_features))
 
-    # Get generator of clustered nodes
+    # Get the clustered nodes
     # We keep these in OSRM units for now.
-    clustered_node_iters = itertools.groupby(
-        topotools.read_clusters(args.input, args.bbox, scale=False),
-        operator.attrgetter('clust')
-    )
-
-    # Get the ID, the hull (if it exists), and the nodes for each cluster
-    clustered_nodes = (
-        (clust, cluster_features.get(clust), list(nodes))
-        for clust, nodes in clustered_node_iters
-    )
-
-    def find_edge_nodes(fargs):
-        """ Find nodes are near the edge of the hull"""
-        cluster, cluster_hull, nodes = fargs
+    nodes, _ = topotools.io.read_nodes(args.input, args.bbox)
+
+    def find_edge_nodes(cluster, nodes):
+        """ Find nodes are near the edge of the hull
+
+        Returns a mask of the nodes to keep.
+        """
+        cluster_hull = cluster_features.get(cluster)
         # There is no hull for this community, it's been deleted.
         if cluster_hull is None:
             log.error("Missing hull, keeping all nodes in cluster %i",
                       cluster)
-            return len(nodes), nodes
+            return np.ones(len(nodes), dtype=bool)
 
         characteristic_size = math.sqrt(cluster_hull.area)
         allowed_distance = characteristic_size * args.within
-        boundary = cluster_hull.boundary
-
-        output = []
-        for node in nodes:
-            # check if it is an interior node
-            point = Point((node.lon, node.lat))
-            keep = False
-            if random.random() < args.keep:
-                keep = True
-            elif point.distance(boundary) < allowed_distance:
-                keep = True
-            if keep:
-                output.append(node)
-        return len(nodes), output
-
-    log.info("Spawning %i worker threads", args.threads)
-    final_nodes = []
-    total_nodes = 0
-    with futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
-        for processed_nodes, edge_nodes in executor.map(
-                find_edge_nodes, clustered_nodes):
-            total_nodes += processed_nodes
-            final_nodes.extend(edge_nodes)
-    log.info("Kept %i edge nodes out of %i", len(final_nodes), total_nodes)
-
-    final_nodes.sort(key=operator.attrgetter('clust'))
+
+        # Keep a random sampling of interior nodes.  Each cluster has
+        # its own seeded stream, so the sample does not depend on how
+        # clusters are spread over the workers.
+        random_state = np.random.RandomState(
+            [args.seed, cluster % (1 << 32)])
+        keep = random_state.random_sample(len(nodes)) < args.keep
+
+        points = np.column_stack((nodes['lon'], nodes['lat']))
+        distances = topotools.distance_to_boundary(
+            points, cluster_hull, allowed_distance)
+        keep |= distances < allowed_distance
+        return keep
+
+    def cluster_hull(cluster):
+        """The hull a cluster's edge nodes depend on, for the cache"""
+        hull = cluster_features.get(cluster)
+        return hull.wkb if hull is not None else b''
+
+    cache = topotools.incremental.open_cache(
+        args.cluster_cache, __file__, args.within, args.keep, args.seed)
+    masks = topotools.cached_map_clusters(
+        find_edge_nodes, nodes, cache, args.threads, args.processes,
+        extra=cluster_hull)
+    edge_indices = np.flatnonzero(np.concatenate(masks)) if masks else \
+        np.zeros(0, dtype=int)
+    final_nodes = nodes[edge_indices]
+    log.info("Kept %i edge nodes out of %i", len(final_nodes), len(nodes))
+
+    final_nodes = final_nodes[
+        np.argsort(final_nodes['clust'], kind='mergesort')]
 
     log.info("Writing to %s", args.output)
-    with gzip.open(args.output, 'wb') as outputfd:
-        for node in final_nodes:
-            outputfd.write(' '.join(str(x) for x in [
-                node.id, node.lat, node.lon, node.clust, '\n'
-            ]))
+    topotools.write_clusters(args.output, final_nodes)
+
+    topotools.metrics.write(args.metrics)
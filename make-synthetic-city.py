@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''
+
+Make a synthetic city, for testing and benchmarking without OSM data.
+
+Writes the road network as output/road.graph, in the CSR graph format
+written by osrm2igraph.py, so the workflow can start from
+find-communities.py.
+The true neighborhood of each node can also be written as a cluster
+file, to start the workflow further down.
+
+The same --nodes and --seed always give the same city.
+
+'''
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+import topotools
+from topotools.synthetic import network_nodes, road_network
+
+log = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', metavar='city',
+                        help='Output directory')
+
+    parser.add_argument('--nodes', type=int, metavar='N', default=100000,
+                        help='Approximate number of nodes.'
+                        ' Default %(default)i')
+
+    parser.add_argument('--towns', type=int, metavar='N',
+                        help='Number of towns.  Default: one per 20k'
+                        ' nodes, squared')
+
+    parser.add_argument('--seed', default=1, type=int, help='random seed')
+
+    parser.add_argument('--clusters', metavar='communities.clusters',
+                        help='Also write the neighborhood of each node'
+                        ' to this cluster file, in the output directory')
+
+    topotools.metrics.add_argument(parser)
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    topotools.synthetic.log.setLevel(logging.INFO)
+    topotools.graph.log.setLevel(logging.INFO)
+
+    network = road_network(args.nodes, seed=args.seed, n_towns=args.towns)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    graph_file = os.path.join(args.output, 'road.graph')
+    topotools.write_graph(
+        graph_file, np.arange(1, len(network.lat) + 1), network.lat,
+        network.lon, network.edges, network.weights)
+
+    if args.clusters:
+        cluster_file = os.path.join(args.output, args.clusters)
+        log.info("Writing neighborhoods to %s", cluster_file)
+        topotools.write_clusters(cluster_file, network_nodes(network))
+
+    topotools.metrics.write(args.metrics)
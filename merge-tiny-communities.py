@@ -1,22 +1,24 @@
 #!/usr/bin/env python
 '''
 
-Orphan objects in spiky communities
-whose concave hull area is much less than convex one.
+Merge communities whose area is much smaller than the median
+into the neighbor they share the longest border with.
+
+Communities which are still too small after a merge are merged again,
+and small communities with no neighbors are kept in the output.
 
 '''
 
 
 import argparse
-import bisect
-from collections import deque
 import logging
 
 import geojson
 import numpy as np
 from shapely.geometry import asShape
 from scipy.stats.mstats import mquantiles
-from shapely.prepared import prep
+
+import topotools
 
 log = logging.getLogger(__name__)
 
@@ -33,6 +35,8 @@ if __name__ == "__main__":
                         default=0.5, dest='fraction',
                         help='Merge the F smallest area concave objects.'
                         ' Default %(default)f')
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
@@ -42,8 +46,8 @@ if __name__ == "__main__":
     with open(args.input, 'r') as inputfd:
         input_features = geojson.load(inputfd)
 
-    features = []
-    clusters = {}
+    shapes = []
+    cluster_ids = []
     for feature in input_features['features']:
         if feature['geometry'] is None:
             log.error("Geometry is null! Skipping: %s", repr(feature))
@@ -53,56 +57,31 @@ if __name__ == "__main__":
                 raise ValueError("Don't know what to do!")
             else:
                 continue
-        shape = asShape(feature['geometry'])
-        area = shape.area
-        cluster_id = feature['properties']['clust']
-        clusters[cluster_id] = shape
-        features.append((area, cluster_id))
-
-    # Sort by ascending area, get fast pop access on left
-    features = deque(sorted(features))
+        shapes.append(asShape(feature['geometry']))
+        cluster_ids.append(feature['properties']['clust'])
 
-    areas = np.array([x[0] for x in features])
+    areas = np.array([shape.area for shape in shapes])
 
     q50 = mquantiles(areas, prob=[0.5])[0]
 
     log.info("Area of 50%% quantile: %f", q50)
 
-    num_shapes_to_merge = bisect.bisect_left(areas, q50 * args.fraction)
+    log.info("Found %i/%i communities to merge",
+             np.count_nonzero(areas < q50 * args.fraction), len(areas))
 
-    log.info("Found %i/%i communities to merge", num_shapes_to_merge,
-             len(areas))
-
-    while num_shapes_to_merge:
-        num_shapes_to_merge -= 1
-        _, cluster = features.popleft()
-        shape = clusters[cluster]
-        # Prep for faster compuations
-        intersecting = []
-        for i, (_, other_clust_id) in enumerate(features):
-            if other_clust_id == cluster:
-                continue
-            other_shape = clusters[other_clust_id]
-            intersection = shape.intersection(other_shape)
-            if intersection:
-                intersecting.append((intersection.length,
-                                     other_clust_id, other_shape))
-        if not intersecting:
-            log.error("Couldn't find any neighbors for %i", cluster)
-        else:
-            # Merge this into the neighbor shape with the largest
-            # shared border.
-            maxlength, other_clust_id, other_shape = max(intersecting)
-            clusters[other_clust_id] = other_shape.union(shape)
-            log.info("Merged %i -> %i", cluster, other_clust_id)
+    merged_shapes, merges = topotools.merge_small_shapes(
+        shapes, q50 * args.fraction)
+    for idx, into in merges:
+        log.info("Merged %i -> %i", cluster_ids[idx], cluster_ids[into])
 
     output_features = []
-    for _, clustidx in features:
+    # Write in order of ascending area
+    for idx in sorted(merged_shapes, key=lambda x: merged_shapes[x].area):
         feature = geojson.Feature(
-            id=clustidx,
-            geometry=clusters[clustidx],
+            id=cluster_ids[idx],
+            geometry=merged_shapes[idx],
             properties={
-                'clust': clustidx
+                'clust': cluster_ids[idx]
             }
         )
         output_features.append(feature)
@@ -111,3 +90,5 @@ if __name__ == "__main__":
         log.info("Writing output to %s", args.output)
         geojson.dump(geojson.FeatureCollection(output_features),
                      outputfd, indent=2)
+
+    topotools.metrics.write(args.metrics)
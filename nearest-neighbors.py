@@ -11,7 +11,6 @@ orphans and reasigned.
 """
 
 import argparse
-import gzip
 import logging
 
 import numpy as np
@@ -33,13 +32,38 @@ if __name__ == "__main__":
                         help='k neigherest neighbors for the association')
 
     parser.add_argument('--bbox', nargs=4, type=float, metavar='x',
-                        help='Only consider nodes within bbox')
+                        help='Only consider nodes within bbox, given in'
+                        ' degrees, not in OSRM integer units')
 
     parser.add_argument('--only-orphans', default=False, action='store_true',
                         dest='only_orphans',
                         help='If specified, only reassign orphans.')
 
+    parser.add_argument('--iterate', default=False, action='store_true',
+                        help='Repeat the smoothing until the clusters'
+                        ' converge.  Not with --only-orphans.')
+
+    parser.add_argument('--max-rounds', type=int, metavar='N', default=10,
+                        dest='max_rounds',
+                        help='Maximum number of smoothing rounds with'
+                        ' --iterate.  Default %(default)i')
+
+    parser.add_argument('--min-change', type=float, metavar='x',
+                        default=1e-4, dest='min_change',
+                        help='With --iterate, stop once at most this fraction'
+                        ' of nodes change cluster in a round.'
+                        '  Default %(default)g')
+
+    parser.add_argument('--threads', type=int, metavar='N', default=2,
+                        help='Number of KD-tree query workers.'
+                        ' Default %(default)i')
+
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
+    if args.iterate and args.only_orphans:
+        parser.error("--iterate smooths all nodes, it can't be used with"
+                     " --only-orphans")
 
     logging.basicConfig()
     log.setLevel(logging.INFO)
@@ -75,21 +99,34 @@ if __name__ == "__main__":
     log.info("Constructing KD-tree")
     tree = KDTree(good_points)
 
-    if not args.only_orphans:
+    if not args.only_orphans and args.iterate:
+        log.info("Smoothing all nodes, for up to %i rounds", args.max_rounds)
+        new_clusters, rounds = topotools.neighbors.smooth_clusters(
+            good_points, tree, current_clusters, args.k,
+            max_rounds=args.max_rounds, min_change=args.min_change,
+            workers=args.threads)
+        log.info("Stopped smoothing after %i rounds", rounds)
+
+        changed = new_clusters != current_clusters
+        good_nodes.clust = new_clusters
+        log.info("Changed %i clusters", np.count_nonzero(changed))
+    elif not args.only_orphans:
         log.info("Reassigning all nodes...")
         new_clusters = topotools.reassign_clusters(
-            good_points, tree, current_clusters, args.k)
+            good_points, tree, current_clusters, args.k,
+            workers=args.threads)
 
         log.info("Upating cluster membership")
         changed = new_clusters != current_clusters
-        nodes.clust = new_clusters
+        good_nodes.clust = new_clusters
         log.info("Changed %i clusters", np.count_nonzero(changed))
 
     log.info("Reassigning orphans")
     orphan_points = orphans[['lon', 'lat']].view('<i8').reshape(
         (orphans.size, 2))
     new_orphan_clusters = topotools.reassign_clusters(
-        orphan_points, tree, current_clusters, args.k)
+        orphan_points, tree, current_clusters, args.k,
+        workers=args.threads)
     orphans.clust = new_orphan_clusters
 
     log.info("Done adopting orphans")
@@ -97,9 +134,6 @@ if __name__ == "__main__":
     sorted_indices = np.argsort(nodes.clust)
 
     log.info("Writing to %s", args.output)
-    with gzip.open(args.output, 'wb') as outputfd:
-        for id, lat, lon, clust in nodes[sorted_indices][
-                ['id', 'lat', 'lon', 'clust']]:
-            outputfd.write(' '.join(str(x) for x in [
-                id, lat, lon, clust, '\n'
-            ]))
+    topotools.write_clusters(args.output, nodes[sorted_indices])
+
+    topotools.metrics.write(args.metrics)
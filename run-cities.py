@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''
+
+Run the community identification workflow for many cities at once.
+
+The stages of all the cities are scheduled together, on one budget of
+--jobs threads, so one city's short stages fill in around another's
+long ones.  Every stage is counted by the threads it uses: the
+parallel stages run --threads workers (at most --jobs), and the others
+one thread, with their numerical libraries capped to match.  The
+longest stages (building the graph and finding the communities) start
+first whenever they are ready.  A city whose stage fails is dropped,
+and the others carry on.
+
+A per-city timing summary is logged, and written as JSON with
+--summary.
+
+'''
+
+import argparse
+import json
+import logging
+import os
+
+from topotools.pipeline import Pipeline, prefix_stages
+from topotools.workflow import city_stages, set_params
+
+log = logging.getLogger(__name__)
+
+
+def city_prefix(city):
+    """The prefix of a city's stage names
+
+    Stage names are paths within the cache, so the prefix is the city's
+    path relative to the working directory, or its absolute path without
+    the leading slash if it is outside it.
+    """
+    path = os.path.relpath(city)
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        path = os.path.abspath(city).lstrip(os.sep)
+    return path + '/'
+
+
+def summarize(pipeline, cities, timings):
+    """Per-city stage timings, total stage time and wall time"""
+    summary = {}
+    for city in cities:
+        prefix = city_prefix(city)
+        stages = {}
+        spans = []
+        for name in pipeline.order():
+            if not name.startswith(prefix):
+                continue
+            stage = name[len(prefix):]
+            if name in pipeline.failed:
+                stages[stage] = 'failed'
+            elif name in timings:
+                stages[stage] = timings[name] if timings[name] is not None \
+                    else 'cached'
+            if name in pipeline.spans:
+                spans.append(pipeline.spans[name])
+        run_times = [x for x in stages.values() if isinstance(x, float)]
+        summary[city] = {
+            'stages': stages,
+            'total': sum(run_times),
+            'wall': (max(end for _, end in spans) -
+                     min(start for start, _ in spans)) if spans else 0.,
+            'failed': sorted(stage for stage, x in stages.items()
+                             if x == 'failed'),
+        }
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cities', nargs='+', metavar='city',
+                        help='City directories, each containing osrm')
+
+    parser.add_argument('--jobs', '-j', type=int, metavar='N', default=8,
+                        help='Number of threads to use at once, over all'
+                        ' cities.  Default %(default)i')
+
+    parser.add_argument('--threads', type=int, metavar='N', default=4,
+                        help='Threads used by each parallel stage.'
+                        ' Default %(default)i')
+
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='dir',
+                        default='.pipeline-cache',
+                        help='Where stage outputs are kept.'
+                        ' Default %(default)s')
+
+    parser.add_argument('--param', dest='params', action='append',
+                        default=[], metavar='stage.name=value',
+                        help='Change a stage parameter, for every city')
+
+    parser.add_argument('--memory', type=int, metavar='MB',
+                        help='Limit the memory of every stage')
+
+    parser.add_argument('--timeout', type=float, metavar='s',
+                        help='Limit the run time of every stage')
+
+    parser.add_argument('--summary', metavar='timings.json',
+                        help='Write the per-city timings here')
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    logging.getLogger('topotools.pipeline').setLevel(logging.INFO)
+
+    # A stage can't take up more than the whole budget
+    threads = min(args.threads, args.jobs)
+    if threads < args.threads:
+        log.warning("Using %i threads per stage, the number of --jobs",
+                    threads)
+
+    cities = [city.rstrip('/') for city in args.cities]
+    stages = []
+    for city in cities:
+        city_stage_list = city_stages(city, threads)
+        set_params(city_stage_list, args.params)
+        stages.extend(prefix_stages(city_stage_list, city_prefix(city),
+                                    link_dir=city))
+    for stage in stages:
+        if args.memory is not None:
+            stage.memory = args.memory
+        if args.timeout is not None:
+            stage.timeout = args.timeout
+
+    pipeline = Pipeline(stages, '.', args.cache_dir)
+    timings = pipeline.run(jobs=args.jobs, keep_going=True)
+
+    summary = summarize(pipeline, cities, timings)
+    for city in cities:
+        log.info("%-20s %8.1fs wall, %8.1fs in stages%s", city,
+                 summary[city]['wall'], summary[city]['total'],
+                 ', FAILED' if summary[city]['failed'] else '')
+
+    if args.summary:
+        log.info("Writing timings to %s", args.summary)
+        with open(args.summary, 'w') as outputfd:
+            json.dump(summary, outputfd, indent=2, sort_keys=True)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+
+Run the community identification workflow for a city.
+
+The same chain of scripts as the Makefile, but each stage's outputs are
+cached under a hash of its script, parameters and inputs, so changing
+a parameter only reruns the stages downstream of it.  The outputs are
+linked into the city directory under their usual names.
+
+Parameters can be changed with --param stage.name=value, for example
+
+    ./run-pipeline.py los-angeles --param smooth-hulls.convexity=0.5
+
+On a refresh of the OSM data, --previous and --cluster-cache keep the
+community labels stable, and only recompute the hulls, edge nodes and
+Voronoi pruning of the clusters whose nodes changed.
+
+'''
+
+import argparse
+import logging
+
+from topotools.pipeline import Pipeline
+from topotools.workflow import city_stages, set_params
+
+log = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('city', help='City directory, containing osrm')
+    parser.add_argument('targets', nargs='*', metavar='stage',
+                        help='Stages to run.  Default: all of them')
+
+    parser.add_argument('--jobs', '-j', type=int, metavar='N', default=4,
+                        help='Number of threads to use at once.'
+                        ' Default %(default)i')
+
+    parser.add_argument('--threads', type=int, metavar='N', default=4,
+                        help='Threads used by each parallel stage.'
+                        ' Default %(default)i')
+
+    parser.add_argument('--cache-dir', dest='cache_dir', metavar='dir',
+                        default='.pipeline-cache',
+                        help='Where stage outputs are kept.'
+                        ' Default %(default)s')
+
+    parser.add_argument('--param', dest='params', action='append',
+                        default=[], metavar='stage.name=value',
+                        help='Change a stage parameter')
+
+    parser.add_argument('--memory', type=int, metavar='MB',
+                        help='Limit the memory of every stage')
+
+    parser.add_argument('--timeout', type=float, metavar='s',
+                        help='Limit the run time of every stage')
+
+    parser.add_argument('--previous', metavar='dir',
+                        help='Outputs of the last run (road.graph and'
+                        ' communities.clusters), to keep the communities'
+                        ' consistent with on a refresh')
+
+    parser.add_argument('--cluster-cache', dest='cluster_cache',
+                        metavar='dir',
+                        help='Keep per-cluster results in dir, and reuse'
+                        ' them for clusters which did not change')
+
+    parser.add_argument('--list', default=False, action='store_true',
+                        help='List the stages and their parameters,'
+                        ' and exit')
+
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    logging.getLogger('topotools.pipeline').setLevel(logging.INFO)
+
+    stages = city_stages(args.city, args.threads, previous=args.previous,
+                         cluster_cache=args.cluster_cache)
+    set_params(stages, args.params)
+    for stage in stages:
+        if args.memory is not None:
+            stage.memory = args.memory
+        if args.timeout is not None:
+            stage.timeout = args.timeout
+
+    if args.list:
+        for stage in stages:
+            print stage.name, ' '.join(
+                '%s=%s' % item for item in sorted(stage.params.items()))
+    else:
+        pipeline = Pipeline(stages, '.', args.cache_dir, link_dir=args.city)
+        timings = pipeline.run(args.targets or None, jobs=args.jobs)
+        for name in pipeline.order():
+            if name in timings:
+                if timings[name] is None:
+                    log.info("%-20s cached", name)
+                else:
+                    log.info("%-20s %8.1fs", name, timings[name])
@@ -4,31 +4,56 @@
 
 Find the voronoi diagram of a set of points.
 
+With --tile-size, the map is split into tiles (see topotools/tiles.py),
+and each tile prunes the clusters it owns and finds their Voronoi cells
+on its own, with the nodes in a --halo around them for context.  Tiles
+whose halo turns out narrower than their edge cells, such as at the
+shore of a big lake, are redone with a wider one.  The tiles run in
+parallel with --threads and --processes, so big extracts never need a
+Voronoi diagram of everything at once.  Each tile reads only its own
+nodes from a binary .clusters input, and the pruned nodes are kept on
+disk between the passes, so the memory used depends on the tile size
+and not on the size of the extract.
+
+With --cluster-cache, the pruning of each cluster is reused if its
+nodes are unchanged, and with --tile-size so are the polygons of each
+tile, if the pruned nodes within its halo are.
+
 Author: Evan K. Friis
 
 '''
 
 import argparse
+import atexit
 import itertools
 import geojson
 import logging
 import operator
+import os
 import random
+import shutil
+import tempfile
 
 import numpy as np
 from scipy.spatial import Voronoi
 
 from descartes import PolygonPatch
-from shapely.geometry import MultiPolygon, MultiLineString, Polygon
+from shapely.geometry import MultiPolygon, Polygon
 #from shapely.geometry import mapping
-from shapely.ops import cascaded_union, polygonize
-from shapely.validation import explain_validity
+from matplotlib.collections import PolyCollection
 import matplotlib.pyplot as plt
 
 import topotools
 
 log = logging.getLogger(__name__)
 
+# How many times a tile's halo is doubled, before giving up
+HALO_RETRIES = 3
+
+# The pruned nodes of a tile, as kept on disk for the tiles around it
+PRUNED_DTYPE = np.dtype(
+    [('lon', np.float64), ('lat', np.float64), ('clust', np.int64)])
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -53,39 +78,213 @@ if __name__ == "__main__":
                         help='List of .shp files to '
                         'AND the output shapes with')
 
+    parser.add_argument('--mask-cache', dest='mask_cache', metavar='dir',
+                        help='Cache the AND-ed shapes for this bounding'
+                        ' box in dir, and reuse them on later runs')
+
     parser.add_argument('--seed', default=1, type=int, help='random seed')
 
+    parser.add_argument('--tile-size', dest='tile_size', type=float,
+                        metavar='deg',
+                        help='Work on square tiles of this size, rather'
+                        ' than on everything at once')
+
+    parser.add_argument('--halo', type=float, metavar='deg', default=0.05,
+                        help='Margin of neighboring nodes around each'
+                        ' tile.  It has to be wider than the Voronoi'
+                        ' cells at the edge of the tile; tiles where it'
+                        ' is not are redone with a wider one.'
+                        '  Default %(default)g')
+
+    parser.add_argument('--threads', type=int, metavar='N', default=1,
+                        help='Number of tiles to work on at once.'
+                        ' Default %(default)i')
+
+    parser.add_argument('--processes', default=False, action='store_true',
+                        help='Run the --threads workers as separate'
+                        ' processes, to use more than one core.')
+
+    topotools.incremental.add_argument(parser)
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
     log.setLevel(logging.INFO)
 
-    random.seed(args.seed)
+    cache = topotools.incremental.open_cache(
+        args.cluster_cache, __file__, args.bbox, args.seed)
 
-    clustered_nodes = itertools.groupby(
-        topotools.read_clusters(args.input, args.bbox),
-        operator.attrgetter('clust')
-    )
-
-    pruned_nodes = []
-
-    for clustidx, nodes in clustered_nodes:
-        log.info("Pruning interior of cluster %i", clustidx)
+    def prune_cluster(clustidx, nodes):
+        """Prune the interior of a cluster, or get it from the cache"""
         draw = None
         if args.drawprune and clustidx in args.drawprune:
             draw = 'prune_%i.png' % clustidx
-        pruned = topotools.voronoi_prune_region(nodes, 25, draw=draw)
-        pruned_nodes.extend(pruned)
+        key = None
+        if cache is not None and draw is None:
+            key = cache.key(clustidx, np.array(nodes, dtype=float))
+            found, pruned = cache.get(key)
+            if found:
+                return pruned
+        log.info("Pruning interior of cluster %i", clustidx)
+        # Each cluster has its own seeded random state, so the pruning does
+        # not depend on which other clusters were pruned or cached, nor on
+        # which thread prunes it.
+        random_state = random.Random(
+            args.seed * (1 << 32) + clustidx % (1 << 32))
+        with topotools.metrics.span('voronoi_prune_region', clustidx):
+            pruned = topotools.voronoi_prune_region(
+                nodes, 25, draw=draw, random_state=random_state)
+        if key is not None:
+            cache.put(key, pruned)
+        return pruned
+
+    def cell_rings(voronoi, clusters, owned=None):
+        """The rings of the finite Voronoi cells, to draw
+
+        Only the cells of points in the owned clusters are kept, if they
+        are given.
+        """
+        if not args.draw:
+            return []
+        cell_points, offsets, rings = \
+            topotools.voronoi.voronoi_cells(voronoi)
+        keep = [True] * len(cell_points)
+        if owned is not None:
+            owned = set(owned)
+            keep = [clustidx in owned for clustidx in clusters[cell_points]]
+        return [rings[start:stop] for start, stop, kept
+                in zip(offsets[:-1], offsets[1:], keep) if kept]
+
+    if args.tile_size:
+        # The nodes are read a tile at a time from the memory-mapped
+        # columns of a binary file, so the memory used doesn't grow with
+        # the extract.
+        nodes, scale = topotools.io.read_nodes(args.input, None)
+        if not isinstance(nodes, topotools.io.NodeColumns):
+            log.warning("%s is in the text format, which is read whole;"
+                        " write it as %s to read it a tile at a time",
+                        args.input, topotools.io.BINARY_EXTENSION)
+
+        def select(part, bounds=None):
+            """The nodes of part within the --bbox, and the bounds
+
+            Returns them, and their lon and lat in degrees.
+            """
+            lon = part['lon'] / scale
+            lat = part['lat'] / scale
+            mask = np.ones(len(part), dtype=bool)
+            if args.bbox:
+                mask &= topotools.io.bbox_mask(lat, lon, args.bbox)
+            if bounds is not None:
+                mask &= topotools.tiles.within(lon, lat, bounds)
+            return part[mask], lon[mask], lat[mask]
+
+        # Where the nodes of each cluster are, and the sums and extents
+        # of their coordinates
+        runs = {}
+        summaries = []
+        position = 0
+        for clustidx, part in topotools.io.cluster_slices(nodes):
+            start, position = position, position + len(part)
+            _, lon, lat = select(part)
+            if not len(lon):
+                continue
+            runs.setdefault(clustidx, []).append((start, position))
+            summaries.append((clustidx, lon.sum(), lat.sum(), len(lon),
+                              lon.min(), lat.min(), lon.max(), lat.max()))
+        if not summaries:
+            raise ValueError("There are no nodes in %s" % args.input)
+        summaries = np.array(summaries, dtype=float)
+        order = np.argsort(summaries[:, 0], kind='mergesort')
+        summaries = summaries[order]
+        clusters, first = np.unique(summaries[:, 0], return_index=True)
+        sums = np.add.reduceat(summaries[:, 1:4], first)
+        extents = np.concatenate(
+            [np.minimum.reduceat(summaries[:, 4:6], first),
+             np.maximum.reduceat(summaries[:, 6:8], first)], axis=1).T
+        tiling = topotools.tiles.Tiling(
+            extents[[0, 2]].ravel(), extents[[1, 3]].ravel(),
+            args.tile_size, args.halo)
+        tiles = tiling.cluster_tiles(
+            clusters.astype(np.int64), (sums[:, :2] / sums[:, 2:]).T,
+            extents)
+        del summaries, sums, extents
+
+        def cluster_nodes(clustidx):
+            """The nodes of a cluster, within the --bbox, as NodeInfo"""
+            found = []
+            for start, stop in runs[clustidx]:
+                part, lon, lat = select(nodes[start:stop])
+                found.extend(topotools.NodeInfo(*fields) for fields in zip(
+                    part['id'].tolist(), lat.tolist(), lon.tolist(),
+                    part['clust'].tolist()))
+            return found
+
+        # The pruned nodes of each tile are kept on disk, for the tiles
+        # around it to read the ones in their halo
+        work_dir = tempfile.mkdtemp(prefix='tesselate-')
+        atexit.register(shutil.rmtree, work_dir, True)
+
+        def pruned_filename(tile):
+            return os.path.join(work_dir, 'pruned_%i.npy' % tile.index)
+
+        def prune_tile(tile):
+            """Prune the clusters a tile owns, and save the pruned nodes
+
+            Returns how many there are, and their extent.
+            """
+            pruned = []
+            for clustidx in tile.clusters:
+                pruned.extend(
+                    prune_cluster(clustidx, cluster_nodes(clustidx)))
+            if not pruned:
+                return 0, None
+            pruned = np.array([(x.lon, x.lat, x.clust) for x in pruned],
+                              dtype=PRUNED_DTYPE)
+            np.save(pruned_filename(tile), pruned)
+            return len(pruned), (
+                pruned['lon'].min(), pruned['lat'].min(),
+                pruned['lon'].max(), pruned['lat'].max())
+
+        pruned_tiles = []
+        pruned_extents = []
+        pruned_count = 0
+        for tile, (count, extent) in zip(tiles, topotools.parallel.map_tasks(
+                prune_tile, tiles, args.threads, args.processes)):
+            if count:
+                pruned_tiles.append(tile)
+                pruned_extents.append(extent)
+            pruned_count += count
+
+        log.info("Generating tiled Voronoi from %i pruned nodes",
+                 pruned_count)
+
+        min_lon, min_lat = np.min(pruned_extents, axis=0)[:2]
+        max_lon, max_lat = np.max(pruned_extents, axis=0)[2:]
+    else:
+        clustered_nodes = itertools.groupby(
+            topotools.read_clusters(args.input, args.bbox),
+            operator.attrgetter('clust')
+        )
 
-    pruned_nodes.sort(key=operator.attrgetter('clust'))
+        pruned_nodes = []
+        for clustidx, nodes in clustered_nodes:
+            pruned_nodes.extend(prune_cluster(clustidx, list(nodes)))
 
-    log.info("Generating full Voronoi from %i pruned nodes",
-             len(pruned_nodes))
+        pruned_nodes.sort(key=operator.attrgetter('clust'))
 
-    max_lat = max([x.lat for x in pruned_nodes])
-    min_lat = min([x.lat for x in pruned_nodes])
-    max_lon = max([x.lon for x in pruned_nodes])
-    min_lon = min([x.lon for x in pruned_nodes])
+        log.info("Generating full Voronoi from %i pruned nodes",
+                 len(pruned_nodes))
+
+        max_lat = max([x.lat for x in pruned_nodes])
+        min_lat = min([x.lat for x in pruned_nodes])
+        max_lon = max([x.lon for x in pruned_nodes])
+        min_lon = min([x.lon for x in pruned_nodes])
+
+        points = np.array([(x.lon, x.lat) for x in pruned_nodes],
+                          dtype=float)
+        clusters = np.array([x.clust for x in pruned_nodes], dtype=int)
 
     bounding_box = Polygon(
         [(min_lon, min_lat), (max_lon, min_lat),
@@ -93,72 +292,112 @@ if __name__ == "__main__":
          (min_lon, min_lat)])
 
     # Find any relevant shapes in our AND shapefile
-    bounding_polygon = None
-    feature_count = 0
-    for shp_file in args.and_shapes:
-        log.info("Loading features from %s", shp_file)
-        polys_in_shp_file = []
-        for feature in topotools.shp_to_multipolygon(
-                shp_file, overlapping=bounding_box):
-            if not isinstance(feature, MultiPolygon):
-                feature = [feature]
-            for poly in feature:
-                if bounding_box.intersects(poly):
-                    feature_count += 1
-                    interesting_part = poly.intersection(bounding_box)
-                    polys_in_shp_file.append(interesting_part)
-        shp_file_megapoly = cascaded_union(polys_in_shp_file)
-        if bounding_polygon is None:
-            bounding_polygon = shp_file_megapoly
-        else:
-            bounding_polygon = bounding_polygon.intersection(
-                shp_file_megapoly)
-    log.info("Found %i overlapping features", feature_count)
-
-    voronoi = Voronoi(np.array(
-        [(x.lon, x.lat) for x in pruned_nodes], dtype=float))
+    bounding_polygon = topotools.io.load_clip_mask(
+        args.and_shapes, bounding_box, cache_dir=args.mask_cache)
 
     log.info("Joining polygons")
 
     output_polygons = []
-
-    # Loop over collections of node indices
-    for clusteridx, node_iter in itertools.groupby(
-            enumerate(pruned_nodes), lambda x: x[1].clust):
-
-        # keep track of all paths in this cluster's
-        # voronoi regions.
-        cluster_polygons = []
-
-        for node_idx, node in node_iter:
-            #print clusteridx, node_idx, node.clust
-            # Get the voronoi region of this point
-            voronoi_region = voronoi.point_region[node_idx]
-            vertices_idxs = voronoi.regions[voronoi_region]
-            # ignore infinite cells
-            if -1 in vertices_idxs:
-                continue
-            # add lines between all interior points
-            points = [(tuple(voronoi.vertices[a]), tuple(voronoi.vertices[b]))
-                      for a, b in itertools.combinations(vertices_idxs, 2)]
-            ring = MultiLineString(points)
-            polygons = list(polygonize([ring]))
-            if not polygons:
-                log.warning("No polygons detected in line, skipping")
-                continue
-            else:
-                if not polygons[0].is_valid:
-                    log.warning("Invalid polygon! %s",
-                                explain_validity(polygons[0]))
-                    polygons[0] = polygons[0].buffer(0)
-                    log.warning("After cleaning validity = %i",
-                                polygons[0].is_valid)
-                cluster_polygons.append(polygons[0])
-
-        log.info("Merging %i cluster polygons", len(cluster_polygons))
-        polygon = cascaded_union(cluster_polygons)
-        #import pdb
-        #pdb.set_trace()
+    cells = []
+
+    if args.tile_size:
+
+        def pruned_within(bounds):
+            """The pruned nodes within bounds, from the tiles they're in"""
+            found = [np.empty(0, dtype=PRUNED_DTYPE)]
+            for tile in pruned_tiles:
+                if topotools.tiles.overlaps(tile.bounds, bounds):
+                    pruned = np.load(pruned_filename(tile), mmap_mode='r')
+                    found.append(pruned[topotools.tiles.within(
+                        pruned['lon'], pruned['lat'], bounds)])
+            return np.concatenate(found)
+
+        def points_within(bounds):
+            pruned = pruned_within(bounds)
+            return np.column_stack([pruned['lon'], pruned['lat']])
+
+        def halo_polygons(tile, pruned, points, halo):
+            """The polygons and cells of the clusters a tile owns
+
+            They are made from the pruned nodes within its halo, or taken
+            from the cache, if those are unchanged.  Either way, the
+            caller checks that the halo was wide enough.
+            """
+            key = None
+            if cache is not None:
+                key = cache.key(tile.index, pruned, repr(
+                    ('tile', halo, tile.clusters, bounding_box.bounds,
+                     bool(args.draw))).encode('utf-8'))
+                found, result = cache.get(key)
+                if found:
+                    return result
+            voronoi = Voronoi(points)
+            with topotools.metrics.span('cluster_polygons', tile.index):
+                polygons = topotools.voronoi.cluster_polygons(
+                    voronoi, pruned['clust'], bounding_box)
+            result = (dict((clustidx, polygons[clustidx])
+                           for clustidx in tile.clusters
+                           if clustidx in polygons),
+                      cell_rings(voronoi, pruned['clust'], tile.clusters))
+            if key is not None:
+                cache.put(key, result)
+            return result
+
+        def tile_polygons(tile):
+            """The polygons of the clusters a tile owns
+
+            If the halo is too narrow for them to come out the same as
+            from all of the nodes, or holds too few nodes for a Voronoi
+            diagram, the tile is redone with a halo twice as wide.
+            """
+            halo = args.halo
+            for attempt in range(HALO_RETRIES + 1):
+                bounds = topotools.tiles.grow(tile.bounds, halo)
+                pruned = pruned_within(bounds)
+                log.info("Tile %i has %i clusters, and %i pruned nodes"
+                         " with its halo", tile.index, len(tile.clusters),
+                         len(pruned))
+                if len(pruned) < 4:
+                    # Qhull needs at least 4 points
+                    everything = (bounds[0] <= min_lon and
+                                  bounds[1] <= min_lat and
+                                  bounds[2] >= max_lon and
+                                  bounds[3] >= max_lat)
+                    if everything or attempt == HALO_RETRIES:
+                        log.warning("Skipping tile %i, with only %i"
+                                    " pruned nodes", tile.index,
+                                    len(pruned))
+                        return {}, []
+                    log.warning("The %g halo of tile %i has too few"
+                                " nodes, doubling it", halo, tile.index)
+                else:
+                    points = np.column_stack(
+                        [pruned['lon'], pruned['lat']])
+                    owned, rings = halo_polygons(tile, pruned, points, halo)
+                    if topotools.tiles.exact_cells(
+                            owned.values(), points, bounds, points_within):
+                        return owned, rings
+                    log.warning("The %g halo of tile %i is too narrow,"
+                                " doubling it", halo, tile.index)
+                topotools.metrics.count('tiles.halo_retries')
+                halo *= 2
+            raise ValueError("Tile %i needs a halo wider than %g, give a"
+                             " wider --halo" % (tile.index, halo / 2))
+
+        polygons = {}
+        for owned, rings in topotools.parallel.map_tasks(
+                tile_polygons, pruned_tiles, args.threads, args.processes):
+            polygons.update(owned)
+            cells.extend(rings)
+    else:
+        voronoi = Voronoi(points)
+        with topotools.metrics.span('cluster_polygons'):
+            polygons = topotools.voronoi.cluster_polygons(
+                voronoi, clusters, bounding_box)
+        cells = cell_rings(voronoi, clusters)
+
+    for clusteridx in sorted(polygons):
+        polygon = polygons[clusteridx]
         log.info("Created polygon for cluster %i with area %0.2f",
                  clusteridx, polygon.area)
 
@@ -198,6 +437,9 @@ if __name__ == "__main__":
                 xy = np.array([(x.lon, x.lat) for x in node_iter], dtype=float)
                 plt.plot(xy[:, 0], xy[:, 1], 'x',
                          color=color_for_clust, hold=1)
+        # The Voronoi cells of the pruned nodes, under the clusters
+        plt.gca().add_collection(PolyCollection(
+            cells, facecolors='none', edgecolors='gray', linewidths=0.2))
         for polygon in output_polygons:
             if not polygon:
                 continue
@@ -223,3 +465,5 @@ if __name__ == "__main__":
 
     with open(args.output, 'w') as outputfd:
         geojson.dump(feature_collection, outputfd, indent=2)
+
+    topotools.metrics.write(args.metrics)
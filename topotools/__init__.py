@@ -1,4 +1,13 @@
 from voronoi import voronoi_prune_region
 from hulls import get_concave_hull, get_convex_hull
-from io import shp_to_multipolygon, read_clusters, NodeInfo
+from tails import trim_tails
+from polygons import points_in_polygon, distance_to_boundary
+from io import shp_to_multipolygon, read_clusters, write_clusters, NodeInfo
 from neighbors import reassign_clusters, reassign_clusters_threaded
+from parallel import map_clusters
+from merge import merge_small_shapes
+from communities import find_communities
+from dendrogram import cut_dendrogram, membership_matrix
+from graph import read_igraph, write_graph
+from incremental import ClusterCache, cached_map_clusters
+from tiles import Tiling
@@ -0,0 +1,149 @@
+'''
+
+Community detection on the road graph, with a choice of algorithm
+
+fastgreedy builds a full dendrogram, which is slow and memory hungry
+on big graphs, but can be cut at any number of clusters, now or later
+(see topotools.dendrogram).  multilevel
+(Louvain), leiden and label_propagation scale much better.
+
+'''
+
+import logging
+import time
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+METHODS = ['fastgreedy', 'multilevel', 'leiden', 'label_propagation']
+
+# Steps of the search for a resolution which gives a target count
+RESOLUTION_STEPS = 12
+
+
+def _leiden(graph, weights, resolution, initial=None):
+    return graph.community_leiden(
+        objective_function='modularity', weights=weights,
+        resolution_parameter=resolution, n_iterations=-1,
+        initial_membership=initial)
+
+
+def _multilevel(graph, weights, resolution, return_levels=False):
+    kwargs = {'weights': weights, 'return_levels': return_levels}
+    # Older igraphs don't take a resolution, and use 1.
+    if resolution != 1:
+        kwargs['resolution'] = resolution
+    return graph.community_multilevel(**kwargs)
+
+
+def _closest(clusterings, n_clusters):
+    """The clustering with the number of clusters nearest to n_clusters"""
+    return min(clusterings, key=lambda x: abs(len(x) - n_clusters))
+
+
+def _search_resolution(detect, n_clusters, resolution):
+    """Find the resolution which gives about n_clusters clusters
+
+    The number of clusters grows with the resolution, so the resolution
+    is first scaled by factors of two to bracket the target, and then
+    bisected, in log space.
+    """
+    tried = {}
+
+    def count(value):
+        if value not in tried:
+            tried[value] = detect(value)
+            log.info("Resolution %g gives %i clusters",
+                     value, len(tried[value]))
+        return len(tried[value])
+
+    low = high = resolution
+    for _ in range(RESOLUTION_STEPS):
+        if count(low) <= n_clusters:
+            break
+        low /= 2.
+    for _ in range(RESOLUTION_STEPS):
+        if count(high) >= n_clusters:
+            break
+        high *= 2.
+    for _ in range(RESOLUTION_STEPS):
+        if count(low) == n_clusters or count(high) == n_clusters:
+            break
+        middle = (low * high) ** 0.5
+        if count(middle) < n_clusters:
+            low = middle
+        else:
+            high = middle
+    return _closest(tried.values(), n_clusters)
+
+
+def find_communities(graph, method='fastgreedy', n_clusters=0,
+                     resolution=1., weights='weight', initial=None):
+    """Find communities in a graph
+
+    If n_clusters is given, fastgreedy cuts its dendrogram there,
+    multilevel picks the level closest to it, and leiden searches for
+    the resolution which gives it.  label_propagation can't be steered,
+    and ignores it.  resolution is used by multilevel and leiden.
+
+    leiden and label_propagation can start from an initial membership,
+    such as the previous clustering of a slightly changed graph
+    (see topotools.incremental.seed_membership).
+
+    Returns the VertexClustering, and a dict with the method, the
+    number of clusters, the modularity and the run time.  For
+    fastgreedy, the dict also has the merges of the dendrogram.
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown community method %s" % method)
+    start = time.time()
+    merges = None
+    if initial is not None:
+        if method in ('leiden', 'label_propagation'):
+            initial = [int(x) for x in initial]
+        else:
+            log.warning("%s can't start from a previous membership",
+                        method)
+
+    if method == 'fastgreedy':
+        dendrogram = graph.community_fastgreedy(weights=weights)
+        log.info("Found an optimal count of %i communities",
+                 dendrogram.optimal_count)
+        clustering = dendrogram.as_clustering(
+            n_clusters or dendrogram.optimal_count)
+        merges = dendrogram.merges
+    elif method == 'multilevel':
+        if n_clusters:
+            clustering = _closest(_multilevel(
+                graph, weights, resolution, return_levels=True), n_clusters)
+        else:
+            clustering = _multilevel(graph, weights, resolution)
+    elif method == 'leiden':
+        if n_clusters:
+            clustering = _search_resolution(
+                lambda value: _leiden(graph, weights, value, initial),
+                n_clusters, resolution)
+        else:
+            clustering = _leiden(graph, weights, resolution, initial)
+    else:
+        if n_clusters:
+            log.warning("label_propagation can't aim for %i clusters",
+                        n_clusters)
+        clustering = graph.community_label_propagation(
+            weights=weights, initial=initial)
+
+    elapsed = time.time() - start
+    info = {
+        'method': method,
+        'clusters': len(clustering),
+        'modularity': graph.modularity(clustering.membership,
+                                       weights=weights),
+        'seconds': elapsed,
+    }
+    if merges is not None:
+        info['merges'] = merges
+    metrics.record('find_communities', elapsed, method)
+    log.info("%s found %i communities with modularity %0.4f in %0.1fs",
+             method, info['clusters'], info['modularity'], elapsed)
+    return clustering, info
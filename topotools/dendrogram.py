@@ -0,0 +1,141 @@
+'''
+
+Save community dendrograms, and cut them at any number of clusters
+
+A dendrogram is stored as its merges, as igraph gives them: merge i
+joins the two clusters (or vertices) in row i into a new cluster
+numbered n_vertices + i.  The node ids and coordinates are stored with
+it, so cluster files can be written from a cut without the graph.
+
+'''
+
+import logging
+
+import numpy as np
+
+from .io import NODE_DTYPE
+
+log = logging.getLogger(__name__)
+
+
+def dendrogram_filename(communities_file):
+    """Where to keep the dendrogram next to a communities file"""
+    root = communities_file
+    for extension in ('.gz', '.clusters'):
+        if root.endswith(extension):
+            root = root[:-len(extension)]
+    return root + '.dendrogram.npz'
+
+
+def save_dendrogram(filename, merges, ids, lat, lon):
+    """Save the merges of a dendrogram, and the nodes it clusters"""
+    n_vertices = len(ids)
+    dtype = np.int32 if 2 * n_vertices < np.iinfo(np.int32).max \
+        else np.int64
+    merges = np.asarray(merges, dtype=dtype).reshape((-1, 2))
+    log.info("Saving %i merges of %i vertices to %s",
+             len(merges), n_vertices, filename)
+    # np.savez adds .npz to names without it, so write to an open file
+    with open(filename, 'wb') as outputfd:
+        np.savez_compressed(outputfd, merges=merges,
+                            id=np.asarray(ids, dtype=np.int64),
+                            lat=np.asarray(lat, dtype=np.int32),
+                            lon=np.asarray(lon, dtype=np.int32))
+
+
+def load_dendrogram(filename):
+    """Load a dendrogram saved by save_dendrogram
+
+    Returns the merges, and the nodes as a structured array, in vertex
+    order, with no clusters.
+    """
+    with np.load(filename) as data:
+        merges = data['merges']
+        nodes = np.empty(len(data['id']), dtype=NODE_DTYPE)
+        nodes['id'] = data['id']
+        nodes['lat'] = data['lat']
+        nodes['lon'] = data['lon']
+        nodes['clust'] = -1
+    return merges, nodes
+
+
+def leaf_order(merges, n_vertices):
+    """Lay out the vertices so that every cluster is a contiguous run
+
+    Returns the size of every cluster (vertices first, then merges),
+    the position of the first vertex of each in the layout, and the
+    parent of each (-1 for the clusters never merged).
+    """
+    n_nodes = n_vertices + len(merges)
+    parent = np.empty(n_nodes, dtype=np.int64)
+    parent.fill(-1)
+    parent[merges[:, 0]] = np.arange(n_vertices, n_nodes)
+    parent[merges[:, 1]] = np.arange(n_vertices, n_nodes)
+
+    size = np.ones(n_nodes, dtype=np.int64)
+    size_list = size.tolist()
+    for merge, (a, b) in enumerate(merges.tolist()):
+        size_list[n_vertices + merge] = size_list[a] + size_list[b]
+    size = np.array(size_list, dtype=np.int64)
+
+    # The roots are laid out one after the other, and each cluster
+    # splits its run between its two parts, top down.
+    roots = np.flatnonzero(parent == -1)
+    first = np.zeros(n_nodes, dtype=np.int64)
+    first[roots] = np.cumsum(size[roots]) - size[roots]
+    first_list = first.tolist()
+    for merge in range(len(merges) - 1, -1, -1):
+        a, b = merges[merge].tolist()
+        start = first_list[n_vertices + merge]
+        first_list[a] = start
+        first_list[b] = start + size_list[a]
+    first = np.array(first_list, dtype=np.int64)
+    return size, first, parent
+
+
+def _renumber(membership):
+    """Number clusters in the order of their first vertex"""
+    n_clusters = membership.max() + 1
+    first = np.empty(n_clusters, dtype=np.int64)
+    first.fill(len(membership))
+    np.minimum.at(first, membership, np.arange(len(membership)))
+    rank = np.empty(n_clusters, dtype=membership.dtype)
+    rank[np.argsort(first)] = np.arange(n_clusters)
+    return rank[membership]
+
+
+def membership_matrix(merges, n_vertices, counts):
+    """Cut a dendrogram at each of several numbers of clusters
+
+    The dendrogram is laid out once, after which each cut only needs to
+    find its clusters, and label their runs of vertices.  Counts below
+    the number of clusters left after the last merge give that many.
+
+    Returns an array with one row of cluster memberships per count.
+    Clusters are numbered in the order of their first vertex.
+    """
+    merges = np.asarray(merges, dtype=np.int64).reshape((-1, 2))
+    size, first, parent = leaf_order(merges, n_vertices)
+    vertex_first = first[:n_vertices]
+
+    matrix = np.empty((len(counts), n_vertices), dtype=np.int32)
+    for row, n_clusters in enumerate(counts):
+        n_merges = min(max(n_vertices - n_clusters, 0), len(merges))
+        n_nodes = n_vertices + n_merges
+        # A cluster exists after n_merges merges if it was made by then,
+        # and has not been merged into another yet.
+        exists = parent[:n_nodes]
+        clusters = np.flatnonzero((exists == -1) | (exists >= n_nodes))
+        clusters = clusters[np.argsort(first[clusters])]
+        by_position = np.repeat(np.arange(len(clusters)), size[clusters])
+        matrix[row] = _renumber(by_position[vertex_first])
+        log.info("Cut into %i clusters", len(clusters))
+    return matrix
+
+
+def cut_dendrogram(merges, n_vertices, n_clusters):
+    """Cut a dendrogram into n_clusters clusters
+
+    Returns the cluster membership of each vertex.
+    """
+    return membership_matrix(merges, n_vertices, [n_clusters])[0]
@@ -0,0 +1,165 @@
+'''
+
+Road graphs stored as memory-mappable compressed sparse rows
+
+A faster alternative to gzipped igraph pickles, which have to be
+unpickled vertex by vertex before any work can start.  The adjacency
+can be read without igraph, and loaded into igraph in one call.  The
+layout is:
+
+  header     GRAPH_HEADER_DTYPE
+  offsets    int64[n_vertices + 1]  start of each vertex's neighbors
+  id         int64[n_vertices]      OSRM node ids
+  weights    float64[2 * n_edges]   weight of the edge to each neighbor
+  targets    int32[2 * n_edges]     neighbors, ascending per vertex
+  lat        int32[n_vertices]      in 1 / scale degrees
+  lon        int32[n_vertices]      in 1 / scale degrees
+
+The graph is undirected, so each edge is stored under both of its
+vertices, and the neighbors of vertex i are the slice
+offsets[i]:offsets[i + 1] of targets and weights.  Graphs are expected
+to be free of loops, as osrm2igraph.py makes them.
+
+'''
+
+from collections import namedtuple
+import logging
+
+import numpy as np
+
+from .io import COORDINATE_SCALE
+
+log = logging.getLogger(__name__)
+
+GRAPH_EXTENSION = '.graph'
+GRAPH_MAGIC = b'TOPOGRPH'
+GRAPH_VERSION = 1
+GRAPH_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('reserved', '<u4'),
+    ('scale', '<f8'),
+    ('n_vertices', '<i8'),
+    ('n_edges', '<i8'),
+])
+
+GraphArrays = namedtuple(
+    'GraphArrays', ['offsets', 'targets', 'weights', 'id', 'lat', 'lon',
+                    'scale'])
+
+
+def is_graph_file(filename):
+    """Check if a file is in the CSR graph format"""
+    with open(filename, 'rb') as fd:
+        return fd.read(len(GRAPH_MAGIC)) == GRAPH_MAGIC
+
+
+def write_graph(filename, ids, lat, lon, edges, weights,
+                scale=COORDINATE_SCALE):
+    """Write a graph, given as (E, 2) vertex pairs, in the CSR format"""
+    n_vertices = len(ids)
+    edges = np.asarray(edges, dtype=np.int64).reshape((-1, 2))
+    weights = np.asarray(weights, dtype=np.float64)
+    rows = np.concatenate((edges[:, 0], edges[:, 1]))
+    targets = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.lexsort((targets, rows))
+    offsets = np.zeros(n_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_vertices), out=offsets[1:])
+
+    header = np.zeros(1, dtype=GRAPH_HEADER_DTYPE)
+    header['magic'] = GRAPH_MAGIC
+    header['version'] = GRAPH_VERSION
+    header['scale'] = scale
+    header['n_vertices'] = n_vertices
+    header['n_edges'] = len(edges)
+
+    log.info("Writing %i vertices and %i edges to %s",
+             n_vertices, len(edges), filename)
+    with open(filename, 'wb') as outputfd:
+        header.tofile(outputfd)
+        offsets.astype('<i8').tofile(outputfd)
+        np.asarray(ids).astype('<i8').tofile(outputfd)
+        np.concatenate((weights, weights))[order].astype(
+            '<f8').tofile(outputfd)
+        targets[order].astype('<i4').tofile(outputfd)
+        np.asarray(lat).astype('<i4').tofile(outputfd)
+        np.asarray(lon).astype('<i4').tofile(outputfd)
+
+
+def open_graph(filename):
+    """Memory-map the arrays of a CSR graph file
+
+    Returns a GraphArrays tuple of read-only arrays, which are views into
+    the file.
+    """
+    raw = np.memmap(filename, dtype=np.uint8, mode='r')
+    header = raw[:GRAPH_HEADER_DTYPE.itemsize].view(GRAPH_HEADER_DTYPE)[0]
+    if header['magic'] != GRAPH_MAGIC:
+        raise ValueError("%s is not a graph file" % filename)
+    if header['version'] != GRAPH_VERSION:
+        raise ValueError("%s has unknown version %i" %
+                         (filename, header['version']))
+
+    n_vertices = int(header['n_vertices'])
+    n_entries = 2 * int(header['n_edges'])
+    columns = []
+    position = GRAPH_HEADER_DTYPE.itemsize
+    for dtype, size in [('<i8', n_vertices + 1), ('<i8', n_vertices),
+                        ('<f8', n_entries), ('<i4', n_entries),
+                        ('<i4', n_vertices), ('<i4', n_vertices)]:
+        nbytes = np.dtype(dtype).itemsize * size
+        columns.append(raw[position:position + nbytes].view(dtype))
+        position += nbytes
+    offsets, ids, weights, targets, lats, lons = columns
+    return GraphArrays(offsets, targets, weights, ids, lats, lons,
+                       float(header['scale']))
+
+
+def graph_edges(arrays):
+    """The (E, 2) vertex pairs and weights of each edge, once each"""
+    sources = np.repeat(np.arange(len(arrays.offsets) - 1),
+                        np.diff(arrays.offsets))
+    once = sources < arrays.targets
+    edges = np.column_stack((sources[once], arrays.targets[once]))
+    return edges, np.asarray(arrays.weights[once])
+
+
+def load_igraph(filename):
+    """Load a CSR graph file as an igraph Graph
+
+    The vertices get the name, lat and lon attributes, and the edges a
+    weight, as in the igraph pickles written by osrm2igraph.py.
+    """
+    import igraph
+
+    arrays = open_graph(filename)
+    edges, weights = graph_edges(arrays)
+    log.info("Loaded %i vertices and %i edges from %s",
+             len(arrays.id), len(edges), filename)
+    return igraph.Graph(
+        n=len(arrays.id), edges=edges.tolist(),
+        vertex_attrs={'name': arrays.id.tolist(),
+                      'lat': arrays.lat.tolist(),
+                      'lon': arrays.lon.tolist()},
+        edge_attrs={'weight': weights.tolist()})
+
+
+def read_igraph(filename):
+    """Load a graph file in either the CSR or the igraph picklez format"""
+    if is_graph_file(filename):
+        return load_igraph(filename)
+    import igraph
+    return igraph.read(filename, format='picklez')
+
+
+def read_edges(filename):
+    """The node ids and (E, 2) edge vertex pairs of a graph file
+
+    Works with both the CSR and the igraph picklez format.
+    """
+    if is_graph_file(filename):
+        arrays = open_graph(filename)
+        return np.asarray(arrays.id), graph_edges(arrays)[0]
+    graph = read_igraph(filename)
+    return (np.array(graph.vs['name']),
+            np.array(graph.get_edgelist(), dtype=np.int64).reshape((-1, 2)))
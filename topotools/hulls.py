@@ -6,100 +6,187 @@ Author: Evan K. Friis
 
 """
 
-from collections import Counter
 import logging
-import math
 
 import numpy as np
 from scipy.spatial import Delaunay, ConvexHull
-from shapely.geometry import MultiLineString, MultiPolygon
-from shapely.ops import cascaded_union, polygonize
+from shapely.geometry import Polygon
+from shapely.ops import polygonize
 import shapely.speedups
 shapely.speedups.enable()
 
+from . import metrics
+
 log = logging.getLogger(__name__)
 
 
-def get_concave_hull(points, cut):
-    """ Find the concave hull for a set of points
+def _alpha_filter(points, simplices, size, cut):
+    """Mask of the triangles which survive the alpha cut
+
+    The circumradius of every triangle is computed at once, using
+    the side lengths and Heron's formula for the area.  Degenerate
+    triangles (with no area) are never kept.
     """
-    max_x, max_y = np.max(points, axis=0)
-    min_x, min_y = np.min(points, axis=0)
-    log.info("Found %i nodes, bounded in x by (%i, %i)"
-             " and y by (%i, %i)",
-             len(points), min_x, max_x, min_y, max_y)
-    size = max(max_x - min_x, max_y - min_y)
-    tri = Delaunay(points)
-    log.info("Found %i Delaunay triangles", len(tri.vertices))
+    points = np.asarray(points, dtype=float)
+    pa = points[simplices[:, 0]]
+    pb = points[simplices[:, 1]]
+    pc = points[simplices[:, 2]]
 
-    edges = Counter()
+    # Lengths of sides of triangles
+    a = np.sqrt((pa[:, 0] - pb[:, 0])**2 + (pa[:, 1] - pb[:, 1])**2)
+    b = np.sqrt((pb[:, 0] - pc[:, 0])**2 + (pb[:, 1] - pc[:, 1])**2)
+    c = np.sqrt((pc[:, 0] - pa[:, 0])**2 + (pc[:, 1] - pa[:, 1])**2)
 
-    def add_edge(i, j):
-        """Count the occurences of each edge. """
-        edges[(i, j) if i > j else (j, i)] += 1
-    # loop over triangles:
-    # ia, ib, ic = indices of corner points of the triangle
-    for ia, ib, ic in tri.vertices:
+    # Semiperimeter of triangles
+    s = (a + b + c) / 2.0
+    argument = s * (s - a) * (s - b) * (s - c)
+    keep = argument > 0
 
-        pa = points[ia]
-        pb = points[ib]
-        pc = points[ic]
+    # Area of triangles by Heron's formula
+    area = np.sqrt(argument[keep])
+    circum_r = a[keep] * b[keep] * c[keep] / (4.0 * area)
 
-        # Lengths of sides of triangle
-        a = math.sqrt((pa[0]-pb[0])**2 + (pa[1]-pb[1])**2)
-        b = math.sqrt((pb[0]-pc[0])**2 + (pb[1]-pc[1])**2)
-        c = math.sqrt((pc[0]-pa[0])**2 + (pc[1]-pa[1])**2)
+    # Here's the radius filter.
+    keep[keep] = circum_r / size < 1.0 / cut
+    return keep
 
-        # Semiperimeter of triangle
-        s = (a + b + c)/2.0
 
-        argument = s*(s-a)*(s-b)*(s-c)
-        if argument < 0:
-            continue
+def _exterior_edges(points, simplices):
+    """Find the directed edges which are owned by only one triangle
 
-        # Area of triangle by Heron's formula
-        area = math.sqrt(argument)
+    The triangles are first oriented counter-clockwise, so the region
+    they cover always lies to the left of the returned edges.
 
-        if area <= 0:
+    Returns the exterior edges as an (N, 2) array of vertex indices,
+    and the total number of unique edges.
+    """
+    points = np.asarray(points, dtype=float)
+    simplices = np.array(simplices, dtype=np.int64)
+    pa = points[simplices[:, 0]]
+    pb = points[simplices[:, 1]]
+    pc = points[simplices[:, 2]]
+    cross = ((pb[:, 0] - pa[:, 0]) * (pc[:, 1] - pa[:, 1]) -
+             (pb[:, 1] - pa[:, 1]) * (pc[:, 0] - pa[:, 0]))
+    clockwise = cross < 0
+    simplices[clockwise] = simplices[clockwise][:, [0, 2, 1]]
+
+    edges = np.concatenate(
+        [simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]])
+    high = edges.max(axis=1)
+    low = edges.min(axis=1)
+    # Pack each edge into a single integer key so they can be counted
+    # by sorting.
+    stride = high.max() + 1 if len(high) else 1
+    keys, first, counts = np.unique(
+        high * stride + low, return_index=True, return_counts=True)
+    return edges[first[counts == 1]], len(keys)
+
+
+def shoelace_area(coords):
+    """Signed area of a ring, positive if it is counter-clockwise"""
+    x = coords[:, 0]
+    y = coords[:, 1]
+    return 0.5 * (np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def boundary_rings(points, edges):
+    """Walk directed boundary edges into closed rings
+
+    The edges must have the covered region on their left, as returned
+    by _exterior_edges.  Outer rings then come out counter-clockwise
+    and inner rings clockwise.  Where several rings pinch together at
+    one vertex, the walk keeps hugging the uncovered side, taking the
+    outgoing edge with the largest clockwise turn from the incoming
+    one.  Any loop the walk closes on itself is split off, so each ring
+    stays simple, and outer rings enclose everything they surround.
+
+    Returns a list of (ring, area) tuples, where ring is an array of
+    vertex indices and area is its signed shoelace area.
+    """
+    points = np.asarray(points, dtype=float)
+    order = np.argsort(edges[:, 0], kind='mergesort')
+    starts = edges[order, 0]
+    # The outgoing edges of each edge's end vertex
+    first = np.searchsorted(starts, edges[:, 1], side='left')
+    last = np.searchsorted(starts, edges[:, 1], side='right')
+    next_edge = order[np.minimum(first, len(order) - 1)]
+
+    for edge in np.nonzero(last - first > 1)[0]:
+        candidates = order[first[edge]:last[edge]]
+        vertex = points[edges[edge, 1]]
+        back = points[edges[edge, 0]] - vertex
+        out = points[edges[candidates, 1]] - vertex
+        turn = np.mod(np.arctan2(back[1], back[0]) -
+                      np.arctan2(out[:, 1], out[:, 0]), 2 * np.pi)
+        next_edge[edge] = candidates[np.argmax(turn)]
+
+    next_edge = next_edge.tolist()
+    vertices = edges[:, 0].tolist()
+    visited = [False] * len(edges)
+    rings = []
+
+    def add_ring(ring):
+        ring = np.array(ring, dtype=edges.dtype)
+        rings.append((ring, shoelace_area(points[ring])))
+
+    for start in range(len(edges)):
+        if visited[start]:
             continue
+        path = []
+        position = {}
+        edge = start
+        while not visited[edge]:
+            visited[edge] = True
+            vertex = vertices[edge]
+            if vertex in position:
+                # The walk came back to a vertex it already passed,
+                # pinching off a loop.  Split it off as its own ring.
+                loop_start = position[vertex]
+                for looped in path[loop_start:]:
+                    del position[looped]
+                add_ring(path[loop_start:])
+                del path[loop_start:]
+            position[vertex] = len(path)
+            path.append(vertex)
+            edge = next_edge[edge]
+        add_ring(path)
+    return rings
 
-        circum_r = a*b*c/(4.0*area)
 
-        # Here's the radius filter.
-        if circum_r / size < 1.0 / cut:
-            add_edge(ia, ib)
-            add_edge(ib, ic)
-            add_edge(ic, ia)
+def get_concave_hull(points, cut):
+    """ Find the concave hull for a set of points
+    """
+    max_x, max_y = np.max(points, axis=0)
+    min_x, min_y = np.min(points, axis=0)
+    log.info("Found %i nodes, bounded in x by (%i, %i)"
+             " and y by (%i, %i)",
+             len(points), min_x, max_x, min_y, max_y)
+    size = max(max_x - min_x, max_y - min_y)
+    tri = Delaunay(points)
+    log.info("Found %i Delaunay triangles", len(tri.vertices))
+    metrics.count('hull.nodes', len(points))
+    metrics.count('hull.triangles', len(tri.vertices))
 
-    log.info("After filter, %i edges remain", len(edges))
-    if not edges:
+    keep = _alpha_filter(points, tri.vertices, size, cut)
+    exterior_edges, n_edges = _exterior_edges(points, tri.vertices[keep])
+
+    log.info("After filter, %i edges remain", n_edges)
+    if not n_edges:
         log.warning("No edges remain, concave hull is not defined!")
         return None
 
-    # Exterior edges are only owned by one triangle.
-    exterior_edges = [
-        points[list(edge)] for edge, count
-        in edges.iteritems() if count == 1]
-
-    m = MultiLineString(exterior_edges)
-    log.info("Polygonizing")
-    triangles = list(polygonize(m))
-    log.info("Unionizing")
-    polygon = cascaded_union(triangles)
-
-    best_polygon = polygon
-    best_area = polygon.area
+    log.info("Walking %i exterior edges", len(exterior_edges))
+    rings = boundary_rings(points, exterior_edges)
 
-    if isinstance(polygon, MultiPolygon):
-        best_area = 0
+    # Inner rings are clockwise.  The main polygon is the largest outer
+    # ring, with any holes in it filled.
+    outer_rings = [(area, ring) for ring, area in rings if area > 0]
+    if len(outer_rings) > 1:
         log.info("Multi polygons detected")
-        for ip, subpoly in enumerate(polygon):
-            #log.info("Poly %i - area: %f", ip, subpoly.area)
-            if subpoly.area > best_area:
-                best_polygon = subpoly
-                best_area = subpoly.area
+    best_area, best_ring = max(outer_rings, key=lambda x: x[0])
     log.info("Found main polygon with area: %f", best_area)
-    return best_polygon
+    metrics.count('hull.outline_vertices', len(best_ring))
+    return Polygon(points[best_ring])
 
 
 def get_convex_hull(points):
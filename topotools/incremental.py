@@ -0,0 +1,274 @@
+'''
+
+Incremental updates, when the road network changes a little
+
+A refreshed graph is compared with the previous one by node id and
+edge set.  Community detection can start from the previous membership,
+and the new clusters are relabelled to keep the labels of the previous
+clusters they overlap most, so unchanged clusters keep their numbers.
+
+The per-cluster stages (hulls, edge nodes, Voronoi pruning) keep their
+results in a ClusterCache, keyed by a hash of each cluster's nodes, so
+only the clusters whose nodes changed are recomputed.
+
+Node ids are OSRM node ids, which fit in 32 bits.
+
+'''
+
+from collections import namedtuple
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from . import metrics
+from .io import cluster_slices
+from .parallel import map_clusters
+from .pipeline import code_hash, file_hash
+
+log = logging.getLogger(__name__)
+
+GraphDiff = namedtuple(
+    'GraphDiff',
+    ['added_nodes', 'removed_nodes', 'added_edges', 'removed_edges'])
+
+
+def _edge_keys(ids, edges):
+    """Pack each edge, as its pair of node ids, into a sorted uint64"""
+    ids = np.asarray(ids, dtype=np.uint64)
+    edges = np.asarray(edges, dtype=np.int64).reshape((-1, 2))
+    a = ids[edges[:, 0]]
+    b = ids[edges[:, 1]]
+    low = np.minimum(a, b)
+    high = np.maximum(a, b)
+    return np.unique((low << np.uint64(32)) | high)
+
+
+def _edge_pairs(keys):
+    """Unpack edge keys into (E, 2) node id pairs"""
+    return np.column_stack((keys >> np.uint64(32),
+                            keys & np.uint64(0xffffffff))).astype(np.int64)
+
+
+def diff_graphs(old_ids, old_edges, new_ids, new_edges):
+    """Compare two graphs by node id and edge set
+
+    The edges are given as (E, 2) vertex pairs, and compared as pairs
+    of node ids, regardless of direction.  Returns a GraphDiff, with the
+    added and removed node ids, and added and removed (E, 2) node id
+    pairs.
+    """
+    old_keys = _edge_keys(old_ids, old_edges)
+    new_keys = _edge_keys(new_ids, new_edges)
+    diff = GraphDiff(
+        np.setdiff1d(new_ids, old_ids),
+        np.setdiff1d(old_ids, new_ids),
+        _edge_pairs(np.setdiff1d(new_keys, old_keys, assume_unique=True)),
+        _edge_pairs(np.setdiff1d(old_keys, new_keys, assume_unique=True)))
+    log.info("%i nodes added, %i removed, %i edges added, %i removed",
+             *[len(x) for x in diff])
+    return diff
+
+
+def is_unchanged(diff):
+    """Whether a GraphDiff found no differences at all"""
+    return not any(len(x) for x in diff)
+
+
+def touched_nodes(diff):
+    """Ids of the nodes which were added, or gained or lost an edge"""
+    return np.unique(np.concatenate((
+        diff.added_nodes, diff.added_edges.ravel(),
+        diff.removed_edges.ravel())).astype(np.int64))
+
+
+def lookup(ids, values, wanted, missing=-1):
+    """The value of each wanted id, or missing if it isn't in ids"""
+    ids = np.asarray(ids)
+    wanted = np.asarray(wanted)
+    result = np.empty(len(wanted), dtype=np.int64)
+    result.fill(missing)
+    if not len(ids):
+        return result
+    by_id = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[by_id]
+    position = np.searchsorted(sorted_ids, wanted)
+    position[position == len(ids)] = 0
+    found = sorted_ids[position] == wanted
+    result[found] = np.asarray(values)[by_id[position[found]]]
+    return result
+
+
+def seed_membership(old_ids, old_membership, new_ids):
+    """Start a new membership from the previous one
+
+    Nodes keep their previous cluster, and new nodes start in clusters
+    of their own.  The clusters are numbered from 0, as igraph wants.
+    """
+    membership = lookup(old_ids, old_membership, new_ids)
+    new = membership < 0
+    membership[new] = membership.max() + 1 + np.arange(new.sum())
+    return np.unique(membership, return_inverse=True)[1]
+
+
+def stable_relabel(old_ids, old_membership, new_ids, new_membership):
+    """Relabel new clusters after the previous clusters they overlap most
+
+    Pairs of new and old clusters are matched greedily, most shared
+    nodes first, one to one.  New clusters left unmatched are numbered
+    after the largest previous label.
+    """
+    new_membership = np.asarray(new_membership, dtype=np.int64)
+    old = lookup(old_ids, old_membership, new_ids)
+    n_old = int(np.max(old_membership)) + 1 if len(old_membership) else 0
+    shared = old >= 0
+    pairs, overlap = np.unique(
+        new_membership[shared] * max(n_old, 1) + old[shared],
+        return_counts=True)
+    order = np.lexsort((pairs, -overlap))
+
+    n_new = int(new_membership.max()) + 1 if len(new_membership) else 0
+    label = np.empty(n_new, dtype=np.int64)
+    label.fill(-1)
+    used = set()
+    for pair in pairs[order].tolist():
+        new_cluster, old_cluster = divmod(pair, max(n_old, 1))
+        if label[new_cluster] < 0 and old_cluster not in used:
+            label[new_cluster] = old_cluster
+            used.add(old_cluster)
+    unmatched = label < 0
+    label[unmatched] = n_old + np.arange(unmatched.sum())
+    log.info("%i of %i clusters kept their previous label",
+             n_new - unmatched.sum(), n_new)
+    return label[new_membership]
+
+
+def params_filename(communities_file):
+    """Where to keep the parameters next to a communities file"""
+    root = communities_file
+    for extension in ('.gz', '.clusters'):
+        if root.endswith(extension):
+            root = root[:-len(extension)]
+    return root + '.params.json'
+
+
+def write_params(filename, params):
+    """Save the parameters the communities were found with"""
+    with open(filename, 'w') as outputfd:
+        json.dump(params, outputfd, indent=2, sort_keys=True)
+
+
+def read_params(filename):
+    """The parameters saved by write_params, or None without them"""
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as inputfd:
+        return json.load(inputfd)
+
+
+class ClusterCache(object):
+    """Results of per-cluster work, kept on disk across runs
+
+    Each result is keyed by a hash of the cluster number, its nodes, and
+    anything else it depends on, salted with the topotools sources and
+    the salt given (such as the script's parameters).
+    """
+
+    def __init__(self, directory, *salt):
+        self.directory = directory
+        digest = hashlib.sha1(code_hash().encode('utf-8'))
+        digest.update(repr(salt).encode('utf-8'))
+        self.salt = digest.hexdigest()
+
+    def key(self, cluster, nodes, extra=None):
+        digest = hashlib.sha1(self.salt.encode('utf-8'))
+        digest.update(repr(cluster).encode('utf-8'))
+        digest.update(np.ascontiguousarray(nodes).tobytes())
+        if extra is not None:
+            digest.update(extra)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pkl')
+
+    def get(self, key):
+        """Returns whether the key was found, and its result"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            metrics.count('cluster_cache.misses')
+            return False, None
+        metrics.count('cluster_cache.hits')
+        with open(path, 'rb') as fd:
+            return True, pickle.load(fd)
+
+    def put(self, key, result):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Made by another worker in the meantime
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        # Write under a temporary name, so readers never see a partial file
+        temp_file = '%s.%i.tmp' % (path, os.getpid())
+        with open(temp_file, 'wb') as fd:
+            pickle.dump(result, fd, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_file, path)
+
+
+def add_argument(parser):
+    """Add the --cluster-cache option to a script"""
+    parser.add_argument('--cluster-cache', dest='cluster_cache',
+                        metavar='dir',
+                        help='Keep per-cluster results in dir, and reuse'
+                        ' them for clusters whose nodes are unchanged')
+
+
+def open_cache(directory, script, *params):
+    """The ClusterCache of a script in directory, or None without one
+
+    The results are salted with the script's contents and its
+    parameters.
+    """
+    if not directory:
+        return None
+    return ClusterCache(directory, file_hash(script), *params)
+
+
+def cached_map_clusters(function, nodes, cache=None, workers=1,
+                        processes=False, extra=None):
+    """Like map_clusters, but only for clusters missing from the cache
+
+    If extra is given, extra(cluster) gives bytes which the cluster's
+    result also depends on, such as its hull.  Without a cache, this is
+    just map_clusters.
+    """
+    if cache is None:
+        return map_clusters(function, nodes, workers, processes)
+
+    keys = []
+    results = []
+    missing = []
+    for cluster, cluster_nodes in cluster_slices(nodes):
+        key = cache.key(cluster, cluster_nodes,
+                        extra(cluster) if extra is not None else None)
+        found, result = cache.get(key)
+        if not found:
+            missing.append((len(keys), cluster_nodes))
+        keys.append(key)
+        results.append(result)
+    log.info("%i of %i clusters are cached", len(keys) - len(missing),
+             len(keys))
+
+    if missing:
+        computed = map_clusters(
+            function, np.concatenate([x for _, x in missing]),
+            workers, processes)
+        for (index, _), result in zip(missing, computed):
+            results[index] = result
+            cache.put(keys[index], result)
+    return results
@@ -6,71 +6,427 @@ Info for reading & writing geo data
 
 from collections import namedtuple
 import gzip
+import hashlib
 import logging
+import os
 
 from osgeo import ogr
 import numpy as np
-from shapely.wkb import loads
+from shapely.geometry import MultiPolygon
+from shapely.ops import cascaded_union
+from shapely.wkb import dumps, loads
 
 log = logging.getLogger(__name__)
 
 NodeInfo = namedtuple('NodeInfo', ['id', 'lat', 'lon', 'clust'])
+NODE_DTYPE = np.dtype(
+    [('id', int), ('lat', int), ('lon', int), ('clust', int)])
 
+# Node coordinates are stored as integers, in units of 1e-5 degrees.
+COORDINATE_SCALE = 100000.
 
-def read_clusters(gzipped_file, bbox, scale=True):
-    """Yield node and cluster info from a gzip file
+# Binary cluster files
+# --------------------
+#
+# A columnar alternative to the gzipped "id lat lon clust" text files,
+# which can be memory-mapped without copying.  The layout is:
+#
+#   header     CLUSTER_HEADER_DTYPE
+#   clusters   int64[n_clusters]      cluster ids, ascending
+#   offsets    int64[n_clusters + 1]  start of each cluster in the columns
+#   id         int64[n_nodes]
+#   lat        int32[n_nodes]         in 1 / scale degrees
+#   lon        int32[n_nodes]         in 1 / scale degrees
+#   clust      int32[n_nodes]
+#
+# The nodes are ordered by cluster, so cluster i is the slice
+# offsets[i]:offsets[i + 1] of every column.
+
+BINARY_EXTENSION = '.clusters'
+CLUSTER_MAGIC = b'TOPOCLST'
+CLUSTER_VERSION = 1
+CLUSTER_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('reserved', '<u4'),
+    ('scale', '<f8'),
+    ('n_nodes', '<i8'),
+    ('n_clusters', '<i8'),
+])
+
+ClusterArrays = namedtuple(
+    'ClusterArrays',
+    ['id', 'lat', 'lon', 'clust', 'clusters', 'offsets', 'scale'])
+
+
+def is_binary_clusters(filename):
+    """Check if a cluster file is in the binary format"""
+    with open(filename, 'rb') as fd:
+        return fd.read(len(CLUSTER_MAGIC)) == CLUSTER_MAGIC
 
-    Uses the format defined in find-communities.py
 
+def open_clusters(filename):
+    """Memory-map the columns of a binary cluster file
+
+    Returns a ClusterArrays tuple of read-only arrays, which are views
+    into the file.
     """
-    def in_bbox(node):
-        if not bbox:
-            return True
-        # make sure they are ordered correctly
-        upper_lat = max(bbox[1], bbox[3])
-        lower_lat = min(bbox[1], bbox[3])
-        upper_lon = max(bbox[0], bbox[2])
-        lower_lon = min(bbox[0], bbox[2])
-        if lower_lon < node.lon < upper_lon:
-            if lower_lat < node.lat < upper_lat:
-                return True
-        return False
+    raw = np.memmap(filename, dtype=np.uint8, mode='r')
+    header = raw[:CLUSTER_HEADER_DTYPE.itemsize].view(CLUSTER_HEADER_DTYPE)[0]
+    if header['magic'] != CLUSTER_MAGIC:
+        raise ValueError("%s is not a binary cluster file" % filename)
+    if header['version'] != CLUSTER_VERSION:
+        raise ValueError("%s has unknown version %i" %
+                         (filename, header['version']))
+
+    n_nodes = int(header['n_nodes'])
+    n_clusters = int(header['n_clusters'])
+    columns = []
+    position = CLUSTER_HEADER_DTYPE.itemsize
+    for dtype, size in [('<i8', n_clusters), ('<i8', n_clusters + 1),
+                        ('<i8', n_nodes), ('<i4', n_nodes),
+                        ('<i4', n_nodes), ('<i4', n_nodes)]:
+        nbytes = np.dtype(dtype).itemsize * size
+        columns.append(raw[position:position + nbytes].view(dtype))
+        position += nbytes
+    clusters, offsets, ids, lats, lons, clusts = columns
+    return ClusterArrays(ids, lats, lons, clusts, clusters, offsets,
+                         float(header['scale']))
+
+
+class NodeColumns(object):
+    """Nodes kept as separate columns, used like a NODE_DTYPE array
+
+    Binary cluster files are read as this, so the columns can stay
+    memory-mapped.  nodes['lat'] gives a column, and indexing with a
+    slice, mask or index array picks the same nodes from every column;
+    slices of memory-mapped columns are still views into the file.
+    Setting a field replaces its column.  np.asarray(nodes) copies them
+    into a NODE_DTYPE array.
+
+    If the nodes are whole clusters, in cluster order, clusters and
+    offsets are their cluster table, as in the binary format, so
+    cluster_slices doesn't have to look for the boundaries.
+    """
+
+    def __init__(self, columns, clusters=None, offsets=None):
+        self.columns = dict(columns)
+        self.clusters = clusters
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return NodeColumns((field, column[key])
+                           for field, column in self.columns.items())
+
+    def __setitem__(self, field, values):
+        self.columns[field] = np.asarray(values)
+        if field == 'clust':
+            # The cluster table no longer holds
+            self.clusters = self.offsets = None
+
+    def __array__(self, dtype=None, copy=None):
+        nodes = np.empty(len(self), dtype=NODE_DTYPE)
+        for field in NODE_DTYPE.names:
+            nodes[field] = self.columns[field]
+        if dtype is not None:
+            nodes = nodes.astype(dtype)
+        return nodes
 
+
+def _write_binary_clusters(filename, nodes, scale):
+    """Write nodes as a binary cluster file, ordered by cluster"""
+    order = np.argsort(nodes['clust'], kind='mergesort')
+    nodes = nodes[order]
+    clusters, offsets = np.unique(nodes['clust'], return_index=True)
+    offsets = np.append(offsets, len(nodes))
+
+    header = np.zeros(1, dtype=CLUSTER_HEADER_DTYPE)
+    header['magic'] = CLUSTER_MAGIC
+    header['version'] = CLUSTER_VERSION
+    header['scale'] = scale
+    header['n_nodes'] = len(nodes)
+    header['n_clusters'] = len(clusters)
+
+    with open(filename, 'wb') as outputfd:
+        header.tofile(outputfd)
+        clusters.astype('<i8').tofile(outputfd)
+        offsets.astype('<i8').tofile(outputfd)
+        nodes['id'].astype('<i8').tofile(outputfd)
+        nodes['lat'].astype('<i4').tofile(outputfd)
+        nodes['lon'].astype('<i4').tofile(outputfd)
+        nodes['clust'].astype('<i4').tofile(outputfd)
+
+
+def write_clusters(filename, nodes, scale=COORDINATE_SCALE):
+    """Write nodes to a cluster file
+
+    The nodes can be a structured array with id, lat, lon and clust
+    fields, NodeColumns, or an iterable of NodeInfo, in unscaled
+    (integer) units.
+
+    Files ending in BINARY_EXTENSION are written in the binary format,
+    ordered by cluster.  Anything else is written in the gzipped
+    text format defined in find-communities.py, in the given order.
+    """
+    if not isinstance(nodes, (np.ndarray, NodeColumns)):
+        nodes = nodes_to_recarray(nodes)
+    if filename.endswith(BINARY_EXTENSION):
+        _write_binary_clusters(filename, nodes, scale)
+    else:
+        with gzip.open(filename, 'wb') as outputfd:
+            np.savetxt(outputfd, np.column_stack(
+                [nodes['id'], nodes['lat'], nodes['lon'], nodes['clust']]),
+                fmt='%d')
+
+
+def bbox_mask(lat, lon, bbox):
+    """Mask of coordinates (in degrees) strictly within bbox"""
+    # make sure they are ordered correctly
+    upper_lat = max(bbox[1], bbox[3])
+    lower_lat = min(bbox[1], bbox[3])
+    upper_lon = max(bbox[0], bbox[2])
+    lower_lon = min(bbox[0], bbox[2])
+    return ((lower_lon < lon) & (lon < upper_lon) &
+            (lower_lat < lat) & (lat < upper_lat))
+
+
+def _parse_text_block(block, bbox):
+    """Parse complete lines of the text format into a node array"""
+    values = np.fromstring(block, dtype=np.int64, sep=' ').reshape((-1, 4))
+    if bbox:
+        values = values[bbox_mask(values[:, 1] / COORDINATE_SCALE,
+                                   values[:, 2] / COORDINATE_SCALE, bbox)]
+    nodes = np.empty(len(values), dtype=NODE_DTYPE)
+    for column, field in enumerate(NODE_DTYPE.names):
+        nodes[field] = values[:, column]
+    return nodes
+
+
+def _read_text_nodes(gzipped_file, bbox, chunk_size):
+    """Read a gzipped text cluster file in large blocks"""
+    blocks = []
+    remainder = b''
     with gzip.open(gzipped_file, 'rb') as fd:
-        for line in fd:
-            fields = [int(x) for x in line.strip().split()]
-            # Scale lat/lon to normal degrees
-            if scale:
-                fields[1] /= 100000.
-                fields[2] /= 100000.
-            node = NodeInfo(*fields)
-            if in_bbox(node):
-                yield node
+        while True:
+            data = fd.read(chunk_size)
+            if not data:
+                break
+            data = remainder + data
+            # Only parse complete lines, keep the rest for the next block
+            end = data.rfind(b'\n') + 1
+            remainder = data[end:]
+            if end:
+                blocks.append(_parse_text_block(data[:end], bbox))
+    if remainder.strip():
+        blocks.append(_parse_text_block(remainder, bbox))
+    if not blocks:
+        return np.empty(0, dtype=NODE_DTYPE)
+    return np.concatenate(blocks)
+
+
+def _read_binary_nodes(filename, bbox):
+    """Read a binary cluster file as NodeColumns
+
+    Without a bbox, the columns are the memory-mapped ones.  With one,
+    only the nodes within it are copied out, and the cluster table is
+    cut down to match.
+    """
+    arrays = open_clusters(filename)
+    columns = [(field, getattr(arrays, field))
+               for field in NODE_DTYPE.names]
+    clusters = arrays.clusters
+    offsets = arrays.offsets
+    if bbox:
+        mask = bbox_mask(arrays.lat / arrays.scale,
+                          arrays.lon / arrays.scale, bbox)
+        columns = [(field, column[mask]) for field, column in columns]
+        # Count the nodes kept before each offset, and drop the clusters
+        # with none left
+        kept = np.append(0, np.cumsum(mask))[offsets]
+        nonempty = np.diff(kept) > 0
+        clusters = clusters[nonempty]
+        offsets = np.append(kept[:-1][nonempty], kept[-1])
+    return NodeColumns(columns, clusters, offsets), arrays.scale
+
+
+def read_nodes(filename, bbox, chunk_size=1 << 24):
+    """Read a cluster file into a structured array of nodes
+
+    Works with both the gzipped text and the binary format.  The text
+    format is decoded chunk_size bytes at a time.  Only nodes strictly
+    within bbox (given in degrees) are kept.
+
+    Returns the nodes, with unscaled (integer) coordinates, and the
+    coordinate scale.  The nodes of a binary file are NodeColumns, and
+    those of a text file a structured array.
+    """
+    if is_binary_clusters(filename):
+        return _read_binary_nodes(filename, bbox)
+    return _read_text_nodes(filename, bbox, chunk_size), COORDINATE_SCALE
+
+
+def cluster_slices(nodes):
+    """Yield (cluster, nodes) for each run of nodes with the same cluster
+
+    Like itertools.groupby, but each group is a slice of the array.
+    NodeColumns read from a binary file are cut up by its cluster table.
+    """
+    if not len(nodes):
+        return
+    offsets = getattr(nodes, 'offsets', None)
+    if offsets is not None:
+        for cluster, start, stop in zip(nodes.clusters.tolist(),
+                                        offsets[:-1].tolist(),
+                                        offsets[1:].tolist()):
+            yield cluster, nodes[start:stop]
+        return
+    clusters = nodes['clust']
+    starts = np.append(0, np.flatnonzero(np.diff(clusters)) + 1)
+    stops = np.append(starts[1:], len(nodes))
+    for start, stop in zip(starts.tolist(), stops.tolist()):
+        yield int(clusters[start]), nodes[start:stop]
+
+
+def read_clusters(gzipped_file, bbox, scale=True):
+    """Yield node and cluster info from a cluster file
+
+    Uses the format defined in find-communities.py, or the binary
+    format if the file has the binary header.  The bbox is always
+    given in degrees.
+
+    """
+    nodes, coordinate_scale = read_nodes(gzipped_file, bbox)
+    for _, cluster in cluster_slices(nodes):
+        lat = cluster['lat']
+        lon = cluster['lon']
+        if scale:
+            lat = lat / coordinate_scale
+            lon = lon / coordinate_scale
+        for fields in zip(cluster['id'].tolist(), lat.tolist(),
+                          lon.tolist(), cluster['clust'].tolist()):
+            yield NodeInfo(*fields)
 
 
 def nodes_to_recarray(nodes):
     """Convert an iterable of nodes into a numpy recarray"""
     return np.array(
         [(x.id, x.lat, x.lon, x.clust) for x in nodes],
-        dtype=[('id', int), ('lat', int), ('lon', int), ('clust', int)]
+        dtype=NODE_DTYPE
     )
 
 
+def membership_to_recarray(ids, lat, lon, membership):
+    """Make nodes from whole columns and a cluster membership
+
+    The nodes are ordered by cluster, keeping the given order within
+    each cluster.
+    """
+    nodes = np.empty(len(membership), dtype=NODE_DTYPE)
+    nodes['id'] = ids
+    nodes['lat'] = lat
+    nodes['lon'] = lon
+    nodes['clust'] = membership
+    return nodes[np.argsort(nodes['clust'], kind='mergesort')]
+
+
 def read_clusters_as_recarray(gzipped_file, bbox):
-    return nodes_to_recarray(read_clusters(gzipped_file, bbox, False))
+    return np.asarray(read_nodes(gzipped_file, bbox)[0])
 
 
 def shp_to_multipolygon(shp_file, overlapping=None):
     """Yields features from a .shp in Shapely format
 
     If overlapping is not None, only polygons which overlap it
-    are yielded.
+    are yielded.  Its bounding box is passed to OGR as a spatial
+    filter, so features far away are never read.
     """
     log.info("Converting %s to shapely format", shp_file)
     source = ogr.Open(shp_file)
     layer = source.GetLayer()
-    for fidx in range(layer.GetFeatureCount()):
-        feature = layer.GetFeature(fidx)
+    if overlapping is not None:
+        layer.SetSpatialFilterRect(*overlapping.bounds)
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
         polygon = loads(feature.GetGeometryRef().ExportToWkb())
         if not overlapping or polygon.intersects(overlapping):
             yield polygon
+        feature = layer.GetNextFeature()
+
+
+def _clip_mask_key(shp_files, bbox):
+    """Identify a clip mask by its shapefiles and bounding box"""
+    key = hashlib.sha1()
+    for shp_file in shp_files:
+        info = os.stat(shp_file)
+        key.update(repr((os.path.abspath(shp_file), info.st_size,
+                         info.st_mtime)).encode('utf-8'))
+    key.update(repr(tuple(bbox.bounds)).encode('utf-8'))
+    return key.hexdigest()
+
+
+def build_clip_mask(shp_files, bbox):
+    """Intersect the union of the features of each .shp within bbox
+
+    Returns the mask, or None if there are no files.
+    """
+    mask = None
+    feature_count = 0
+    for shp_file in shp_files:
+        log.info("Loading features from %s", shp_file)
+        polys_in_shp_file = []
+        for feature in shp_to_multipolygon(shp_file, overlapping=bbox):
+            if not isinstance(feature, MultiPolygon):
+                feature = [feature]
+            for poly in feature:
+                if bbox.intersects(poly):
+                    feature_count += 1
+                    polys_in_shp_file.append(poly.intersection(bbox))
+        shp_file_megapoly = cascaded_union(polys_in_shp_file)
+        if mask is None:
+            mask = shp_file_megapoly
+        else:
+            mask = mask.intersection(shp_file_megapoly)
+    log.info("Found %i overlapping features", feature_count)
+    return mask
+
+
+def load_clip_mask(shp_files, bbox, cache_dir=None):
+    """Load the clip mask of some .shp files within bbox
+
+    Like build_clip_mask, but if cache_dir is given the mask is kept
+    there as WKB, keyed on the path, size and modification time of each
+    file and on the bounding box, and reused by later calls.
+    """
+    if not shp_files:
+        return None
+    if cache_dir is None:
+        return build_clip_mask(shp_files, bbox)
+
+    cache_file = os.path.join(
+        cache_dir, _clip_mask_key(shp_files, bbox) + '.wkb')
+    if os.path.exists(cache_file):
+        log.info("Loading cached clip mask from %s", cache_file)
+        with open(cache_file, 'rb') as fd:
+            return loads(fd.read())
+
+    mask = build_clip_mask(shp_files, bbox)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Made by another worker in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+    log.info("Caching clip mask in %s", cache_file)
+    # Write under a temporary name, so readers never see a partial file
+    temp_file = '%s.%i.tmp' % (cache_file, os.getpid())
+    with open(temp_file, 'wb') as fd:
+        fd.write(dumps(mask))
+    os.rename(temp_file, cache_file)
+    return mask
@@ -0,0 +1,117 @@
+'''
+
+Merge small shapes of a tesselation into their neighbors
+
+Unlike the original loop in merge-tiny-communities.py, a merged shape
+which is still smaller than the minimum area is merged again, and a
+small shape with no neighbors at all (an island) is kept as it is,
+rather than dropped from the output.
+
+'''
+
+import heapq
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def bbox_pairs(bounds):
+    """Find all pairs of overlapping bounding boxes
+
+    The bounds are an (N, 4) array of (minx, miny, maxx, maxy).  The
+    boxes are swept in x, so only boxes which overlap in x are checked
+    for overlap in y.
+
+    Returns an (M, 2) array of index pairs (i, j), with i < j.
+    """
+    bounds = np.asarray(bounds, dtype=float).reshape((-1, 4))
+    order = np.argsort(bounds[:, 0], kind='mergesort')
+    minx = bounds[order, 0]
+    # Each box overlaps in x with the following boxes which start
+    # before it ends.
+    stop = np.searchsorted(minx, bounds[order, 2], side='right')
+    start = np.arange(len(order)) + 1
+    counts = np.maximum(stop - start, 0)
+    first = np.repeat(np.arange(len(order)), counts)
+    second = np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts) + start[first]
+    first = order[first]
+    second = order[second]
+    overlap = ((bounds[first, 1] <= bounds[second, 3]) &
+               (bounds[second, 1] <= bounds[first, 3]))
+    pairs = np.column_stack((first[overlap], second[overlap]))
+    pairs.sort(axis=1)
+    return pairs
+
+
+def shared_borders(shapes):
+    """Find the length of the border shared by each pair of shapes
+
+    Only pairs with overlapping bounding boxes are intersected.
+
+    Returns a list with, for each shape, a dict mapping each touching
+    shape to the length of their intersection.
+    """
+    bounds = [shape.bounds if not shape.is_empty else (0, 0, -1, -1)
+              for shape in shapes]
+    borders = [{} for _ in shapes]
+    for i, j in bbox_pairs(bounds).tolist():
+        intersection = shapes[i].intersection(shapes[j])
+        if not intersection.is_empty:
+            borders[i][j] = borders[j][i] = intersection.length
+    return borders
+
+
+def merge_small_shapes(shapes, min_area):
+    """Merge every shape smaller than min_area into a neighbor
+
+    The smallest shape is always merged first, into the neighbor it
+    shares the longest border with.  The merged shape then goes back in
+    line with its new area, so it is merged again if it is still too
+    small.  Shapes without any neighbors are left alone, and kept.
+    Shared borders are found once, and added up as shapes are merged.
+
+    Returns a dict mapping the index of each remaining shape to its
+    (merged) shape, and the list of merges as (from, into) index pairs.
+    """
+    shapes = list(shapes)
+    log.info("Finding shared borders of %i shapes", len(shapes))
+    borders = shared_borders(shapes)
+    areas = [shape.area for shape in shapes]
+    heap = [(area, idx) for idx, area in enumerate(areas) if area < min_area]
+    heapq.heapify(heap)
+
+    alive = dict(enumerate(shapes))
+    merges = []
+    while heap:
+        area, idx = heapq.heappop(heap)
+        # Skip entries for shapes which have since grown or been merged
+        if idx not in alive or area != areas[idx]:
+            continue
+        neighbors = borders[idx]
+        if not neighbors:
+            log.error("Couldn't find any neighbors for shape %i", idx)
+            continue
+        # Merge this into the neighbor shape with the largest
+        # shared border.
+        _, into = max((length, other) for other, length in neighbors.items())
+
+        alive[into] = alive[into].union(alive.pop(idx))
+        areas[into] = alive[into].area
+        merges.append((idx, into))
+
+        # The merged shape borders all the neighbors of both.
+        for other, length in neighbors.items():
+            del borders[other][idx]
+            if other != into:
+                total = borders[into].get(other, 0) + length
+                borders[into][other] = borders[other][into] = total
+        borders[idx] = {}
+
+        if areas[into] < min_area:
+            heapq.heappush(heap, (areas[into], into))
+
+    log.info("Merged %i of %i shapes", len(merges), len(shapes))
+    return alive, merges
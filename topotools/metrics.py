@@ -0,0 +1,195 @@
+'''
+
+Timing spans, counters and progress reports for the scripts
+
+Everything is recorded in one registry per process.  Spans time a
+named piece of work, optionally for one key (such as a cluster), so
+the slowest clusters of a stage can be picked out.  Counters add up
+numbers of things, like nodes in and out or tail clips, and values
+note single results, like a modularity.  The scripts write it all,
+with the wall time and peak memory, with --metrics.
+
+Work done in worker processes is recorded there, and merged back with
+snapshot and merge (topotools.parallel does this), along with each
+worker's peak memory.
+
+'''
+
+from contextlib import contextmanager
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# How many of the slowest keys to keep per span in the output
+SLOWEST = 20
+
+_lock = threading.Lock()
+_start = time.time()
+_counters = {}
+_spans = {}
+_values = {}
+# Peak resident memory of each worker process merged, in kB, by pid
+_peaks = {}
+
+
+def reset():
+    """Forget everything recorded so far"""
+    with _lock:
+        _counters.clear()
+        _spans.clear()
+        _values.clear()
+        _peaks.clear()
+
+
+def count(name, value=1):
+    """Add value to a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def value(name, x):
+    """Note a single value, such as a result's quality"""
+    with _lock:
+        _values[name] = x
+
+
+def record(name, seconds, key=None):
+    """Record the time taken by one piece of work"""
+    with _lock:
+        _spans.setdefault(name, []).append((seconds, key))
+
+
+@contextmanager
+def span(name, key=None):
+    """Time the work done in a with block"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start, key)
+
+
+def peak_memory():
+    """Peak resident memory of this process and its workers, in MB
+
+    The peaks of the worker processes merged are added to this one's,
+    since they may have run at the same time.  That is an upper bound:
+    the workers need not have peaked together, and the pages they share
+    with this process, from the fork, count in each of them.  Other
+    child processes only count through the largest peak among them
+    (ru_maxrss), which under-reports when several ran at once.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    with _lock:
+        workers = sum(peak for pid, peak in _peaks.items()
+                      if pid != os.getpid())
+    # ru_maxrss is in kB on Linux
+    return max(own + workers, children) / 1024.
+
+
+def snapshot():
+    """Everything recorded so far, to merge into another process
+
+    This includes the peak memory of this process, and of any workers
+    merged into it.
+    """
+    with _lock:
+        peaks = dict(_peaks)
+        recorded = (dict(_counters), dict(
+            (name, list(times)) for name, times in _spans.items()),
+            dict(_values), peaks)
+    pid = os.getpid()
+    peaks[pid] = max(peaks.get(pid, 0),
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return recorded
+
+
+def merge(recorded):
+    """Add a snapshot from another process"""
+    counters, spans, values, peaks = recorded
+    with _lock:
+        for name, x in counters.items():
+            _counters[name] = _counters.get(name, 0) + x
+        for name, times in spans.items():
+            _spans.setdefault(name, []).extend(times)
+        _values.update(values)
+        for pid, peak in peaks.items():
+            _peaks[pid] = max(_peaks.get(pid, 0), peak)
+
+
+def summary():
+    """Summarize the spans and counters as a dict"""
+    spans = snapshot()[1]
+    span_summary = {}
+    for name, times in spans.items():
+        seconds = [x for x, _ in times]
+        slowest = sorted(times, key=lambda x: x[0], reverse=True)[:SLOWEST]
+        span_summary[name] = {
+            'count': len(seconds),
+            'total': sum(seconds),
+            'max': max(seconds),
+            'mean': sum(seconds) / len(seconds),
+            'slowest': [{'key': key, 'seconds': x} for x, key in slowest
+                        if key is not None],
+        }
+    with _lock:
+        counters = dict(_counters)
+        values = dict(_values)
+    return {
+        'wall': time.time() - _start,
+        'peak_memory_mb': peak_memory(),
+        'counters': counters,
+        'values': values,
+        'spans': span_summary,
+    }
+
+
+def add_argument(parser):
+    """Add the --metrics option to a script"""
+    parser.add_argument('--metrics', metavar='out.json',
+                        help='Write timings, counters and peak memory'
+                        ' to this file')
+
+
+def write(filename):
+    """Write the summary to a JSON file, if filename is given"""
+    if not filename:
+        return
+    log.info("Writing metrics to %s", filename)
+    with open(filename, 'w') as outputfd:
+        json.dump(summary(), outputfd, indent=2, sort_keys=True)
+
+
+class Progress(object):
+    """Log progress through a known amount of work, now and then
+
+    At most one message is logged every interval seconds, however often
+    update is called.
+    """
+
+    def __init__(self, total, label, interval=10., logger=None):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.logger = logger or log
+        self.done = 0
+        self.start = self.last = time.time()
+
+    def update(self, done=1):
+        """Add done to the work done, and log if it's been a while"""
+        self.done += done
+        now = time.time()
+        if now - self.last < self.interval and self.done < self.total:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        self.logger.info("%s: %i/%i (%0.1f%%), %0.0f/s", self.label,
+                         self.done, self.total,
+                         100. * self.done / max(self.total, 1), rate)
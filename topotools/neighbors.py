@@ -4,14 +4,13 @@ Functions to smooth communities using k nearest neighbors
 
 '''
 
-from concurrent import futures
 from collections import Counter
-import functools
 import logging
 
 import numpy as np
 
 from . import NodeInfo
+from . import metrics
 
 log = logging.getLogger(__name__)
 
@@ -25,25 +24,77 @@ def reassign_cluster(node, kdtree=None, current_clusters=None, k=None):
     return new_cluster
 
 
-def reassign_clusters(nodecollection, kdtree, current_clusters, k):
+def _query(kdtree, points, k, workers):
+    """Query a cKDTree for the indices of the k nearest neighbors
+
+    Always returns a 2D (len(points), k) array.
+    """
+    try:
+        _, indices = kdtree.query(points, k=k, workers=workers)
+    except TypeError:
+        try:
+            # Older scipy calls the parallel workers n_jobs
+            _, indices = kdtree.query(points, k=k, n_jobs=workers)
+        except TypeError:
+            # Before scipy 0.16, queries only run in one thread
+            _, indices = kdtree.query(points, k=k)
+    return np.reshape(indices, (len(points), k))
+
+
+def cluster_modes(neighbor_clusters):
+    """Find the most common cluster in each row of neighbor clusters
+
+    Ties are broken in favor of the cluster of the nearest neighbor,
+    i.e. the one which appears first in the row.
+
+    Each row is sorted, so equal clusters form runs, which are counted
+    with one bincount; this takes O(k log k) per row, not O(k^2).
+    """
+    neighbor_clusters = np.asarray(neighbor_clusters)
+    n_rows, k = neighbor_clusters.shape
+    rows = np.arange(n_rows)[:, np.newaxis]
+    # A stable sort keeps the nearest neighbor first in each run
+    order = np.argsort(neighbor_clusters, axis=1, kind='mergesort')
+    ordered = neighbor_clusters[rows, order]
+    starts = np.ones((n_rows, k), dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    runs = np.cumsum(starts.ravel()) - 1
+    counts = np.bincount(runs)[runs].reshape((n_rows, k))
+    # Score each run by its size, then by how near its first member is
+    score = np.where(starts, counts * k + (k - 1 - order), -1)
+    best = score.argmax(axis=1)
+    return ordered[np.arange(n_rows), best]
+
+
+def reassign_clusters(nodecollection, kdtree, current_clusters, k,
+                      workers=1, block_size=4096):
     """Return a new copy of node collection with reassigned clusters
 
     The mode of the cluster distribution of the k nearest neighbors
     is the new cluster value.
 
-    @param nodecollection: nodes to reassign
+    The nodes are processed in blocks, and each block is queried at
+    once.
+
+    @param nodecollection: array of points to reassign
     @param current_clusters: array of cluster values corresponding
         to the points used to build kdtree
-    @param kdtree: a k-nearest neighbor tree
+    @param kdtree: a k-nearest neighbor tree (a cKDTree)
     @param k: how many neighbors to use.
+    @param workers: number of parallel workers for the tree query.
+    @param block_size: number of nodes to query at once.
     """
-    new_clusters = []
-    report_every = int(len(nodecollection) / 100)
-    for idx, node in enumerate(nodecollection):
-        if idx % report_every == 0:
-            log.info("Reassigned %i nodes", idx)
-        new_cluster = reassign_cluster(node, kdtree, current_clusters, k)
-        new_clusters.append(new_cluster)
+    nodecollection = np.asarray(nodecollection)
+    current_clusters = np.asarray(current_clusters)
+    n_nodes = len(nodecollection)
+    new_clusters = np.empty(n_nodes, dtype=current_clusters.dtype)
+    progress = metrics.Progress(n_nodes, "Reassigned nodes", logger=log)
+    for start in range(0, n_nodes, block_size):
+        stop = min(start + block_size, n_nodes)
+        indices = _query(kdtree, nodecollection[start:stop], k, workers)
+        new_clusters[start:stop] = cluster_modes(current_clusters[indices])
+        progress.update(stop - start)
+    metrics.count('reassign.nodes', n_nodes)
     return new_clusters
 
 
@@ -51,22 +102,67 @@ def reassign_clusters_threaded(nodecollection, kdtree, current_clusters,
                                k, worker_threads):
     """Threaded version of reassign_clusters
 
-    Nodes are reassigned in place.
+    The tree queries are split over worker_threads workers.
 
     """
-    log.info("Spawning %i threads to reassign %i nodes",
+    log.info("Using %i workers to reassign %i nodes",
              worker_threads, len(nodecollection))
-    reassigner = functools.partial(
-        reassign_cluster,
-        kdtree=kdtree, current_clusters=current_clusters, k=k)
-    output = np.zeros(len(nodecollection), dtype=int)
-    report_every = int(len(nodecollection) / 100)
-    with futures.ThreadPoolExecutor(max_workers=worker_threads) as executor:
-        i = 0
-        log.info("Beginning execution")
-        for new_cluster in executor.map(reassigner, nodecollection):
-            output[i] = new_cluster
-            i += 1
-            if True or i % report_every == 0:
-                log.info("Reassigned %i nodes", i)
-    return output
+    return reassign_clusters(nodecollection, kdtree, current_clusters, k,
+                             workers=worker_threads)
+
+
+def neighbor_indices(points, kdtree, k, workers=1, block_size=4096):
+    """Find the k nearest neighbors of each point
+
+    Returns an (N, k) matrix of indices into the points used to build
+    kdtree.  It is stored as 32 bit integers when possible, to halve
+    its size.
+    """
+    points = np.asarray(points)
+    dtype = np.int32 if kdtree.n < np.iinfo(np.int32).max else np.intp
+    indices = np.empty((len(points), k), dtype=dtype)
+    for start in range(0, len(points), block_size):
+        stop = min(start + block_size, len(points))
+        indices[start:stop] = _query(kdtree, points[start:stop], k, workers)
+    return indices
+
+
+def smooth_clusters(points, kdtree, clusters, k, max_rounds=10,
+                    min_change=0., workers=1, block_size=4096):
+    """Repeatedly reassign clusters until they stop changing
+
+    The points must be the ones used to build kdtree.  The k nearest
+    neighbors are found once, and the neighbor index matrix is reused
+    by every round.  After the first round, only nodes which have a
+    neighbor that changed cluster are voted on again.
+
+    Stops after max_rounds, or once the fraction of nodes changing
+    cluster in a round is not more than min_change.
+
+    Returns the new clusters and the number of rounds.
+    """
+    clusters = np.array(clusters)
+    n_nodes = len(clusters)
+    log.info("Finding %i nearest neighbors of %i nodes", k, n_nodes)
+    indices = neighbor_indices(points, kdtree, k, workers, block_size)
+
+    candidates = np.arange(n_nodes)
+    for iround in range(1, max_rounds + 1):
+        votes = np.empty(len(candidates), dtype=clusters.dtype)
+        for start in range(0, len(candidates), block_size):
+            stop = min(start + block_size, len(candidates))
+            votes[start:stop] = cluster_modes(
+                clusters[indices[candidates[start:stop]]])
+        different = votes != clusters[candidates]
+        changed = candidates[different]
+        clusters[changed] = votes[different]
+        log.info("Round %i: %i of %i re-voted nodes changed cluster",
+                 iround, len(changed), len(candidates))
+        metrics.count('smooth.votes', len(candidates))
+        metrics.count('smooth.changed', len(changed))
+        if len(changed) <= min_change * n_nodes:
+            break
+        touched = np.zeros(n_nodes, dtype=bool)
+        touched[changed] = True
+        candidates = np.flatnonzero(touched[indices].any(axis=1))
+    return clusters, iround
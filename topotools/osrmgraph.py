@@ -0,0 +1,184 @@
+'''
+
+Read the road graph from an OSRM .osrm file, as NumPy arrays
+
+The node and edge sections are memory-mapped, and the graph is
+simplified and cut down to its largest connected component with array
+operations, so the time and memory taken grow linearly with the size
+of the extract.
+
+The .osrm layout assumed is the one written by the OSRM 0.3 extractor,
+in native (little endian) byte order:
+
+    header     the UUID fingerprint; its size varies between versions
+    n_nodes    uint32
+    nodes      OSRM_NODE_DTYPE[n_nodes]   the C struct, with padding
+    n_edges    uint32
+    edges      OSRM_EDGE_DTYPE[n_edges]   each field written packed
+
+The header size is found by checking which one makes the counts add up
+to the size of the file.  Coordinates are integers in 1e-5 degrees, and
+edge weights are travel times in tenths of a second.  The edges refer
+to the nodes by their (OSM) ids.  Direction is ignored, since the
+communities are found on the undirected graph.
+
+'''
+
+import logging
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+log = logging.getLogger(__name__)
+
+OSRM_NODE_DTYPE = np.dtype([
+    ('lat', '<i4'),
+    ('lon', '<i4'),
+    ('id', '<u4'),
+    ('bollard', 'u1'),
+    ('traffic_light', 'u1'),
+    ('padding', 'V2'),
+])
+
+OSRM_EDGE_DTYPE = np.dtype([
+    ('source', '<u4'),
+    ('target', '<u4'),
+    ('distance', '<i4'),
+    ('direction', '<i2'),
+    ('weight', '<i4'),
+    ('type', '<i2'),
+    ('name', '<u4'),
+    ('roundabout', 'u1'),
+    ('ignore_in_grid', 'u1'),
+    ('access_restricted', 'u1'),
+    ('contra_flow', 'u1'),
+])
+
+# The largest header to look for the node count after
+MAX_HEADER = 1024
+
+# Edges are looked up this many at a time, to bound the copies made
+CHUNK_SIZE = 1 << 22
+
+
+def _count_at(raw, position):
+    return int(raw[position:position + 4].view('<u4')[0])
+
+
+def _find_sections(raw):
+    """Find the offsets and sizes of the node and edge sections"""
+    size = len(raw)
+    for header in range(min(MAX_HEADER, size - 8) + 1):
+        n_nodes = _count_at(raw, header)
+        edge_count = header + 4 + n_nodes * OSRM_NODE_DTYPE.itemsize
+        if edge_count + 4 > size:
+            continue
+        n_edges = _count_at(raw, edge_count)
+        if edge_count + 4 + n_edges * OSRM_EDGE_DTYPE.itemsize == size:
+            return header + 4, n_nodes, edge_count + 4, n_edges
+    raise ValueError("Can't find the node and edge sections of the"
+                     " OSRM file")
+
+
+def open_osrm(filename):
+    """Memory-map the nodes and edges of an .osrm file
+
+    Returns two read-only structured arrays, with OSRM_NODE_DTYPE and
+    OSRM_EDGE_DTYPE, which are views into the file.
+    """
+    raw = np.memmap(filename, dtype=np.uint8, mode='r')
+    node_start, n_nodes, edge_start, n_edges = _find_sections(raw)
+    log.info("%s has %i nodes and %i edges, after a %i byte header",
+             filename, n_nodes, n_edges, node_start - 4)
+    nodes = raw[node_start:node_start + n_nodes *
+                OSRM_NODE_DTYPE.itemsize].view(OSRM_NODE_DTYPE)
+    edges = raw[edge_start:edge_start + n_edges *
+                OSRM_EDGE_DTYPE.itemsize].view(OSRM_EDGE_DTYPE)
+    return nodes, edges
+
+
+def simplify_edges(source, target, weight, n_vertices):
+    """Drop loops, and keep the fastest of any parallel edges
+
+    The edges are undirected, so each is stored with source < target.
+    Returns the source, target and weight of the simple graph, ordered
+    by source, then target.
+    """
+    low = np.minimum(source, target).astype(np.int64)
+    high = np.maximum(source, target).astype(np.int64)
+    keep = low != high
+    key = low[keep] * n_vertices + high[keep]
+    weight = weight[keep]
+    order = np.lexsort((weight, key))
+    key = key[order]
+    first = np.ones(len(key), dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+    key = key[first]
+    return key // n_vertices, key % n_vertices, weight[order][first]
+
+
+def largest_component(source, target, n_vertices):
+    """Mask of the vertices in the largest connected component"""
+    adjacency = coo_matrix(
+        (np.ones(len(source), dtype=np.int8), (source, target)),
+        shape=(n_vertices, n_vertices))
+    n_components, labels = connected_components(adjacency, directed=False)
+    sizes = np.bincount(labels, minlength=n_components)
+    log.info("%i connected components, the largest with %i of %i nodes",
+             n_components, sizes.max(), n_vertices)
+    return labels == np.argmax(sizes)
+
+
+def osrm_graph(filename, simplify=True, remove_disconnected=True):
+    """Read the road graph from an .osrm file
+
+    Returns the node id, lat and lon of each vertex, the (E, 2) vertex
+    pairs of the edges, and the edge weights.  Edges whose nodes are
+    missing are dropped.
+    """
+    nodes, edges = open_osrm(filename)
+    ids = np.array(nodes['id'], dtype=np.int64)
+    # The extractor writes the nodes sorted by id, but don't rely on it
+    by_id = np.argsort(ids, kind='mergesort')
+    sorted_ids = ids[by_id]
+
+    def vertices(external):
+        position = np.searchsorted(sorted_ids, external)
+        position[position == len(ids)] = 0
+        found = sorted_ids[position] == external
+        return by_id[position], found
+
+    sources = []
+    targets = []
+    weights = []
+    for start in range(0, len(edges), CHUNK_SIZE):
+        chunk = edges[start:start + CHUNK_SIZE]
+        source, source_found = vertices(chunk['source'].astype(np.int64))
+        target, target_found = vertices(chunk['target'].astype(np.int64))
+        found = source_found & target_found
+        weight = np.array(chunk['weight'][found], dtype=np.int64)
+        sources.append(source[found])
+        targets.append(target[found])
+        weights.append(weight)
+    source = np.concatenate(sources) if sources else np.empty(0, int)
+    target = np.concatenate(targets) if targets else np.empty(0, int)
+    weight = np.concatenate(weights) if weights else np.empty(0, int)
+    if simplify:
+        source, target, weight = simplify_edges(
+            source, target, weight, len(ids))
+    log.info("Kept %i edges, dropped %i", len(source),
+             len(edges) - len(source))
+
+    lat = np.array(nodes['lat'], dtype=np.int64)
+    lon = np.array(nodes['lon'], dtype=np.int64)
+    if remove_disconnected:
+        keep = largest_component(source, target, len(ids))
+        new_index = np.cumsum(keep) - 1
+        edge_keep = keep[source]
+        source = new_index[source[edge_keep]]
+        target = new_index[target[edge_keep]]
+        weight = weight[edge_keep]
+        ids, lat, lon = ids[keep], lat[keep], lon[keep]
+
+    return ids, lat, lon, np.column_stack((source, target)), weight
@@ -0,0 +1,172 @@
+'''
+
+Run per-cluster work in parallel, on threads or processes
+
+The nodes are shared with worker processes through shared memory, or
+as they are through the fork for memory-mapped NodeColumns, so only the
+cluster boundaries and the results are pickled.
+
+'''
+
+from concurrent import futures
+import ctypes
+import logging
+import multiprocessing
+
+import numpy as np
+
+from . import metrics
+from .io import NodeColumns, cluster_slices
+
+log = logging.getLogger(__name__)
+
+# State of a worker process, set when the pool starts.
+_worker = {}
+
+
+def _init_worker(function, shared, dtype):
+    """Attach a worker process to the shared nodes
+
+    Without a dtype, the nodes are NodeColumns, passed as they are.
+    """
+    _worker['function'] = function
+    if dtype is None:
+        _worker['nodes'] = shared
+    else:
+        _worker['nodes'] = np.frombuffer(shared, dtype=dtype)
+
+
+def _timed(function, cluster, nodes):
+    """Run the function on one cluster, recording its time"""
+    with metrics.span(function.__name__, cluster):
+        return function(cluster, nodes)
+
+
+def _run_task(task):
+    """Run the function on one cluster in a worker process
+
+    Returns what was recorded in the metrics with the result, to be
+    merged in the parent.
+    """
+    index, cluster, start, stop = task
+    nodes = _worker['nodes'][start:stop]
+    metrics.reset()
+    result = _timed(_worker['function'], cluster, nodes)
+    return index, result, metrics.snapshot()
+
+
+def _init_task_worker(function):
+    """Attach a worker process to the function of map_tasks"""
+    _worker['function'] = function
+
+
+def _run_indexed_task(item):
+    """Run the function on one task of map_tasks in a worker process"""
+    index, task = item
+    metrics.reset()
+    result = _worker['function'](task)
+    return index, result, metrics.snapshot()
+
+
+def share_nodes(nodes):
+    """Copy a node array into shared memory
+
+    Returns the shared buffer.  Child processes forked after this can
+    view it without copying, with np.frombuffer(shared, nodes.dtype).
+    """
+    nodes = np.ascontiguousarray(nodes)
+    shared = multiprocessing.RawArray(ctypes.c_char, max(nodes.nbytes, 1))
+    np.frombuffer(shared, dtype=np.uint8)[:nodes.nbytes] = \
+        nodes.view(np.uint8)
+    return shared
+
+
+def map_clusters(function, nodes, workers=1, processes=False):
+    """Apply function(cluster, nodes) to every cluster of nodes
+
+    The nodes are a structured array or NodeColumns, grouped by cluster
+    as by topotools.io.cluster_slices.  The results are returned as a list,
+    in cluster order.
+
+    With more than one worker, the clusters are spread over a pool of
+    threads, or over a pool of processes if processes is True.  Worker
+    processes are forked, so the function does not need to be
+    picklable, but its results do.  The largest clusters are started
+    first, to keep the workers busy until the end.
+
+    The time taken by each cluster is recorded as a metrics span, named
+    after the function.
+    """
+    tasks = []
+    position = 0
+    for index, (cluster, slice_nodes) in enumerate(cluster_slices(nodes)):
+        tasks.append((index, cluster, position, position + len(slice_nodes)))
+        position += len(slice_nodes)
+
+    if workers <= 1 or len(tasks) <= 1:
+        return [_timed(function, cluster, nodes[start:stop])
+                for _, cluster, start, stop in tasks]
+
+    if not processes:
+        log.info("Spawning %i worker threads", workers)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                lambda task: _timed(function, task[1],
+                                    nodes[task[2]:task[3]]),
+                tasks))
+
+    log.info("Spawning %i worker processes", workers)
+    if isinstance(nodes, NodeColumns):
+        # The workers are forked, so they see the memory-mapped columns
+        # without copying them
+        initargs = (function, nodes, None)
+    else:
+        nodes = np.ascontiguousarray(nodes)
+        initargs = (function, share_nodes(nodes), nodes.dtype)
+    largest_first = sorted(tasks, key=lambda task: task[2] - task[3])
+    results = [None] * len(tasks)
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=initargs)
+    try:
+        for index, result, recorded in pool.imap_unordered(
+                _run_task, largest_first):
+            results[index] = result
+            metrics.merge(recorded)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
+def map_tasks(function, tasks, workers=1, processes=False):
+    """Apply function(task) to every task, like map_clusters
+
+    For work which isn't one cluster of a node array, such as a tile of
+    the map.  Worker processes are forked, so whatever the function
+    needs can be set up beforehand, and is shared copy-on-write.  The
+    results are returned as a list, in task order.
+    """
+    tasks = list(tasks)
+    if workers <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+
+    if not processes:
+        log.info("Spawning %i worker threads", workers)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(function, tasks))
+
+    log.info("Spawning %i worker processes", workers)
+    results = [None] * len(tasks)
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_task_worker, initargs=(function,))
+    try:
+        for index, result, recorded in pool.imap_unordered(
+                _run_indexed_task, enumerate(tasks)):
+            results[index] = result
+            metrics.merge(recorded)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
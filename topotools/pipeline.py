@@ -0,0 +1,434 @@
+'''
+
+Run a chain of scripts with content-addressed caching of their outputs
+
+Each stage runs one script on the outputs of other stages, or on
+external files.  A stage's key is a hash of its script, the topotools
+sources, its arguments and parameters, and the keys (or contents) of its
+inputs.  Its outputs are kept in a directory named by that key, so a
+stage is only rerun when something it depends on has changed, and
+different parameter choices don't overwrite each other.
+
+Stages whose inputs are ready run concurrently, as long as the threads
+they ask for fit in the number of jobs.
+
+'''
+
+import copy
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+log = logging.getLogger(__name__)
+
+# Code which every stage depends on
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Caps on the threads of numerical libraries, set to a stage's threads
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS')
+
+# Content hashes of input files, by (path, size, mtime)
+_file_hashes = {}
+
+
+class Output(object):
+    """Reference to one of the outputs of another stage"""
+
+    def __init__(self, stage, name='output'):
+        self.stage = stage
+        self.name = name
+
+    def __repr__(self):
+        return 'Output(%r, %r)' % (self.stage, self.name)
+
+
+class Stage(object):
+    """One script run in a pipeline
+
+    The inputs map names to either Output references or external
+    paths, and the outputs map names to file names.  The args are
+    formatted with the input paths, the output paths and the params,
+    by name, so '{input}' becomes the path of the input called input.
+
+    threads is the number of jobs the stage takes up while it runs,
+    and the numerical libraries it uses are capped to as many threads.
+    memory (in MB) limits its address space, and timeout (in seconds)
+    its run time.  Ready stages with a higher priority start first.
+    The outputs are linked into link_dir, if it is given, instead of
+    the pipeline's.  The outputs named in optional may be left unwritten.
+    """
+
+    def __init__(self, name, script, inputs, outputs, args, params=None,
+                 threads=1, memory=None, timeout=None, priority=0,
+                 link_dir=None, optional=()):
+        self.name = name
+        self.script = script
+        self.inputs = inputs
+        self.outputs = outputs
+        self.args = args
+        self.params = dict(params or {})
+        self.threads = threads
+        self.memory = memory
+        self.timeout = timeout
+        self.priority = priority
+        self.link_dir = link_dir
+        self.optional = set(optional)
+
+    def dependencies(self):
+        """Names of the stages this stage reads outputs of"""
+        return set(ref.stage for ref in self.inputs.values()
+                   if isinstance(ref, Output))
+
+
+def _hash_path(path, digest):
+    """Add the contents of a file, or all files under a directory"""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                digest.update(os.path.relpath(full, path).encode('utf-8'))
+                _hash_path(full, digest)
+        return
+    with open(path, 'rb') as fd:
+        while True:
+            block = fd.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+
+
+def file_hash(path):
+    """Content hash of a file or directory
+
+    Hashes are remembered for as long as the path's size and
+    modification time don't change.
+    """
+    info = os.stat(path)
+    identity = (os.path.abspath(path), info.st_size, info.st_mtime)
+    if identity not in _file_hashes:
+        digest = hashlib.sha1()
+        _hash_path(path, digest)
+        _file_hashes[identity] = digest.hexdigest()
+    return _file_hashes[identity]
+
+
+def code_hash():
+    """Hash of the topotools sources, which every script imports"""
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(PACKAGE_DIR)):
+        if name.endswith('.py'):
+            digest.update(name.encode('utf-8'))
+            _hash_path(os.path.join(PACKAGE_DIR, name), digest)
+    return digest.hexdigest()
+
+
+def _preexec(memory):
+    """Make a function which limits a child's memory, in MB"""
+    if memory is None:
+        return None
+
+    def limit():
+        import resource
+        size = int(memory) << 20
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+    return limit
+
+
+def _reap(process, block=False):
+    """Collect a child process once it has exited
+
+    Sets its return code, and returns its peak resident memory in MB,
+    or None if it is still running.
+    """
+    pid, status, usage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if not pid:
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    # ru_maxrss is in kB on Linux
+    return usage.ru_maxrss / 1024.
+
+
+def _link(target, link):
+    """Point a symlink at target, unless a real file is in the way"""
+    if os.path.lexists(link):
+        if not os.path.islink(link):
+            log.warning("Not replacing %s, which is not a link", link)
+            return
+        os.remove(link)
+    os.symlink(target, link)
+
+
+class Pipeline(object):
+    """A set of stages, run in dependency order
+
+    root is the directory the scripts are in, and where they run.
+    Stage outputs go to cache_dir/<stage>/<key>/, and are linked into
+    link_dir by their file names, if it is given.  Stage names may
+    contain slashes, as made by prefix_stages, but must be relative
+    paths which stay within cache_dir.
+    """
+
+    def __init__(self, stages, root, cache_dir, link_dir=None):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        if len(self.stages) != len(stages):
+            raise ValueError("Stage names must be unique")
+        for name in self.stages:
+            if os.path.isabs(name) or \
+                    os.pardir in os.path.normpath(name).split(os.sep):
+                raise ValueError("Stage name %s is not a relative path"
+                                 " within the cache" % name)
+        self.root = os.path.abspath(root)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.link_dir = link_dir
+        self.code = code_hash()
+        self.keys = {}
+        for name in self.order():
+            self.keys[name] = self.key(self.stages[name])
+
+    def order(self):
+        """Stage names, with every stage after those it depends on"""
+        ordered = []
+        state = {}
+
+        def visit(name, chain):
+            if state.get(name) == 'done':
+                return
+            if name in chain:
+                raise ValueError("Stages depend on each other: %s" %
+                                 ' -> '.join(chain + [name]))
+            if name not in self.stages:
+                raise KeyError("Unknown stage %s" % name)
+            for dependency in sorted(self.stages[name].dependencies()):
+                visit(dependency, chain + [name])
+            state[name] = 'done'
+            ordered.append(name)
+
+        for name in sorted(self.stages):
+            visit(name, [])
+        return ordered
+
+    def key(self, stage):
+        """Content hash of everything a stage's outputs depend on"""
+        digest = hashlib.sha1()
+        script = os.path.join(self.root, stage.script)
+        if os.path.exists(script):
+            digest.update(file_hash(script).encode('utf-8'))
+        else:
+            digest.update(stage.script.encode('utf-8'))
+        digest.update(self.code.encode('utf-8'))
+        digest.update(repr((stage.args, sorted(stage.params.items()),
+                            sorted(stage.outputs.items()))).encode('utf-8'))
+        for name, ref in sorted(stage.inputs.items()):
+            if isinstance(ref, Output):
+                source = '%s:%s' % (self.keys[ref.stage], ref.name)
+            else:
+                source = file_hash(os.path.join(self.root, ref))
+            digest.update(('%s=%s' % (name, source)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def stage_dir(self, name):
+        return os.path.join(self.cache_dir, name, self.keys[name])
+
+    def output_path(self, ref):
+        stage = self.stages[ref.stage]
+        return os.path.join(self.stage_dir(ref.stage),
+                            stage.outputs[ref.name])
+
+    def is_cached(self, name):
+        return os.path.exists(os.path.join(self.stage_dir(name), '.done'))
+
+    def command(self, stage, output_dir):
+        """The command line of a stage, writing to output_dir"""
+        values = dict(stage.params)
+        for name, ref in stage.inputs.items():
+            if isinstance(ref, Output):
+                values[name] = self.output_path(ref)
+            else:
+                values[name] = os.path.join(self.root, ref)
+        for name, filename in stage.outputs.items():
+            values[name] = os.path.join(output_dir, filename)
+        script = os.path.join(self.root, stage.script)
+        return [script] + [str(arg).format(**values) for arg in stage.args]
+
+    def start(self, name):
+        """Start a stage in a temporary directory"""
+        stage = self.stages[name]
+        temp_dir = '%s.%i.tmp' % (self.stage_dir(name), os.getpid())
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir)
+        command = self.command(stage, temp_dir)
+        log.info("Starting %s: %s", name, ' '.join(command))
+        logfile = open(os.path.join(temp_dir, 'log.txt'), 'w')
+        env = dict(os.environ)
+        for variable in THREAD_VARIABLES:
+            env[variable] = str(stage.threads)
+        process = subprocess.Popen(
+            command, cwd=self.root, stdout=logfile,
+            stderr=subprocess.STDOUT, preexec_fn=_preexec(stage.memory),
+            env=env)
+        logfile.close()
+        return process, temp_dir, time.time()
+
+    def finish(self, name, temp_dir):
+        """Move a finished stage's outputs into the cache"""
+        stage = self.stages[name]
+        for output, filename in stage.outputs.items():
+            if output in stage.optional:
+                continue
+            if not os.path.exists(os.path.join(temp_dir, filename)):
+                raise IOError("Stage %s did not write %s" % (name, filename))
+        open(os.path.join(temp_dir, '.done'), 'w').close()
+        final_dir = self.stage_dir(name)
+        if os.path.exists(final_dir):
+            shutil.rmtree(final_dir)
+        os.rename(temp_dir, final_dir)
+
+    def link(self, name):
+        """Link a stage's outputs into its link directory"""
+        link_dir = self.stages[name].link_dir or self.link_dir
+        if link_dir is None:
+            return
+        try:
+            os.makedirs(link_dir)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        for filename in self.stages[name].outputs.values():
+            target = os.path.join(self.stage_dir(name), filename)
+            link = os.path.join(link_dir, filename)
+            if not os.path.exists(target):
+                # An optional output this run didn't write; don't leave
+                # a link to an older run's
+                if os.path.islink(link):
+                    os.remove(link)
+                continue
+            _link(target, link)
+
+    def run(self, targets=None, jobs=1, poll=0.5, keep_going=False):
+        """Run the targets, and every stage they need
+
+        Ready stages are started by priority, highest first, and then in
+        dependency order.  Returns a dict mapping each stage name to its
+        run time, or None if it came from the cache.  The start and end
+        times of each run are kept in spans, and the peak resident
+        memory of its process, in MB, in peak_rss.
+
+        Raises RuntimeError if a stage fails, unless keep_going is set,
+        in which case the stages which depend on it are skipped, and the
+        failed and skipped stages are kept in failed.
+        """
+        if targets is None:
+            targets = list(self.stages)
+        needed = set()
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].dependencies())
+        order = [name for name in self.order() if name in needed]
+
+        timings = {}
+        self.spans = {}
+        self.peak_rss = {}
+        self.failed = set()
+        done = set()
+        for name in order:
+            if self.is_cached(name):
+                log.info("Using cached %s (%s)", name, self.keys[name][:12])
+                timings[name] = None
+                done.add(name)
+                self.link(name)
+        position = dict((name, idx) for idx, name in enumerate(order))
+        waiting = sorted((name for name in order if name not in done),
+                         key=lambda x: (-self.stages[x].priority,
+                                        position[x]))
+
+        running = {}
+        try:
+            while waiting or running:
+                busy = sum(self.stages[name].threads for name in running)
+                for name in list(waiting):
+                    stage = self.stages[name]
+                    if stage.dependencies() & self.failed:
+                        log.warning("Skipping %s", name)
+                        self.failed.add(name)
+                        waiting.remove(name)
+                        continue
+                    if not stage.dependencies() <= done:
+                        continue
+                    # A stage bigger than all the jobs runs on its own.
+                    if running and busy + stage.threads > jobs:
+                        continue
+                    running[name] = self.start(name)
+                    busy += stage.threads
+                    waiting.remove(name)
+
+                time.sleep(poll)
+                for name, (process, temp_dir, start) in list(running.items()):
+                    stage = self.stages[name]
+                    elapsed = time.time() - start
+                    peak = _reap(process)
+                    if peak is None:
+                        if stage.timeout and elapsed > stage.timeout:
+                            log.error("Stage %s took more than %gs, killing",
+                                      name, stage.timeout)
+                            process.kill()
+                            peak = _reap(process, block=True)
+                        else:
+                            continue
+                    del running[name]
+                    self.spans[name] = (start, start + elapsed)
+                    self.peak_rss[name] = peak
+                    if process.returncode != 0:
+                        message = "Stage %s failed with code %i, see %s" % (
+                            name, process.returncode,
+                            os.path.join(temp_dir, 'log.txt'))
+                        if not keep_going:
+                            raise RuntimeError(message)
+                        log.error(message)
+                        self.failed.add(name)
+                        continue
+                    self.finish(name, temp_dir)
+                    log.info("Finished %s in %0.1fs", name, elapsed)
+                    timings[name] = elapsed
+                    done.add(name)
+                    self.link(name)
+        finally:
+            for process, _, _ in running.values():
+                process.kill()
+        return timings
+
+
+def prefix_stages(stages, prefix, link_dir=None):
+    """Rename stages, and their references to each other, with a prefix
+
+    This lets the stages of several runs of a workflow go in one
+    Pipeline.  The outputs of the renamed stages are linked into
+    link_dir, if it is given.
+    """
+    renamed = []
+    for stage in stages:
+        inputs = {}
+        for name, ref in stage.inputs.items():
+            if isinstance(ref, Output):
+                ref = Output(prefix + ref.stage, ref.name)
+            inputs[name] = ref
+        stage = copy.copy(stage)
+        stage.name = prefix + stage.name
+        stage.inputs = inputs
+        stage.params = dict(stage.params)
+        if link_dir is not None:
+            stage.link_dir = link_dir
+        renamed.append(stage)
+    return renamed
@@ -0,0 +1,188 @@
+'''
+
+Vectorized geometry tests of many points against one polygon
+
+These replace per-point Shapely calls, which dominate the run time
+of the stages that touch every node.
+
+'''
+
+import logging
+
+import numpy as np
+from shapely.geometry import MultiPolygon
+
+log = logging.getLogger(__name__)
+
+
+def polygon_rings(polygon):
+    """List the rings of a Shapely (Multi)Polygon as coordinate arrays"""
+    if isinstance(polygon, MultiPolygon):
+        parts = list(polygon.geoms)
+    else:
+        parts = [polygon]
+    rings = []
+    for part in parts:
+        if part.is_empty:
+            continue
+        rings.append(np.asarray(part.exterior.coords)[:, :2])
+        rings.extend(np.asarray(interior.coords)[:, :2]
+                     for interior in part.interiors)
+    return rings
+
+
+def ring_segments(rings):
+    """Stack the segments of closed rings into start and end arrays"""
+    if not rings:
+        empty = np.empty((0, 2), dtype=float)
+        return empty, empty
+    starts = np.concatenate([ring[:-1] for ring in rings])
+    ends = np.concatenate([ring[1:] for ring in rings])
+    return starts.astype(float), ends.astype(float)
+
+
+def points_in_polygon(points, polygon, max_pairs=1 << 22):
+    """Find which points lie inside a Shapely (Multi)Polygon
+
+    Uses the even-odd ray casting rule over all rings at once.  The
+    points are sorted by y, so each segment is only tested against the
+    points within its y range, which are a contiguous block.  At most
+    max_pairs segment/point pairs are tested at a time.
+
+    Returns a boolean mask.
+    """
+    points = np.asarray(points, dtype=float)
+    inside = np.zeros(len(points), dtype=bool)
+    starts, ends = ring_segments(polygon_rings(polygon))
+    if not len(points) or not len(starts):
+        return inside
+
+    order = np.argsort(points[:, 1], kind='mergesort')
+    xs = points[order, 0]
+    ys = points[order, 1]
+
+    # A ray cast in +x from the point crosses a segment if the point
+    # lies in the half-open y range of the segment, and to the left of
+    # the segment at that y.
+    low = np.minimum(starts[:, 1], ends[:, 1])
+    high = np.maximum(starts[:, 1], ends[:, 1])
+    first = np.searchsorted(ys, low, side='left')
+    last = np.searchsorted(ys, high, side='left')
+    counts = last - first
+    # Horizontal segments, and those with no points in range, never cross.
+    useful = np.flatnonzero(counts)
+    crossings = np.zeros(len(points), dtype=np.int64)
+
+    cumulative = np.cumsum(counts[useful])
+    chunk_start = 0
+    while chunk_start < len(useful):
+        # Take as many segments as fit in max_pairs, but at least one.
+        done = cumulative[chunk_start - 1] if chunk_start else 0
+        chunk_stop = max(chunk_start + 1, np.searchsorted(
+            cumulative, done + max_pairs, side='right'))
+        segments = useful[chunk_start:chunk_stop]
+        chunk_start = chunk_stop
+
+        n_pairs = counts[segments]
+        pair_segment = np.repeat(segments, n_pairs)
+        # Position of each pair within its segment's block of points
+        pair_offset = (np.arange(n_pairs.sum()) -
+                       np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs))
+        pair_point = first[pair_segment] + pair_offset
+
+        x1 = starts[pair_segment, 0]
+        y1 = starts[pair_segment, 1]
+        x2 = ends[pair_segment, 0]
+        y2 = ends[pair_segment, 1]
+        x_cross = x1 + (ys[pair_point] - y1) * (x2 - x1) / (y2 - y1)
+        crossed = pair_point[xs[pair_point] < x_cross]
+        crossings += np.bincount(crossed, minlength=len(points))
+
+    inside[order] = crossings % 2 == 1
+    return inside
+
+
+def _segment_distances(points, starts, ends):
+    """Distance from each point to the matching segment"""
+    direction = ends - starts
+    length2 = (direction ** 2).sum(axis=1)
+    offset = points - starts
+    # Fraction along the segment of the closest point, zero for
+    # degenerate segments.
+    fraction = np.zeros(len(points))
+    nonzero = length2 > 0
+    fraction[nonzero] = (offset[nonzero] * direction[nonzero]).sum(axis=1) \
+        / length2[nonzero]
+    fraction = np.clip(fraction, 0, 1)
+    closest = starts + fraction[:, np.newaxis] * direction
+    return np.hypot(points[:, 0] - closest[:, 0],
+                    points[:, 1] - closest[:, 1])
+
+
+def distance_to_boundary(points, polygon, max_distance, max_pairs=1 << 22):
+    """Find the distance from each point to the boundary of a polygon
+
+    Only distances below max_distance are computed; the others are
+    returned as inf.  The boundary segments are indexed on a grid with
+    cells of size max_distance, each segment being listed in every
+    cell within max_distance of it, so each point is only compared to
+    the segments listed in its own cell.  At most max_pairs
+    point/segment pairs are compared at a time.
+    """
+    points = np.asarray(points, dtype=float)
+    distances = np.empty(len(points))
+    distances.fill(np.inf)
+    starts, ends = ring_segments(polygon_rings(polygon))
+    if not len(points) or not len(starts) or max_distance <= 0:
+        return distances
+
+    cell = float(max_distance)
+    lower = np.minimum(starts, ends)
+    upper = np.maximum(starts, ends)
+    origin = lower.min(axis=0) - cell
+    low = ((lower - cell - origin) // cell).astype(np.int64)
+    high = ((upper + cell - origin) // cell).astype(np.int64)
+    width = high[:, 0] - low[:, 0] + 1
+    n_cells = width * (high[:, 1] - low[:, 1] + 1)
+    stride = high[:, 1].max() + 1
+
+    # List each segment in every cell it is registered in
+    cell_segment = np.repeat(np.arange(len(starts)), n_cells)
+    position = (np.arange(n_cells.sum()) -
+                np.repeat(np.cumsum(n_cells) - n_cells, n_cells))
+    cell_x = low[cell_segment, 0] + position % width[cell_segment]
+    cell_y = low[cell_segment, 1] + position // width[cell_segment]
+    cell_keys = cell_x * stride + cell_y
+    order = np.argsort(cell_keys, kind='mergesort')
+    cell_keys = cell_keys[order]
+    cell_segment = cell_segment[order]
+
+    point_cells = ((points - origin) // cell).astype(np.int64)
+    point_keys = point_cells[:, 0] * stride + point_cells[:, 1]
+    first = np.searchsorted(cell_keys, point_keys, side='left')
+    last = np.searchsorted(cell_keys, point_keys, side='right')
+    # Points off the grid have no segments nearby.
+    off_grid = ((point_cells[:, 1] < 0) | (point_cells[:, 1] >= stride) |
+                (point_cells[:, 0] < 0))
+    last[off_grid] = first[off_grid]
+    counts = last - first
+
+    cumulative = np.cumsum(counts)
+    chunk_start = 0
+    while chunk_start < len(points):
+        done = cumulative[chunk_start - 1] if chunk_start else 0
+        chunk_stop = max(chunk_start + 1, np.searchsorted(
+            cumulative, done + max_pairs, side='right'))
+        chunk = np.arange(chunk_start, min(chunk_stop, len(points)))
+        chunk_start = chunk_stop
+
+        n_pairs = counts[chunk]
+        pair_point = np.repeat(chunk, n_pairs)
+        pair_offset = (np.arange(n_pairs.sum()) -
+                       np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs))
+        pair_segment = cell_segment[first[pair_point] + pair_offset]
+        np.minimum.at(distances, pair_point, _segment_distances(
+            points[pair_point], starts[pair_segment], ends[pair_segment]))
+
+    distances[distances >= max_distance] = np.inf
+    return distances
@@ -0,0 +1,177 @@
+'''
+
+Reproducible synthetic road networks, for tests and benchmarks
+
+A network is a set of towns, with sizes spread like real city sizes,
+joined by highways.  Each town is a street grid, dense in the middle
+and stretched out into suburbs.  Every few streets is an arterial,
+which is faster and always connected.  Side streets in one direction
+are thinned out towards the edge of town, leaving dead ends, as in
+suburban developments.
+
+Coordinates are integers in 1e-5 degrees, like the OSRM nodes, and edge
+weights are travel times in tenths of a second.
+
+'''
+
+from collections import namedtuple
+import logging
+
+import numpy as np
+
+from .io import NODE_DTYPE
+
+log = logging.getLogger(__name__)
+
+RoadNetwork = namedtuple(
+    'RoadNetwork', ['lat', 'lon', 'edges', 'weights', 'clusters'])
+
+# Roughly Los Angeles, in 1e-5 degrees
+ORIGIN = (3405000, -11825000)
+# About 100m between streets in the middle of town, in 1e-5 degrees
+BLOCK = 90
+# Speeds, in 1e-5 degrees (about 1.1m) per tenth of a second: about
+# 40, 70 and 110 km/h
+STREET_SPEED = 1.
+ARTERIAL_SPEED = 1.8
+HIGHWAY_SPEED = 2.8
+
+
+def _town_sizes(n_nodes, n_towns, rng):
+    """Split n_nodes between towns, with a Zipf-like spread of sizes"""
+    weights = 1. / np.arange(1, n_towns + 1) ** 1.1
+    weights *= rng.uniform(0.7, 1.3, n_towns)
+    sizes = np.floor(weights / weights.sum() * n_nodes).astype(np.int64)
+    sizes[0] += n_nodes - sizes.sum()
+    return sizes
+
+
+def _grid_town(size, center, arterial, neighborhood, rng):
+    """Lay out one town as a stretched grid of about size nodes
+
+    Returns the node coordinates, the edges as index pairs, whether each
+    edge is an arterial, and a neighborhood label for each node.
+    """
+    cols = max(int(np.sqrt(size)), 2)
+    rows = max(size // cols, 2)
+    row, col = np.divmod(np.arange(rows * cols), cols)
+
+    # Distance from the middle of town, in blocks, then stretched so
+    # that blocks get longer towards the suburbs.
+    y = row - (rows - 1) / 2.
+    x = col - (cols - 1) / 2.
+    radius = np.hypot(x, y) / max(rows, cols)
+    stretch = BLOCK * (1 + 2 * radius ** 2)
+    lat = center[0] + y * stretch + rng.normal(0, BLOCK * 0.15, len(row))
+    lon = center[1] + x * stretch * 1.2 + \
+        rng.normal(0, BLOCK * 0.15, len(row))
+
+    index = np.arange(rows * cols).reshape((rows, cols))
+    # Every street along a row is kept, and streets across rows are kept
+    # on arterials, and otherwise thinned out towards the edges of town.
+    along = np.column_stack((index[:, :-1].ravel(), index[:, 1:].ravel()))
+    along_arterial = (row[along[:, 0]] % arterial) == 0
+    across = np.column_stack((index[:-1, :].ravel(), index[1:, :].ravel()))
+    across_arterial = (col[across[:, 0]] % arterial) == 0
+    keep = across_arterial | (
+        rng.uniform(size=len(across)) > 0.6 * radius[across[:, 0]])
+    edges = np.vstack((along, across[keep]))
+    is_arterial = np.concatenate((along_arterial, across_arterial[keep]))
+
+    hood_cols = (cols - 1) // neighborhood + 1
+    hoods = (row // neighborhood) * hood_cols + col // neighborhood
+    coords = np.column_stack((lat, lon)).round().astype(np.int64)
+    return coords, edges, is_arterial, hoods
+
+
+def _highways(centers, rng):
+    """Join towns with a spanning tree of their nearest neighbors
+
+    Returns (N, 2) pairs of town indices, each pair once, smaller town
+    index first.  Each town is joined to the nearest of the towns before
+    it, which are mostly bigger, plus a few random extra links.
+    """
+    pairs = []
+    for town in range(1, len(centers)):
+        distance = np.hypot(*(centers[:town] - centers[town]).T)
+        pairs.append((town, int(np.argmin(distance))))
+    extra = max(len(centers) // 4, 0)
+    for _ in range(extra):
+        a, b = rng.choice(len(centers), 2, replace=False)
+        pairs.append((int(a), int(b)))
+    # The random links can repeat each other, or the tree's
+    pairs = np.sort(np.array(pairs, dtype=np.int64).reshape((-1, 2)), axis=1)
+    keys = np.unique(pairs[:, 0] * len(centers) + pairs[:, 1])
+    return np.column_stack((keys // len(centers), keys % len(centers)))
+
+
+def road_network(n_nodes, seed=1, n_towns=None, arterial=8,
+                 neighborhood=24):
+    """Make a synthetic road network with about n_nodes nodes
+
+    The same seed always gives the same network.  Towns have arterials
+    every arterial streets, and the true cluster of each node is its
+    neighborhood, a square of neighborhood by neighborhood blocks.
+
+    Returns a RoadNetwork of node coordinates, (E, 2) edges, edge
+    weights and node clusters.
+    """
+    rng = np.random.RandomState(seed)
+    if n_towns is None:
+        n_towns = max(1, int(np.sqrt(n_nodes / 20000.)))
+    sizes = _town_sizes(n_nodes, n_towns, rng)
+
+    # Spread the towns over a square area, which grows with the network
+    extent = BLOCK * np.sqrt(n_nodes) * 3
+    centers = np.array(ORIGIN) + rng.uniform(-extent, extent, (n_towns, 2))
+    centers[0] = ORIGIN
+
+    coords = []
+    edges = []
+    arterials = []
+    clusters = []
+    town_start = []
+    offset = 0
+    cluster_offset = 0
+    for size, center in zip(sizes, centers):
+        town_coords, town_edges, is_arterial, hoods = _grid_town(
+            size, center, arterial, neighborhood, rng)
+        coords.append(town_coords)
+        edges.append(town_edges + offset)
+        arterials.append(is_arterial)
+        clusters.append(hoods + cluster_offset)
+        town_start.append(offset)
+        offset += len(town_coords)
+        cluster_offset += hoods.max() + 1
+
+    # Highways join the nodes nearest to each town's center
+    coords = np.vstack(coords)
+    town_start = np.array(town_start)
+    town_center_node = town_start + np.array(
+        [len(c) // 2 for c in clusters])
+    highways = np.array([(town_center_node[a], town_center_node[b])
+                         for a, b in _highways(centers, rng)],
+                        dtype=np.int64).reshape((-1, 2))
+
+    edges = np.vstack(edges + [highways])
+    speed = np.concatenate(
+        [np.where(np.concatenate(arterials), ARTERIAL_SPEED, STREET_SPEED),
+         np.repeat(HIGHWAY_SPEED, len(highways))])
+    delta = coords[edges[:, 1]] - coords[edges[:, 0]]
+    length = np.hypot(delta[:, 0], delta[:, 1])
+    weights = np.maximum(np.round(length / speed), 1).astype(np.int64)
+
+    log.info("Made %i nodes and %i edges in %i towns",
+             len(coords), len(edges), n_towns)
+    return RoadNetwork(coords[:, 0], coords[:, 1], edges, weights,
+                       np.concatenate(clusters))
+
+
+def network_nodes(network):
+    """The nodes of a network as a structured array, by cluster"""
+    nodes = np.empty(len(network.lat), dtype=NODE_DTYPE)
+    nodes['id'] = np.arange(1, len(network.lat) + 1)
+    nodes['lat'] = network.lat
+    nodes['lon'] = network.lon
+    nodes['clust'] = network.clusters
+    return nodes[np.argsort(network.clusters, kind='mergesort')]
@@ -0,0 +1,132 @@
+'''
+
+Trim long pokey tails off concave hulls
+
+Tails are long, thin, features which are created when a community
+goes down a road away from the main group.  A tail is found as a pair
+of outline vertices which are close together as the crow flies, but
+far apart along the outline.
+
+'''
+
+import logging
+import math
+
+import numpy as np
+from scipy.spatial import cKDTree
+from shapely.geometry import Polygon
+
+from . import metrics
+from .hulls import shoelace_area
+
+log = logging.getLogger(__name__)
+
+
+def _arc_lengths(ring):
+    """Distance along a closed ring to each vertex, and its total length"""
+    steps = np.diff(np.vstack((ring, ring[:1])), axis=0)
+    steps = np.hypot(steps[:, 0], steps[:, 1])
+    return np.append(0, np.cumsum(steps[:-1])), steps.sum()
+
+
+def _close_pairs(ring, radius):
+    """Find all pairs of distinct vertices within radius of each other
+
+    Returns the (i, j) pairs, with i < j, and their distances.
+    """
+    pairs = np.array(sorted(cKDTree(ring).query_pairs(radius)),
+                     dtype=np.intp).reshape((-1, 2))
+    delta = ring[pairs[:, 1]] - ring[pairs[:, 0]]
+    crow = np.hypot(delta[:, 0], delta[:, 1])
+    distinct = crow > 0
+    return pairs[distinct], crow[distinct]
+
+
+def find_tail(ring, pairs, crow, tail_length):
+    """Find the biggest tail between pairs of close vertices
+
+    A pair bounds a tail if the distance between them along the outline
+    (the shorter way around) is more than tail_length times the
+    distance as the crow flies.  The biggest tail is the one with the
+    largest length^2/width.
+
+    Returns the pair and its length^2/width, or None if there are no
+    tails.
+    """
+    arc, length = _arc_lengths(ring)
+    along = np.abs(arc[pairs[:, 1]] - arc[pairs[:, 0]])
+    along = np.minimum(along, length - along)
+    tailiness = along / crow
+    tails = np.flatnonzero(tailiness > tail_length)
+    if not len(tails):
+        return None
+    metric = tailiness[tails] * along[tails]
+    best = tails[np.argmax(metric)]
+    return pairs[best], metric.max()
+
+
+def trim_tails(shape, tail_pinch, tail_length):
+    """Repeatedly clip the biggest tail off a polygon
+
+    Pairs of vertices closer than tail_pinch times the characteristic
+    size (the square root of the area) are candidates for a tail's
+    pinch point.  The polygon is cut at the pinch of the biggest tail,
+    and the larger of the two pieces is kept, until there are no tails
+    left.
+
+    The close pairs are found once.  Each clip keeps a contiguous run
+    of the outline, so the pairs among the kept vertices carry over,
+    and only need to be found again if the pinch radius grows.
+
+    Returns the trimmed polygon and the number of clips.
+    """
+    ring = np.asarray(shape.exterior.coords)[:-1, :2]
+    metrics.count('tails.outline_vertices', len(ring))
+    original_area = area = shape.area
+    original_length = shape.exterior.length
+    radius = math.sqrt(area) * tail_pinch
+    pairs, crow = _close_pairs(ring, radius)
+
+    clips = 0
+    while True:
+        tail = find_tail(ring, pairs, crow, tail_length)
+        if tail is None:
+            break
+        (min_idx, max_idx), metric = tail
+        log.info("Clipping tail with length^2/width %f from %i -> %i,"
+                 " out of %i edges", metric, min_idx, max_idx, len(ring))
+        clips += 1
+
+        # Now create two hypotheses for what to delete.
+        hypo_1 = np.arange(min_idx, max_idx + 1)
+        hypo_2 = np.append(np.arange(min_idx + 1),
+                           np.arange(max_idx, len(ring)))
+        area_1 = abs(shoelace_area(ring[hypo_1]))
+        area_2 = abs(shoelace_area(ring[hypo_2]))
+        keep, area = (hypo_1, area_1) if area_1 >= area_2 else \
+            (hypo_2, area_2)
+
+        new_index = np.empty(len(ring), dtype=np.intp)
+        new_index.fill(-1)
+        new_index[keep] = np.arange(len(keep))
+        ring = ring[keep]
+
+        new_radius = math.sqrt(area) * tail_pinch
+        if new_radius > radius:
+            pairs, crow = _close_pairs(ring, new_radius)
+        else:
+            pairs = new_index[pairs]
+            kept = (pairs >= 0).all(axis=1) & (crow <= new_radius)
+            pairs = pairs[kept]
+            crow = crow[kept]
+        radius = new_radius
+
+    metrics.count('tails.clips', clips)
+    if not clips:
+        return shape, 0
+    trimmed = Polygon(ring)
+    log.info("Found new hull with %0.2f of the original area "
+             "and %0.2f of the original length after %i clips",
+             trimmed.area / original_area,
+             trimmed.exterior.length / original_length, clips)
+    return trimmed, clips
@@ -0,0 +1,197 @@
+'''
+
+Split the map into tiles, to work on big extracts piece by piece
+
+The nodes' bounding box is cut into a grid of square tiles.  Each
+cluster is owned by the tile its centroid falls in, and a tile's work
+covers the whole of every cluster it owns, plus any other nodes within
+a halo around them, for context.  Only the results for the owned
+clusters are kept, so every cluster's result comes from exactly one
+tile, and the tiles can be worked on independently.
+
+The halo has to be wide enough that the nodes outside it can't change
+the results for the owned clusters.  For Voronoi cells, it has to be
+wider than the cells at the edge of the tile: a few times the spacing of
+the nodes is plenty where they are dense, but not across big empty
+areas like lakes, where the cells are big.  exact_cells checks this, so
+tiles whose halo is too narrow can be redone with a wider one.  It only
+needs the points beyond the halo where a cell could reach them, so no
+tile needs all of the points at once.
+
+'''
+
+from collections import namedtuple
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+log = logging.getLogger(__name__)
+
+Tile = namedtuple('Tile', ['index', 'bounds', 'clusters'])
+
+
+class Tiling(object):
+    """A grid of square tiles of side tile_size over some points"""
+
+    def __init__(self, lon, lat, tile_size, halo=0.):
+        self.tile_size = float(tile_size)
+        self.halo = float(halo)
+        self.origin = (np.min(lon), np.min(lat))
+        self.shape = (
+            int((np.max(lon) - self.origin[0]) // self.tile_size) + 1,
+            int((np.max(lat) - self.origin[1]) // self.tile_size) + 1)
+        log.info("Tiling %i by %i tiles of %g", self.shape[0],
+                 self.shape[1], self.tile_size)
+
+    def tile_of(self, lon, lat):
+        """The index of the tile each point falls in"""
+        column = ((np.asarray(lon) - self.origin[0]) //
+                  self.tile_size).astype(np.int64)
+        row = ((np.asarray(lat) - self.origin[1]) //
+               self.tile_size).astype(np.int64)
+        column = np.clip(column, 0, self.shape[0] - 1)
+        row = np.clip(row, 0, self.shape[1] - 1)
+        return row * self.shape[0] + column
+
+    def bounds(self, index, halo=None):
+        """(minx, miny, maxx, maxy) of a grid square, grown by the halo"""
+        if halo is None:
+            halo = self.halo
+        row, column = divmod(index, self.shape[0])
+        minx = self.origin[0] + column * self.tile_size
+        miny = self.origin[1] + row * self.tile_size
+        return (minx - halo, miny - halo, minx + self.tile_size + halo,
+                miny + self.tile_size + halo)
+
+    def tiles(self, lon, lat, clusters):
+        """The tiles which own at least one cluster
+
+        Each cluster is owned by the tile of the centroid of its points.
+        Returns a list of Tile, with the clusters each one owns, in
+        order.  The bounds of each tile are grown to cover all of the
+        points of its clusters, but not the halo.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        clusters, inverse = np.unique(clusters, return_inverse=True)
+        counts = np.bincount(inverse).astype(float)
+        centroids = np.array([np.bincount(inverse, weights=lon) / counts,
+                              np.bincount(inverse, weights=lat) / counts])
+
+        # The extent of each cluster
+        extents = np.empty((4, len(clusters)))
+        extents[:2] = np.inf
+        extents[2:] = -np.inf
+        np.minimum.at(extents[0], inverse, lon)
+        np.minimum.at(extents[1], inverse, lat)
+        np.maximum.at(extents[2], inverse, lon)
+        np.maximum.at(extents[3], inverse, lat)
+        return self.cluster_tiles(clusters, centroids, extents)
+
+    def cluster_tiles(self, clusters, centroids, extents):
+        """The tiles which own the clusters, like tiles
+
+        For when the clusters have been summarized already, without
+        having all of their points at once.  The centroids are a (2, N)
+        array of their lon and lat, and the extents a (4, N) array of
+        their (minx, miny, maxx, maxy).
+        """
+        clusters = np.asarray(clusters)
+        extents = np.asarray(extents, dtype=float)
+        owners = self.tile_of(centroids[0], centroids[1])
+
+        order = np.argsort(owners, kind='mergesort')
+        starts = np.append(0, np.flatnonzero(np.diff(owners[order])) + 1)
+        stops = np.append(starts[1:], len(order))
+        tiles = []
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            owned = order[start:stop]
+            index = int(owners[owned[0]])
+            minx, miny, maxx, maxy = self.bounds(index, halo=0.)
+            bounds = (min(minx, extents[0, owned].min()),
+                      min(miny, extents[1, owned].min()),
+                      max(maxx, extents[2, owned].max()),
+                      max(maxy, extents[3, owned].max()))
+            tiles.append(Tile(index, bounds, clusters[owned].tolist()))
+        log.info("%i clusters are owned by %i tiles",
+                 len(clusters), len(tiles))
+        return tiles
+
+    def tile_mask(self, lon, lat, tile, halo=None):
+        """Mask of the points a tile works on
+
+        These are the points within its bounds, which cover all of the
+        points of the clusters it owns, grown by the halo.
+        """
+        if halo is None:
+            halo = self.halo
+        return within(lon, lat, grow(tile.bounds, halo))
+
+
+def _vertices(polygon):
+    """The coordinates of all of the rings of a (multi) polygon"""
+    coords = []
+    for part in getattr(polygon, 'geoms', [polygon]):
+        if part.is_empty:
+            continue
+        coords.extend(part.exterior.coords)
+        for interior in part.interiors:
+            coords.extend(interior.coords)
+    return coords
+
+
+def grow(bounds, margin):
+    """(minx, miny, maxx, maxy) bounds grown by a margin"""
+    minx, miny, maxx, maxy = bounds
+    return (minx - margin, miny - margin, maxx + margin, maxy + margin)
+
+
+def within(lon, lat, bounds):
+    """Mask of the points within (minx, miny, maxx, maxy) bounds"""
+    minx, miny, maxx, maxy = bounds
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    return (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+
+
+def overlaps(bounds, other):
+    """Whether two (minx, miny, maxx, maxy) bounds overlap"""
+    return (bounds[0] <= other[2] and other[0] <= bounds[2] and
+            bounds[1] <= other[3] and other[1] <= bounds[3])
+
+
+def exact_cells(polygons, points, bounds, points_within):
+    """Whether unions of Voronoi cells are the same as with all points
+
+    The polygons are made from the cells of only the given points, which
+    are all of the points within bounds.  A point left out would take
+    the part of a cell closer to it than to the cell's own point, which
+    is cut off by a straight line, so it takes a vertex of the polygon
+    too.  So the polygons are exact if no point left out is closer to
+    any of their vertices than the given points are.
+
+    Only vertices whose nearest given point is further away than the
+    edge of the bounds can have a closer point left out.  For those,
+    points_within(bounds) is called, to get the (N, 2) array of all
+    points within reach of them.
+    """
+    vertices = [xy for polygon in polygons for xy in _vertices(polygon)]
+    if not vertices:
+        return True
+    vertices = np.array(vertices, dtype=float)
+    given = cKDTree(points).query(vertices)[0]
+    low = vertices - given[:, np.newaxis]
+    high = vertices + given[:, np.newaxis]
+    outside = ((low[:, 0] < bounds[0]) | (low[:, 1] < bounds[1]) |
+               (high[:, 0] > bounds[2]) | (high[:, 1] > bounds[3]))
+    if not outside.any():
+        return True
+    reach = tuple(low[outside].min(axis=0)) + \
+        tuple(high[outside].max(axis=0))
+    others = points_within(reach)
+    if not len(others):
+        return True
+    nearest = cKDTree(others).query(vertices[outside])[0]
+    # Allow for rounding in the vertices
+    return bool(np.all(nearest >= given[outside] * (1 - 1e-9)))
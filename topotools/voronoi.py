@@ -7,15 +7,19 @@ from descartes import PolygonPatch
 import numpy as np
 from scipy.spatial import Voronoi, voronoi_plot_2d
 from shapely.prepared import prep
-from shapely.geometry import Point
+from shapely.geometry import MultiPolygon, Point, Polygon
+from shapely.ops import cascaded_union
 import matplotlib.pyplot as plt
 
-from .hulls import get_concave_hull, get_convex_hull
+from . import metrics
+from .hulls import boundary_rings, get_concave_hull, get_convex_hull
+from .polygons import points_in_polygon
 
 log = logging.getLogger(__name__)
 
 
-def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
+def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None,
+                         random_state=None):
     """ Takes as input a list of points
 
     First computes the concave hull and removes
@@ -24,11 +28,17 @@ def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
     Then remove all those points completely contained.
     In other words, only return those which are on
     the boundary of the hull.
+
+    The points kept at random are drawn from random_state, a
+    random.Random, if it is given, or else the random module.
     """
+    if random_state is None:
+        random_state = random
 
     nodes_list = list(nodes)
 
     log.info("Pruning %i nodes", len(nodes_list))
+    metrics.count('prune.nodes_in', len(nodes_list))
 
     points = np.array([(x.lon, x.lat) for x in nodes_list], dtype=float)
 
@@ -39,15 +49,16 @@ def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
         hull = get_convex_hull(points)
     # buffer hull by about 5% for determining membership
     hull_distance_scale = math.sqrt(hull.area)
-    buffered_hull = prep(hull.buffer(hull_distance_scale * 0.05))
+    buffered_hull = hull.buffer(hull_distance_scale * 0.05)
     hull_boundary = hull.boundary
 
     # Remove any outlier points around these nodes.
     # Mark the good nodes.
     nodes_in_hull = []
     nodes_outside_hull = []
-    for point, node in itertools.izip(points, nodes_list):
-        if buffered_hull.contains(Point(point)):
+    inside = points_in_polygon(points, buffered_hull)
+    for good, node in itertools.izip(inside, nodes_list):
+        if good:
             nodes_in_hull.append(node)
         else:
             nodes_outside_hull.append(node)
@@ -68,7 +79,7 @@ def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
     for region_idx, region in enumerate(voronoi.regions):
         exterior_region = False
         # keep a random collection of interior points
-        if random.random() < keep:
+        if random_state.random() < keep:
             exterior_region = True
         else:
             for vtx_idx in region:
@@ -82,7 +93,7 @@ def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
                         exterior_region = True
                         break
                     # Keep 20% of points very close to the border
-                    if random.random() < 0.2 and (
+                    if random_state.random() < 0.2 and (
                             point.distance(hull_boundary)
                             < hull_distance_scale * 0.03):
                         exterior_region = True
@@ -99,6 +110,7 @@ def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
             output.append(node)
 
     log.info("There are %i nodes after pruning", len(output))
+    metrics.count('prune.nodes_out', len(output))
 
     if draw is not None:
         log.info("Drawing prune plot")
@@ -117,3 +129,230 @@ def voronoi_prune_region(nodes, alpha_cut, keep=0.05, draw=None):
         del fig
 
     return output
+
+
+def _finite_ridges(voronoi, radius):
+    """Cut off the infinite ridges of a Voronoi diagram
+
+    Each infinite ridge is cut off at a new vertex, radius away from its
+    finite end along the outward normal of its two input points.
+
+    Returns the vertices, with the new ones appended, an (R, 2) array of
+    the ridge vertices, and the indices of the ridges which were cut.
+    """
+    vertices = voronoi.vertices
+    ridges = np.array(voronoi.ridge_vertices, dtype=np.intp).reshape((-1, 2))
+    infinite = np.flatnonzero((ridges == -1).any(axis=1))
+    if not len(infinite):
+        return vertices, ridges, infinite
+
+    points = voronoi.points
+    pairs = voronoi.ridge_points[infinite]
+    finite_end = ridges[infinite].max(axis=1)
+    tangent = points[pairs[:, 1]] - points[pairs[:, 0]]
+    normal = np.column_stack((-tangent[:, 1], tangent[:, 0]))
+    normal /= np.hypot(normal[:, 0], normal[:, 1])[:, np.newaxis]
+    midpoint = points[pairs].mean(axis=1)
+    outward = np.sign(((midpoint - points.mean(axis=0)) * normal).sum(axis=1))
+    outward[outward == 0] = 1
+    far = vertices[finite_end] + normal * (outward * radius)[:, np.newaxis]
+
+    ridges = ridges.copy()
+    ridges[infinite, 0] = finite_end
+    ridges[infinite, 1] = len(vertices) + np.arange(len(infinite))
+    return np.vstack((vertices, far)), ridges, infinite
+
+
+def _closing_edges(ridge_points, ridges, infinite):
+    """Close each infinite region between its two cut off ridges
+
+    Returns an array of (point, vertex, vertex) rows, joining the far
+    ends of the two infinite ridges of each point.  Returns None if an
+    infinite region does not have exactly two infinite ridges.
+    """
+    owners = ridge_points[infinite].ravel()
+    ends = np.repeat(ridges[infinite, 1], 2)
+    order = np.argsort(owners, kind='mergesort')
+    owners = owners[order]
+    ends = ends[order]
+    if len(owners) % 2 or (owners[0::2] != owners[1::2]).any() or \
+            (owners[2::2] == owners[1:-1:2]).any():
+        return None
+    return np.column_stack((owners[0::2], ends[0::2], ends[1::2]))
+
+
+def _orient_edges(vertices, edges, owners, points):
+    """Flip edges so that their owner point lies on their left"""
+    start = vertices[edges[:, 0]]
+    direction = vertices[edges[:, 1]] - start
+    offset = points[owners] - start
+    cross = direction[:, 0] * offset[:, 1] - direction[:, 1] * offset[:, 0]
+    return np.where((cross < 0)[:, np.newaxis], edges[:, ::-1], edges)
+
+
+def _rings_to_polygon(vertices, rings):
+    """Assemble walked rings into a (Multi)Polygon
+
+    Counter-clockwise rings are shells, and clockwise rings are holes,
+    each put in the smallest shell around it.  Returns None if a hole
+    is not inside any shell.
+    """
+    shells = sorted(((area, Polygon(vertices[ring]))
+                     for ring, area in rings if area > 0),
+                    key=lambda x: x[0])
+    if not shells:
+        return None
+    holes = [[] for _ in shells]
+    for ring, area in rings:
+        if area >= 0:
+            continue
+        # The middle of an edge is never on another ring
+        probe = vertices[ring[:2]].mean(axis=0)[np.newaxis]
+        for idx, (_, shell) in enumerate(shells):
+            if points_in_polygon(probe, shell)[0]:
+                holes[idx].append(vertices[ring])
+                break
+        else:
+            return None
+    polygons = [Polygon(shell.exterior.coords, shell_holes)
+                for (_, shell), shell_holes in zip(shells, holes)]
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons)
+
+
+def ordered_rings(vertices, cells, cell_vertices):
+    """Order the vertices of convex cells into rings
+
+    The cells and cell_vertices are matching arrays of (cell, vertex)
+    pairs, which may be repeated.  Since the cells are convex, sorting
+    the vertices of each by their angle around its centroid gives its
+    ring, so all cells are done at once, with one sort.
+
+    Returns the unique cells, the offsets of their rings, with one extra
+    at the end, and the ring vertex indices.  Each ring is counter
+    clockwise and not closed.
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    cell_vertices = np.asarray(cell_vertices, dtype=np.int64)
+    keys = np.unique(cells * len(vertices) + cell_vertices)
+    cells = keys // len(vertices)
+    cell_vertices = keys % len(vertices)
+    unique_cells, first, counts = np.unique(
+        cells, return_index=True, return_counts=True)
+    position = np.repeat(np.arange(len(unique_cells)), counts)
+
+    coords = vertices[cell_vertices]
+    centroids = np.add.reduceat(coords, first, axis=0) / \
+        counts[:, np.newaxis]
+    offset = coords - centroids[position]
+    angles = np.arctan2(offset[:, 1], offset[:, 0])
+    order = np.lexsort((angles, position))
+    return unique_cells, np.append(first, len(keys)), cell_vertices[order]
+
+
+def voronoi_cells(voronoi):
+    """Build the rings of all finite cells of a Voronoi diagram
+
+    Returns the indices of the points with finite cells, the offsets of
+    their rings, with one extra at the end, and the ring coordinates as
+    one (N, 2) array.
+    """
+    lengths = np.array([len(region) for region in voronoi.regions])
+    region_vertices = np.concatenate(
+        [region for region in voronoi.regions if region]).astype(np.intp)
+    region_start = np.cumsum(lengths) - lengths
+
+    point_lengths = lengths[voronoi.point_region]
+    cells = np.repeat(np.arange(len(voronoi.points)), point_lengths)
+    position = np.arange(point_lengths.sum()) - \
+        np.repeat(np.cumsum(point_lengths) - point_lengths, point_lengths)
+    cell_vertices = region_vertices[
+        region_start[voronoi.point_region][cells] + position]
+
+    # Ignore infinite cells
+    infinite = np.zeros(len(voronoi.points), dtype=bool)
+    infinite[cells[cell_vertices == -1]] = True
+    finite = ~infinite[cells]
+    points, offsets, rings = ordered_rings(
+        voronoi.vertices, cells[finite], cell_vertices[finite])
+    return points, offsets, voronoi.vertices[rings]
+
+
+def _union_cells(vertices, ridges, ridge_points, cell_points):
+    """Union the cut off Voronoi cells of some points
+
+    Each cell is made from the vertices of its ridges.
+    """
+    member = np.zeros(ridge_points.max() + 1, dtype=bool)
+    member[cell_points] = True
+    wanted = member[ridge_points]
+    rows = np.nonzero(wanted)[0]
+    _, offsets, rings = ordered_rings(
+        vertices, np.repeat(ridge_points[wanted], 2), ridges[rows].ravel())
+    coords = vertices[rings]
+    return cascaded_union([Polygon(coords[start:stop]) for start, stop
+                           in zip(offsets[:-1], offsets[1:])])
+
+
+def cluster_polygons(voronoi, clusters, bbox):
+    """Build the polygon of each cluster from a Voronoi diagram
+
+    Rather than unioning all the cells of a cluster, only the ridges
+    between points of different clusters are kept.  These are the
+    borders of the clusters, and are walked into rings.  Infinite ridges
+    are cut off far outside the bounding box, which each polygon is
+    then clipped to.  Clusters whose rings don't make a valid polygon
+    fall back to a union of their cells.
+
+    Returns a dict mapping each cluster to its polygon.
+    """
+    clusters = np.asarray(clusters)
+    points = voronoi.points
+    ridge_points = voronoi.ridge_points
+    minx, miny, maxx, maxy = bbox.bounds
+    radius = 10 * max(maxx - minx, maxy - miny, 1.)
+    vertices, ridges, infinite = _finite_ridges(voronoi, radius)
+    closing = _closing_edges(ridge_points, ridges, infinite)
+
+    output = {}
+    fallback = []
+    if closing is None:
+        log.warning("Degenerate infinite regions, unioning all cells")
+        fallback = np.unique(clusters).tolist()
+    else:
+        sides = clusters[ridge_points]
+        border = np.flatnonzero((sides[:, 0] != sides[:, 1]) &
+                                (ridges[:, 0] != ridges[:, 1]))
+        log.info("Found %i border ridges out of %i",
+                 len(border), len(ridges))
+
+        # Every border ridge bounds the clusters on both of its sides,
+        # and every closing edge bounds the cluster of its point.
+        owners = np.concatenate((ridge_points[border, 0],
+                                 ridge_points[border, 1], closing[:, 0]))
+        edges = np.vstack((ridges[border], ridges[border], closing[:, 1:]))
+        edges = _orient_edges(vertices, edges, owners, points)
+        edge_clusters = clusters[owners]
+        order = np.argsort(edge_clusters, kind='mergesort')
+        edge_clusters = edge_clusters[order]
+        edges = edges[order]
+
+        unique_clusters, first = np.unique(edge_clusters, return_index=True)
+        last = np.append(first[1:], len(edges))
+        for cluster, start, stop in zip(unique_clusters.tolist(),
+                                        first, last):
+            polygon = _rings_to_polygon(
+                vertices, boundary_rings(vertices, edges[start:stop]))
+            if polygon is None or not polygon.is_valid:
+                fallback.append(cluster)
+                continue
+            output[cluster] = polygon.intersection(bbox)
+
+    if fallback:
+        log.warning("Unioning the cells of %i clusters", len(fallback))
+    for cluster in fallback:
+        cell_points = np.flatnonzero(clusters == cluster)
+        output[cluster] = _union_cells(
+            vertices, ridges, ridge_points, cell_points).intersection(bbox)
+    return output
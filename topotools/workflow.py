@@ -0,0 +1,161 @@
+'''
+
+The stages of the community identification workflow
+
+The same chain of scripts as the Makefile, as topotools.pipeline stages.
+
+'''
+
+import os
+
+from .pipeline import Output, Stage
+
+# Priority of the stages which take the longest, so they start first
+LONG = 10
+
+
+def city_stages(city, threads=4, graph=None, shapefiles=True,
+                previous=None, cluster_cache=None):
+    """The stages of the workflow, reading city/osrm
+
+    If graph is given, the workflow starts from that igraph file
+    instead.  Without shapefiles, the tesselation is not AND-ed with
+    the land and urban area shapes, so nothing needs downloading.
+
+    For a refresh, previous is a directory with the road.graph and
+    communities.clusters of the last run, which the communities are kept
+    consistent with.  With a cluster_cache directory, the per-cluster
+    stages reuse their results for clusters which didn't change.
+    """
+    if graph is None:
+        graph = Output('igraph')
+    communities_inputs = {'input': graph}
+    communities_args = []
+    if previous is not None:
+        communities_inputs['previous'] = \
+            os.path.join(previous, 'communities.clusters')
+        communities_inputs['previous_graph'] = \
+            os.path.join(previous, 'road.graph')
+        communities_args = ['--previous', '{previous}',
+                            '--previous-graph', '{previous_graph}']
+    cache_args = []
+    if cluster_cache is not None:
+        cache_args = ['--cluster-cache', cluster_cache]
+    if shapefiles:
+        tesselate_inputs = {'urban': 'gis_data/ne_10m_urban_areas.shp',
+                            'land': 'gis_data/ne_10m_land.shp'}
+        tesselate_args = ['--AND', '{urban}', '{land}',
+                          '--mask-cache', 'gis_data/clip-masks']
+    else:
+        tesselate_inputs = {}
+        tesselate_args = []
+    tesselate_args = tesselate_args + cache_args
+    tesselate_inputs['input'] = Output('edges')
+
+    stages = [
+        # Put OSRM graph data into igraph format
+        Stage('igraph', 'osrm2igraph.py',
+              {'input': '%s/osrm' % city}, {'output': 'road.graph'},
+              ['{input}', '{output}'], priority=LONG),
+        # Cluster nodes in graph using fast-greedy
+        Stage('communities', 'find-communities.py',
+              communities_inputs,
+              {'output': 'communities.clusters',
+               'params': 'communities.params.json',
+               'dendrogram': 'communities.dendrogram.npz'},
+              ['--clusters', '{clusters}', '--method', '{method}',
+               '--resolution', '{resolution}', '{input}', '{output}'] +
+              communities_args,
+              params={'clusters': 0, 'method': 'fastgreedy',
+                      'resolution': 1.}, priority=LONG,
+              # Only fastgreedy makes a dendrogram
+              optional=['dendrogram']),
+        # Smooth clustering using nearest neighbors
+        Stage('smoothed', 'nearest-neighbors.py',
+              {'input': Output('communities')},
+              {'output': 'communities.smoothed.clusters'},
+              ['{input}', '{output}', '-k', '{k}', '--threads', threads],
+              params={'k': 30}, threads=threads),
+        # Compute the concave hull for each community
+        Stage('hulls', 'concave-hulls.py',
+              {'input': Output('smoothed')},
+              {'output': 'communities.hulls.json'},
+              ['{input}', '{output}', '--alphacut', '{alphacut}',
+               '--threads', threads, '--processes'] + cache_args,
+              params={'alphacut': 10}, threads=threads),
+        # Delete communities which are spiky or "plus-sign" like.
+        Stage('smooth-hulls', 'clean-spiky-hulls.py',
+              {'input': Output('hulls')},
+              {'output': 'communities.smooth.hulls.json'},
+              ['{input}', '{output}', '--convexity', '{convexity}'],
+              params={'convexity': 0.4}),
+        # Remove tails from communities
+        Stage('no-tails', 'trim-tails.py',
+              {'input': Output('smooth-hulls')},
+              {'output': 'communities.no-tails.json'},
+              ['{input}', '{output}', '--min-tail-pinch', '{tail_pinch}',
+               '--max-tail-length', '{tail_length}'],
+              params={'tail_pinch': 0.05, 'tail_length': 10}),
+        # Orphan nodes that don't lie very near their community hull.
+        Stage('no-outliers', 'clean-outliers.py',
+              {'input': Output('smoothed'), 'hulls': Output('no-tails')},
+              {'output': 'communities.no-outliers.clusters'},
+              ['{input}', '{hulls}', '{output}', '--buffer', '{buffer}',
+               '--threads', threads, '--processes'],
+              params={'buffer': 0.05}, threads=threads),
+        # Reassociate all orphans with their neighbors
+        Stage('associate-outliers', 'nearest-neighbors.py',
+              {'input': Output('no-outliers')},
+              {'output': 'communities.associate-outliers.clusters'},
+              ['{input}', '{output}', '-k', '{k}', '--only-orphans',
+               '--threads', threads],
+              params={'k': 30}, threads=threads),
+        # Get only the nodes on the edges of the communities
+        Stage('edges', 'find-edge-nodes.py',
+              {'input': Output('associate-outliers'),
+               'hulls': Output('smooth-hulls')},
+              {'output': 'communities.edges.clusters'},
+              ['{input}', '{hulls}', '{output}', '--within', '{within}',
+               '--keep', '{keep}', '--threads', threads, '--processes'] +
+              cache_args,
+              params={'within': 0.07, 'keep': 0.03}, threads=threads),
+        # Make voronoi geo-json
+        Stage('tesselation', 'tesselate-communities.py',
+              tesselate_inputs,
+              {'output': 'tesselation.json', 'draw': 'tesselation.pdf'},
+              ['{input}', '{output}', '--draw', '{draw}'] + tesselate_args),
+        # Merge all the puny communities into big ones
+        Stage('merged', 'merge-tiny-communities.py',
+              {'input': Output('tesselation')},
+              {'output': 'tesselation.merged.json'},
+              ['{input}', '{output}', '--min-wrt-quantile50', '{min_area}'],
+              params={'min_area': 0.25}),
+        Stage('topo', 'node_modules/topojson/bin/topojson',
+              {'input': Output('merged')}, {'output': 'topo.json'},
+              ['-o', '{output}', '{input}', '-q', '1e3', '-s', '1E-9']),
+    ]
+    if not isinstance(graph, Output):
+        stages = stages[1:]
+    return stages
+
+
+def parse_value(value):
+    """Read a parameter as a number if it looks like one"""
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
+
+
+def set_params(stages, settings):
+    """Apply stage.name=value settings to the stage parameters"""
+    by_name = dict((stage.name, stage) for stage in stages)
+    for setting in settings:
+        target, _, value = setting.partition('=')
+        stage_name, _, param = target.rpartition('.')
+        if stage_name not in by_name or \
+                param not in by_name[stage_name].params:
+            raise KeyError("Unknown parameter %s" % target)
+        by_name[stage_name].params[param] = parse_value(value)
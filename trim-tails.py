@@ -8,12 +8,11 @@ Trim long pokey tails
 
 import argparse
 import logging
-import math
 
 import geojson
 from shapely.geometry import asShape
-from shapely.geometry import Point, Polygon, LineString
-from scipy.spatial import KDTree
+
+import topotools
 
 log = logging.getLogger(__name__)
 
@@ -36,6 +35,8 @@ if __name__ == "__main__":
                         help='Maximum length/width for '
                         'tails Default %(default)f')
 
+    topotools.metrics.add_argument(parser)
+
     args = parser.parse_args()
 
     logging.basicConfig()
@@ -51,70 +52,10 @@ if __name__ == "__main__":
         # Trim tails on the concave hulls.  Tails are long, thin,
         # features which are created when the community goes
         # down a road away from the main group.
-        has_tail = True  # guilty until proven innocent
-        while has_tail:
-            hull_outline = LineString(shape.exterior)
-            characteristic_size = math.sqrt(shape.area)
-            outline_pts = hull_outline.coords[:]
-            # find the projections along the line lenght for each point
-            projections = [hull_outline.project(Point(x)) for x in outline_pts]
-            # so we can find neighbors close to each other
-            outline_kdtree = KDTree(outline_pts)
-            biggest_tail = None
-            for idx, point in enumerate(outline_pts):
-                proj = projections[idx]
-                # find nearest neighbors, within 5% of total size
-                neighbors = outline_kdtree.query_ball_point(
-                    point, r=characteristic_size * args.tail_pinch)
-                for neighbor in neighbors:
-                    neighbor_point = outline_pts[neighbor]
-                    if neighbor_point == point:
-                        continue
-                    neighbor_proj = projections[neighbor]
-                    # Find distance along edge in both directions.
-                    # Must wrap around at proj = 0.
-                    # The smaller of the two is the relevant one.
-                    distance_along_edge = abs(neighbor_proj - proj)
-                    distance_along_edge = min(
-                        distance_along_edge,
-                        hull_outline.length - distance_along_edge
-                    )
-                    distance_as_crow_flies = math.hypot(
-                        point[0] - neighbor_point[0],
-                        point[1] - neighbor_point[1])
-                    tailiness = distance_along_edge / distance_as_crow_flies
-                    if tailiness > args.tail_length:
-                        #if not biggest_tail or tailiness > biggest_tail[0]:
-                        metric = tailiness * distance_along_edge
-                        if not biggest_tail or metric > biggest_tail[0]:
-                            log.info("Found tail with length^2/width %f, "
-                                     "from idx %i -> %i",
-                                     metric, idx, neighbor)
-                            biggest_tail = (metric, (idx, neighbor))
-            if biggest_tail:
-                log.info("Clipping from %i -> %i, out of %i edges",
-                         biggest_tail[1][0], biggest_tail[1][1],
-                         len(outline_pts))
-                tail_idx_1 = biggest_tail[1][0]
-                tail_idx_2 = biggest_tail[1][1]
-                min_idx = min(tail_idx_1, tail_idx_2)
-                max_idx = max(tail_idx_1, tail_idx_2)
-
-                # Now create two hypotheses for what to delete.
-                hypo_1 = Polygon(outline_pts[min_idx:max_idx + 1])
-                hypo_2 = Polygon(
-                    outline_pts[:min_idx + 1] + outline_pts[max_idx:])
-                split_hull = [hypo_1, hypo_2]
-
-                assert(len(split_hull) == 2)
-                biggest = max(split_hull, key=lambda x: x.area)
-                log.info("Found new hull with %0.2f of the original area "
-                         "and %0.2f of the original length",
-                         biggest.area / shape.area,
-                         biggest.exterior.length / hull_outline.length)
-                shape = biggest
-            else:
-                has_tail = False
+        with topotools.metrics.span(
+                'trim_tails', feature['properties']['clust']):
+            shape, clips = topotools.trim_tails(
+                shape, args.tail_pinch, args.tail_length)
         feature['geometry'] = shape
         output_features.append(feature)
 
@@ -122,3 +63,5 @@ if __name__ == "__main__":
         log.info("Writing output to %s", args.output)
         geojson.dump(geojson.FeatureCollection(output_features),
                      outputfd, indent=2)
+
+    topotools.metrics.write(args.metrics)